@@ -1,55 +1,190 @@
 # app.py
-from flask import Flask, render_template, request, redirect, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, flash
 from flask_mysqldb import MySQL
 from werkzeug.utils import secure_filename
 import os
 import time
-import sqlite3
 import boto3
+from botocore.config import Config
 from models import db
+from migrations import run_migrations
+from sqlite_config import DEFAULT_PRAGMAS, configure_engine
+from sqlite_pool import SQLitePool
 from routes import bp as sections_bp
 from home_routes import bp as home_bp
 from kiosk_routes import bp as kiosks_bp
 from floorplan_routes import bp as floorplan_bp
+from job_routes import bp as jobs_bp
+from cache_routes import bp as cache_bp
+from metrics_routes import bp as metrics_bp
+from bulk_edit_routes import bp as bulk_edit_bp
+from upload_jobs import UploadJobQueue
+from transcode import TranscodeQueue
+from manifests import ManifestQueue
+from floorplan_index import FloorPlanIndex
+from response_cache import ResponseCache
+from json_provider import OrjsonProvider
+from profiling import RequestMetrics
+import compression
+import query_budget
+import image_derivatives
+import content_store
 
 app = Flask(__name__)
 
 # Configuration
 app.config['SECRET_KEY'] = 'your_secret_key'
 # Set absolute path for uploads folder
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request body, except on the upload endpoints
+app.config['UPLOAD_MAX_CONTENT_LENGTH'] = int(os.environ.get('UPLOAD_MAX_CONTENT_LENGTH', 2 * 1024 * 1024 * 1024))  # 2GB, see helpers.large_upload
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'mp4', 'mkv'}  # Added mkv
 
 # Ensure upload directory exists
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
+# How /uploads/<path> is served: 'sendfile' (WSGI file wrapper), 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd)
+app.config['UPLOADS_SERVE_MODE'] = os.environ.get('UPLOADS_SERVE_MODE', 'sendfile')
+app.config['UPLOADS_ACCEL_PREFIX'] = os.environ.get('UPLOADS_ACCEL_PREFIX', '/_uploads/')  # nginx internal location
+app.config['UPLOADS_MAX_AGE'] = 3600  # Seconds; content-hashed names are cached for a year
+
+# Media cache configuration (local copies of S3 objects served by /media/<path>)
+app.config['MEDIA_CACHE_DIR'] = os.environ.get('MEDIA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_cache'))
+app.config['MEDIA_CACHE_MAX_BYTES'] = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024))  # 10GB
+app.config['MEDIA_CACHE_REVALIDATE_SECONDS'] = int(os.environ.get('MEDIA_CACHE_REVALIDATE_SECONDS', 3600))
+
+# Upstream (S3) HTTP client configuration
+app.config['UPSTREAM_POOL_SIZE'] = int(os.environ.get('UPSTREAM_POOL_SIZE', 20))
+app.config['UPSTREAM_CONNECT_TIMEOUT'] = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+app.config['UPSTREAM_READ_TIMEOUT'] = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 30))
+app.config['UPSTREAM_RETRIES'] = int(os.environ.get('UPSTREAM_RETRIES', 3))
+app.config['UPSTREAM_BACKOFF_FACTOR'] = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.3))
+
+# Background upload jobs (spooled to disk, pushed to S3 by worker threads)
+app.config['UPLOAD_JOBS_DB'] = os.environ.get('UPLOAD_JOBS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_jobs.db'))
+app.config['UPLOAD_SPOOL_DIR'] = os.environ.get('UPLOAD_SPOOL_DIR', os.path.join(app.instance_path, 'upload_spool'))  # Not under UPLOAD_FOLDER, which is served
+app.config['UPLOAD_JOB_WORKERS'] = int(os.environ.get('UPLOAD_JOB_WORKERS', 2))
+
+# Kiosk manifests are rebuilt by background worker threads after the changes commit
+app.config['MANIFEST_WORKERS'] = int(os.environ.get('MANIFEST_WORKERS', 1))
+
+# Floor plan search index; workers watch this file to notice plan changes made elsewhere
+app.config['FLOORPLAN_INDEX_STAMP'] = os.environ.get('FLOORPLAN_INDEX_STAMP', os.path.join(app.instance_path, 'floorplan_index.stamp'))
+
+# Page sizes for the cursor-paginated list APIs
+app.config['API_DEFAULT_PAGE_SIZE'] = int(os.environ.get('API_DEFAULT_PAGE_SIZE', 50))
+app.config['API_MAX_PAGE_SIZE'] = int(os.environ.get('API_MAX_PAGE_SIZE', 200))
+
+# Response cache for read-heavy JSON endpoints: 'memory' (per process, purged in all of them through RESPONSE_CACHE_DB),
+# 'sqlite' (entries shared by all workers) or None to disable
+app.config['RESPONSE_CACHE_BACKEND'] = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+app.config['RESPONSE_CACHE_DB'] = os.environ.get('RESPONSE_CACHE_DB', os.path.join(app.instance_path, 'response_cache.db'))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 300))  # Seconds
+app.config['RESPONSE_CACHE_MAX_ENTRIES'] = 1000
+
+# On-the-fly compression of JSON responses (cached responses are stored pre-compressed)
+app.config['COMPRESS_MIMETYPES'] = {'application/json'}
+app.config['COMPRESS_MIN_SIZE'] = 1024  # Bytes; smaller bodies aren't worth the CPU
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+
+# Per-request instrumentation: Prometheus metrics at /metrics and profiles of slow requests
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR', os.path.join(app.instance_path, 'metrics'))  # One file per worker, summed by /metrics
+app.config['METRICS_FLUSH_SECONDS'] = 5
+app.config['PROFILE_SLOW_MS'] = int(os.environ['PROFILE_SLOW_MS']) if os.environ.get('PROFILE_SLOW_MS') else None  # None disables profiling
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))  # Fraction of requests profiled
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['QUERY_BUDGET_MODE'] = os.environ.get('QUERY_BUDGET_MODE', 'off')  # off, warn or strict
+app.config['QUERY_BUDGET_DEFAULT'] = 10  # SQL statements per request for views without @query_budget
+
+# Responsive image derivatives created next to uploaded photos and elevations
+app.config['IMAGE_DERIVATIVE_WIDTHS'] = (320, 640, 960, 1440)
+
+# HLS transcoding of kiosk videos (ffmpeg, run by background worker threads)
+app.config['FFMPEG_BINARY'] = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+app.config['FFPROBE_BINARY'] = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+app.config['TRANSCODE_WORKERS'] = int(os.environ.get('TRANSCODE_WORKERS', 1))
+app.config['TRANSCODE_WORK_DIR'] = os.environ.get('TRANSCODE_WORK_DIR', os.path.join(app.instance_path, 'transcode'))  # Not under UPLOAD_FOLDER, which is served
+app.config['HLS_SEGMENT_SECONDS'] = 6
+app.config['HLS_LADDER'] = (  # (name, height, video kbps, audio kbps)
+    ('360p', 360, 800, 96),
+    ('540p', 540, 1800, 128),
+    ('720p', 720, 3000, 128),
+    ('1080p', 1080, 5500, 160),
+)
+
 # SQLAlchemy configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLITE_PRAGMAS'] = dict(DEFAULT_PRAGMAS)
+
+# Connection pool for the raw sqlite3 floor_plans_and_elevations database
+app.config['SQLITE_DATABASE'] = os.environ.get('SQLITE_DATABASE', 'database.db')
+app.config['SQLITE_POOL_SIZE'] = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+app.config['SQLITE_POOL_TIMEOUT'] = 10  # Seconds to wait for a free connection
+app.config['SQLITE_STATEMENT_CACHE_SIZE'] = 128  # Prepared statements kept per connection
 
 # S3 configuration
 app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET')
 app.config['S3_KEY'] = os.environ.get('S3_KEY')
 app.config['S3_SECRET'] = os.environ.get('S3_SECRET')
 app.config['S3_LOCATION'] = os.environ.get('S3_LOCATION')
+app.config['S3_UPLOAD_WORKERS'] = int(os.environ.get('S3_UPLOAD_WORKERS', 8))  # Files uploaded in parallel per process
+app.config['S3_MULTIPART_THRESHOLD'] = 8 * 1024 * 1024  # Use multipart uploads above 8MB
+app.config['S3_MULTIPART_CHUNKSIZE'] = 8 * 1024 * 1024
+app.config['S3_MULTIPART_CONCURRENCY'] = 4  # Parts in flight per file
 
 # Initialize S3 client
 app.s3 = boto3.client(
     's3',
     aws_access_key_id=app.config['S3_KEY'],
-    aws_secret_access_key=app.config['S3_SECRET']
+    aws_secret_access_key=app.config['S3_SECRET'],
+    # Enough connections for every parallel upload to run its multipart parts at once
+    config=Config(max_pool_connections=app.config['S3_UPLOAD_WORKERS'] * app.config['S3_MULTIPART_CONCURRENCY'])
 )
 
 # Initialize SQLAlchemy
 db.init_app(app)
+with app.app_context():
+    configure_engine(db.engine, app.config['SQLITE_PRAGMAS'])
+
+# Initialize request instrumentation first, so its after_request hook sees the final (compressed) response
+request_metrics = RequestMetrics(app)
+query_budget.init_app(app)
+
+# Initialize background upload queue
+upload_queue = UploadJobQueue(app)
+
+# Initialize background HLS transcoding of kiosk videos
+transcode_queue = TranscodeQueue(app)
+
+# Initialize background rebuilds of kiosk manifests
+manifest_queue = ManifestQueue(app)
+
+# Initialize in-memory floor plan search index
+floorplan_index = FloorPlanIndex(app)
+
+# Initialize response cache
+response_cache = ResponseCache(app)
+
+# Serialize JSON with orjson and compress it for clients that accept gzip/brotli
+app.json = OrjsonProvider(app)
+compression.init_app(app)
+
+# Template helpers for srcset/placeholder rendering and /media URLs
+image_derivatives.init_app(app)
+content_store.init_app(app)
 
 # Register blueprints with URL prefix
 app.register_blueprint(sections_bp, url_prefix='')
 app.register_blueprint(kiosks_bp, url_prefix='')
 app.register_blueprint(home_bp, url_prefix='')
 app.register_blueprint(floorplan_bp, url_prefix='')
+app.register_blueprint(jobs_bp, url_prefix='')
+app.register_blueprint(cache_bp, url_prefix='')
+app.register_blueprint(metrics_bp, url_prefix='')
+app.register_blueprint(bulk_edit_bp, url_prefix='')
 
 # If you're using MySQL
 app.config['MYSQL_HOST'] = 'localhost'
@@ -60,41 +195,51 @@ app.config['MYSQL_DB'] = 'floorplan_db'
 # Initialize MySQL
 mysql = MySQL(app)
 
-@app.route('/uploads/<path:filename>')
-def uploaded_file(filename):
-    return send_from_directory('uploads', filename)
+# Pooled SQLite DB connections (as an alternative to MySQL)
+sqlite_pool = SQLitePool(
+    app.config['SQLITE_DATABASE'],
+    size=app.config['SQLITE_POOL_SIZE'],
+    timeout=app.config['SQLITE_POOL_TIMEOUT'],
+    pragmas=app.config['SQLITE_PRAGMAS'],
+    statement_cache_size=app.config['SQLITE_STATEMENT_CACHE_SIZE']
+)
+sqlite_pool.init_app(app)
 
-# Create SQLite DB connection (as an alternative to MySQL)
 def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    """The current request's pooled connection; it goes back to the pool on teardown"""
+    return sqlite_pool.get_connection()
 
 def init_sqlite_db():
     # Create tables for existing functionality
-    conn = get_db_connection()
-    conn.execute('''
-    CREATE TABLE IF NOT EXISTS floor_plans_and_elevations (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        dimension TEXT NOT NULL,
-        facing TEXT NOT NULL,
-        type_of_use TEXT NOT NULL,
-        floors INTEGER NOT NULL,
-        floor_plan TEXT,
-        elevation TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    conn.commit()
-    conn.close()
+    with sqlite_pool.connection() as conn:
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS floor_plans_and_elevations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dimension TEXT NOT NULL,
+            facing TEXT NOT NULL,
+            type_of_use TEXT NOT NULL,
+            floors INTEGER NOT NULL,
+            floor_plan TEXT,
+            elevation TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        conn.commit()
 
     # Create tables for new functionality using SQLAlchemy
     with app.app_context():
         db.create_all()
+        run_migrations(db.engine)
 
 # Initialize SQLite DB
 init_sqlite_db()
 
+# Start the background workers now rather than on the first request, so jobs queued before a restart
+# resume right away; a process forked from this one (gunicorn --preload) starts its own on its first request
+upload_queue.ensure_workers()
+transcode_queue.ensure_workers()
+manifest_queue.ensure_workers()
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
@@ -136,7 +281,6 @@ def upload_floor_plan_and_elevation():
             floor_plan_filename = save_file_locally(floor_plan, floor_plan_filename)
         else:
             flash('Invalid floor plan file', 'danger')
-            conn.close()
             return redirect(request.url)
         
         # Handle elevation image upload
@@ -146,7 +290,6 @@ def upload_floor_plan_and_elevation():
             elevation_filename = save_file_locally(elevation, elevation_filename)
         else:
             flash('Invalid elevation image file', 'danger')
-            conn.close()
             return redirect(request.url)
         
         # Update the record with file paths
@@ -154,7 +297,6 @@ def upload_floor_plan_and_elevation():
         conn.execute(update_query, (floor_plan_filename, elevation_filename, last_row_id))
         
         conn.commit()
-        conn.close()
         
         flash('Floor plan and elevation uploaded successfully', 'success')
         return redirect('/upload_floor_plan_and_elevation')
@@ -166,7 +308,6 @@ def view_records():
 
     conn = get_db_connection()
     records = conn.execute("SELECT * FROM floor_plans_and_elevations").fetchall()
-    conn.close()
 
     return render_template('view_records.html', records=records)
 
@@ -212,7 +353,6 @@ def check_floor_plan_and_elevation():
             print("Floor Plan:", row['floor_plan'])
             print("Elevation:", row['elevation'])
             print("Created At:", row['created_at'])
-        conn.close()
         return render_template('check_floor_plan_and_elevation.html', floor_plans_and_elevations=res, view_floor_plans=True, no_floor_plans_and_elevations=False)
 
     if dimension != '' or facing != '' or floors != '' or type_of_use != '':
@@ -220,7 +360,6 @@ def check_floor_plan_and_elevation():
         cur = conn.cursor()
         cur.execute("SELECT * FROM floor_plans_and_elevations WHERE dimension = ? OR facing = ? OR floors = ? OR type_of_use = ?", (dimension, facing, floors, type_of_use))
         res = cur.fetchall()
-        conn.close()
         no_floor_plans_and_elevations = True
         if len(res) > 0:
             no_floor_plans_and_elevations = False
@@ -0,0 +1,99 @@
+"""
+Set-based title (and description) edits for Media and ButtonMedia.
+
+rename_titles() applies any number of (original title -> new title) renames
+in one UPDATE ... SET title = CASE title WHEN ... END WHERE title IN (...),
+so renaming a title shared by thousands of rows, or many titles at once,
+is a single round trip. Every rename matches against the titles as they
+were before the statement, so a -> b and b -> c in one call don't chain.
+
+Like media_mapping.py, the statement bypasses the ORM, so it records the
+updated rows' cache tags (and, for button media, the kiosk manifests to
+rebuild) on the session itself. The caller commits.
+"""
+from sqlalchemy import case
+from models import db, Media, ButtonMedia
+from manifests import kiosks_for_buttons, rebuild_on_commit
+from response_cache import invalidate_on_commit
+
+# Editable table -> (model, foreign key to the row each row belongs to, that row's table)
+EDITABLE = {
+    'media': (Media, 'subsection_id', 'subsection'),
+    'button_media': (ButtonMedia, 'button_id', 'button'),
+}
+
+
+class BulkEditError(ValueError):
+    """A rename list that can't be applied as given"""
+
+
+def parse_renames(items):
+    """Validate [{'original_title', 'new_title', 'description'?}] into (original, new, description or None) tuples"""
+    if not isinstance(items, list) or not items:
+        raise BulkEditError('renames must be a non-empty list')
+    renames = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise BulkEditError('each rename must be an object')
+        original, new = item.get('original_title'), item.get('new_title')
+        description = item.get('description')
+        if not isinstance(original, str) or not original or not isinstance(new, str) or not new:
+            raise BulkEditError('each rename needs original_title and new_title')
+        if description is not None and not isinstance(description, str):
+            raise BulkEditError('description must be a string')
+        renames.append((original, new, description))
+    if len({original for original, _, _ in renames}) != len(renames):
+        raise BulkEditError('each original_title may only be renamed once per request')
+    return renames
+
+
+def rename_titles(table_name, renames):
+    """
+    Apply (original, new, description) renames to `table_name` in one UPDATE.
+    A description of None leaves the rows' descriptions alone. Returns
+    {new title: [ids]} of the rows that were updated.
+    """
+    model, owner_column, _ = EDITABLE[table_name]
+    table = model.__table__
+    titles = {original: new for original, new, _ in renames}
+    descriptions = {original: description for original, _, description in renames if description is not None}
+
+    values = {'title': case(titles, value=table.c.title)}
+    if descriptions:
+        values['description'] = case(descriptions, value=table.c.title, else_=table.c.description)
+    statement = (
+        table.update()
+        .where(table.c.title.in_(titles))
+        .values(**values)
+        .returning(table.c.id, table.c.title, table.c[owner_column])
+    )
+    rows = db.session.execute(statement).all()
+
+    updated = {}
+    for row in rows:
+        updated.setdefault(row.title, []).append(row.id)
+    if rows:
+        _bookkeeping(table_name, rows)
+    return {title: sorted(ids) for title, ids in updated.items()}
+
+
+def _bookkeeping(table_name, rows):
+    """What the session hooks would have done for these updated rows"""
+    _, owner_column, owner_table = EDITABLE[table_name]
+    session = db.session()
+    tags = {table_name}
+    for row in rows:
+        tags.update((f"{table_name}:{row.id}", f"{owner_table}:{getattr(row, owner_column)}"))
+    invalidate_on_commit(session, tags)
+    if table_name == 'button_media':
+        rebuild_on_commit(session, kiosks_for_buttons(session.connection(), {row.button_id for row in rows}))
+
+
+def summarize(updated):
+    """rename_titles' result as a response body: total count, every id, and count and ids per new title"""
+    ids = sorted(id for title_ids in updated.values() for id in title_ids)
+    return {
+        'count': len(ids),
+        'ids': ids,
+        'titles': {title: {'count': len(title_ids), 'ids': title_ids} for title, title_ids in updated.items()}
+    }
@@ -0,0 +1,34 @@
+from flask import Blueprint, request, jsonify, current_app
+from models import db
+from bulk_edit import EDITABLE, BulkEditError, parse_renames, rename_titles, summarize
+
+bp = Blueprint('bulk_edit', __name__)
+
+@bp.route('/api/titles', methods=['PUT'])
+def update_titles():
+    """
+    Rename many titles of media or button media in one statement.
+
+    Request body:
+    {
+        "table": "media" or "button_media",
+        "renames": [{"original_title": "...", "new_title": "...", "description": "..." (optional)}, ...]
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    table = data.get('table')
+    if table not in EDITABLE:
+        return jsonify({'error': f"table must be one of {', '.join(EDITABLE)}"}), 400
+    try:
+        renames = parse_renames(data.get('renames'))
+    except BulkEditError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        updated = rename_titles(table, renames)
+        db.session.commit()
+        return jsonify(dict(summarize(updated), table=table))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in update_titles: {str(e)}")
+        return jsonify({'error': str(e)}), 500
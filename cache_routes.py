@@ -0,0 +1,9 @@
+from flask import Blueprint, jsonify
+from response_cache import get_response_cache
+
+bp = Blueprint('cache', __name__)
+
+@bp.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Hit/miss counters of this worker's response cache"""
+    return jsonify(get_response_cache().get_stats())
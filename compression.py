@@ -0,0 +1,73 @@
+import gzip
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Preferred first when the client weighs them equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(body, encoding, best=False):
+    """Compress `body`; `best` trades CPU for size and is meant for bodies compressed once and reused"""
+    if encoding == 'br':
+        quality = 11 if best else current_app.config['COMPRESS_BROTLI_QUALITY']
+        return brotli.compress(body, quality=quality)
+    level = 9 if best else current_app.config['COMPRESS_GZIP_LEVEL']
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def compressible(response):
+    return (
+        response.status_code == 200
+        and response.mimetype in current_app.config['COMPRESS_MIMETYPES']
+        and 'Content-Encoding' not in response.headers
+        and not response.direct_passthrough
+    )
+
+
+def compress_variants(body):
+    """Every supported encoding of `body`, best compression, for storing next to a cached response"""
+    if len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+        return {}
+    return {encoding: compress(body, encoding, best=True) for encoding in ENCODINGS}
+
+
+def negotiate(available):
+    """Pick the encoding from `available` the client prefers, or None for identity"""
+    best, best_quality = None, 0
+    for encoding in ENCODINGS:
+        if encoding not in available:
+            continue
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def set_encoded_body(response, encoding, body):
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # A compressed body is a different representation, so only weak validators still hold
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """after_request hook: compress JSON responses on the fly when the client accepts it"""
+    if not compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if len(response.get_data()) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = negotiate(ENCODINGS)
+    if encoding is not None:
+        set_encoded_body(response, encoding, compress(response.get_data(), encoding))
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
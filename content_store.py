@@ -0,0 +1,249 @@
+"""
+Content-addressed storage for uploaded media.
+
+Uploads are keyed by the SHA-256 of their bytes (objects/<digest>.<ext>), so
+the same photo uploaded through /api/media/batch, /api/button-media/batch and
+a home gallery is a single S3 object, and only the first upload does a PUT.
+
+media_objects.ref_count counts the rows whose path columns (REFERENCES) point
+at each object. It is adjusted inside every flush that inserts, deletes or
+repoints such a row, so it commits or rolls back with them. Statements that
+bypass the ORM (bulk inserts/deletes) must call adjust_references themselves.
+
+A row whose count drops to 0 is a pending delete: the same statement that
+decrements it decides it, and the row stays until the object is gone from S3.
+delete_from_s3 deletes it through releasing(), which re-checks the count
+while holding the database write lock, so no upload can reference the object
+in between; purge_unreferenced retries the ones whose delete failed.
+
+An upload that skips storing an object because it already exists can still
+lose it to a delete that was decided before the upload committed. Uploads
+keep their bytes with keep_for_commit, and once the transaction commits,
+any such object it brought back from a count of 0 is checked and stored again
+if it's missing.
+"""
+import hashlib
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from urllib.parse import urlparse
+from flask import current_app
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+from models import db, Media, ButtonMedia, HomeMedia, FloorPlan, Video, MediaObject
+
+KEY_PREFIX = 'objects/'
+HASH_CHUNK_SIZE = 1024 * 1024
+PURGE_RETRY_AFTER = timedelta(minutes=5)  # How long a failed delete waits before purge_unreferenced retries it
+PURGE_BATCH = 100
+
+KNOWN_KEY = 'content_store_known'  # session.info: keys that had a media_objects row when checked
+KEPT_KEY = 'content_store_kept'  # session.info: {key: (file or spool path, content type)} uploaded or skipped
+ACQUIRED_KEY = 'content_store_acquired'  # session.info: file paths whose count went up from 0
+
+# Model -> columns holding the URL of a stored object
+REFERENCES = {
+    Media: ('file_path',),
+    ButtonMedia: ('file_path',),
+    HomeMedia: ('file_path',),
+    Video: ('file_path',),
+    FloorPlan: ('floor_plan_path', 'elevation_path'),
+}
+
+
+def content_key(file, filename):
+    """
+    Hash `file` (an upload or stream) a chunk at a time and return its key,
+    objects/<sha256>.<ext>. The stream is rewound so it can be uploaded next.
+    """
+    stream = getattr(file, 'stream', file)
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    extension = os.path.splitext(filename)[1].lower()
+    return f"{KEY_PREFIX}{digest.hexdigest()}{extension}"
+
+
+def _url(key):
+    return f"{current_app.config['S3_LOCATION'].rstrip('/')}/{key}"
+
+
+def object_key(file_path):
+    """The bucket key of a stored URL; S3_LOCATION may be virtual-hosted or path-style (a local S3 stand-in)"""
+    s3_location = f"{current_app.config['S3_LOCATION'].rstrip('/')}/"
+    if file_path.startswith(s3_location):
+        return file_path[len(s3_location):]
+    return urlparse(file_path).path.lstrip('/')
+
+
+def media_url(file_path):
+    """The /media URL that serves a stored object (through the local media cache)"""
+    return f"/media/{object_key(file_path)}"
+
+
+def init_app(app):
+    app.add_template_filter(media_url, 'media_url')
+
+
+def existing_keys(keys):
+    """The content-addressed keys among `keys` that are already stored and referenced"""
+    urls = {_url(key): key for key in keys if key.startswith(KEY_PREFIX)}
+    if not urls:
+        return set()
+    rows = db.session.query(MediaObject.file_path, MediaObject.ref_count).filter(MediaObject.file_path.in_(urls))
+    counts = {urls[file_path]: ref_count for file_path, ref_count in rows}
+    db.session.info.setdefault(KNOWN_KEY, set()).update(counts)
+    return {key for key, ref_count in counts.items() if ref_count > 0}
+
+
+def keep_for_commit(key, file, content_type):
+    """Hold on to the bytes behind `key` (an open file or a path) until commit, in case they must be stored again"""
+    if key.startswith(KEY_PREFIX):
+        db.session.info.setdefault(KEPT_KEY, {})[key] = (file, content_type)
+
+
+def reference_count(file_path):
+    """How many rows point at `file_path`, or None if it isn't a tracked object (e.g. a derivative)"""
+    return db.session.query(MediaObject.ref_count).filter_by(file_path=file_path).scalar()
+
+
+def is_referenced(file_path):
+    return bool(reference_count(file_path))
+
+
+@contextmanager
+def releasing(file_path):
+    """
+    Yield whether the object at `file_path` may be deleted from storage: nothing references it (or it isn't
+    tracked). The block runs holding the database write lock, so nothing can start referencing it meanwhile,
+    and the bookkeeping row goes once the block succeeds; if it raises, the delete stays pending.
+    """
+    table = MediaObject.__table__
+    failure = None
+    with db.engine.begin() as conn:
+        # A write, so it takes the lock before reading the count
+        ref_count = conn.execute(
+            table.update().where(table.c.file_path == file_path)
+            .values(checked_at=datetime.utcnow()).returning(table.c.ref_count)
+        ).scalar()
+        if ref_count:
+            yield False
+            return
+        try:
+            yield True
+        except Exception as e:
+            failure = e  # Commit just the attempt: the delete stays pending for purge_unreferenced
+        else:
+            if ref_count is not None:
+                conn.execute(table.delete().where(table.c.file_path == file_path))
+    if failure is not None:
+        raise failure
+
+
+def unreferenced(limit=PURGE_BATCH):
+    """File paths of pending deletes that haven't been tried for PURGE_RETRY_AFTER"""
+    rows = db.session.query(MediaObject.file_path).filter(
+        MediaObject.ref_count <= 0, MediaObject.checked_at < datetime.utcnow() - PURGE_RETRY_AFTER
+    ).order_by(MediaObject.checked_at).limit(limit)
+    return [file_path for file_path, in rows]
+
+
+def adjust_references(connection, deltas):
+    """
+    Add {file_path: delta} to the reference counts, on `connection`'s transaction, in one statement.
+    Returns {file_path: new count}: a count that drops to 0 is a pending delete (see the module docstring).
+    """
+    deltas = [(file_path, delta) for file_path, delta in deltas.items() if file_path and delta]
+    if not deltas:
+        return {}
+    params = {'now': datetime.utcnow()}
+    values = []
+    for i, (file_path, delta) in enumerate(deltas):
+        params[f'file_path_{i}'], params[f'delta_{i}'] = file_path, delta
+        values.append(f'(:file_path_{i}, :delta_{i})')
+    rows = connection.execute(text(
+        f'WITH deltas (file_path, delta) AS (VALUES {", ".join(values)}) '
+        'INSERT INTO media_objects (file_path, ref_count, checked_at) '
+        'SELECT file_path, MAX(delta, 0), :now FROM deltas WHERE true '
+        'ON CONFLICT (file_path) DO UPDATE SET checked_at = :now, ref_count = MAX(media_objects.ref_count + '
+        '(SELECT delta FROM deltas WHERE deltas.file_path = excluded.file_path), 0) '
+        'RETURNING file_path, ref_count'
+    ), params)
+    return dict(rows.all())
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_references(session, flush_context):
+    deltas = {}
+
+    def add(values, delta):
+        for value in values:
+            if value:
+                deltas[value] = deltas.get(value, 0) + delta
+
+    for obj in session.new:
+        for attr in REFERENCES.get(type(obj), ()):
+            add([getattr(obj, attr)], 1)
+    for obj in session.deleted:
+        state = inspect(obj)
+        for attr in REFERENCES.get(type(obj), ()):
+            history = state.attrs[attr].history
+            add(history.deleted or history.unchanged, -1)
+    for obj in session.dirty:
+        state = inspect(obj)
+        for attr in REFERENCES.get(type(obj), ()):
+            history = state.attrs[attr].history
+            if history.has_changes():
+                add(history.deleted, -1)
+                add(history.added, 1)
+
+    counts = adjust_references(session.connection(), deltas)
+    session.info.setdefault(ACQUIRED_KEY, set()).update(
+        file_path for file_path, ref_count in counts.items() if 0 < deltas[file_path] == ref_count
+    )
+
+
+@event.listens_for(Session, 'after_commit')
+def _store_acquired_again(session):
+    acquired = session.info.pop(ACQUIRED_KEY, None)
+    known = session.info.pop(KNOWN_KEY, None)
+    kept = session.info.pop(KEPT_KEY, None)
+    if not (acquired and known and kept):
+        return
+    for file_path in acquired:
+        key = object_key(file_path)
+        # Only objects that already had a row can have been deleted while this transaction ran
+        if key in known and key in kept:
+            try:
+                _ensure_stored(key, *kept[key])
+            except Exception as e:
+                current_app.logger.error(f"Error checking {key} is still on S3: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_acquired(session):
+    for name in (ACQUIRED_KEY, KNOWN_KEY, KEPT_KEY):
+        session.info.pop(name, None)
+
+
+def _ensure_stored(key, file, content_type):
+    """Store `file` at `key` again if a delete removed it"""
+    bucket = current_app.config['S3_BUCKET']
+    try:
+        current_app.s3.head_object(Bucket=bucket, Key=key)
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+    current_app.logger.warning(f"{key} was deleted while an upload was using it; storing it again")
+    extra_args = {'ACL': 'public-read', 'ContentType': content_type or 'application/octet-stream'}
+    if isinstance(file, str):
+        with open(file, 'rb') as f:
+            current_app.s3.upload_fileobj(f, bucket, key, ExtraArgs=extra_args)
+    else:
+        stream = getattr(file, 'stream', file)
+        stream.seek(0)
+        current_app.s3.upload_fileobj(stream, bucket, key, ExtraArgs=extra_args)
@@ -0,0 +1,244 @@
+import bisect
+import os
+import threading
+import uuid
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import FloorPlan
+from pagination import sort_key
+from constants import SITE_DIMENSIONS, FACING_OPTIONS, FLOOR_COUNT_OPTIONS, PLAN_TYPES
+
+# Facet column -> the options the search UI offers for it
+FACETS = {
+    'site_dimension': SITE_DIMENSIONS,
+    'facing': FACING_OPTIONS,
+    'floors': FLOOR_COUNT_OPTIONS,
+    'type': PLAN_TYPES
+}
+
+CHANGES_KEY = 'floorplan_changes'
+
+
+def _plan_row(plan):
+    return {
+        'id': plan.id,
+        'site_dimension': plan.site_dimension,
+        'facing': plan.facing,
+        'type': plan.type,
+        'floors': plan.floors,
+        'floor_plan_path': plan.floor_plan_path,
+        'elevation_path': plan.elevation_path,
+        'floor_plan_derivatives': plan.floor_plan_derivatives,
+        'elevation_derivatives': plan.elevation_derivatives,
+        'created_at': plan.created_at,
+        'updated_at': plan.updated_at
+    }
+
+
+def _row_key(row):
+    return sort_key(row['created_at'], row['id'])
+
+
+class FloorPlanIndex:
+    """
+    In-memory faceted index over every FloorPlan.
+
+    Each plan occupies a slot, and every facet value keeps a bitmap (a Python
+    int) of the slots that have it. A search ANDs the bitmaps of the selected
+    values, and the count for any other option is one more AND plus a popcount,
+    so filtering and facet counts never touch the database.
+
+    Slots are in pagination.sort_key order (oldest first), so the highest set
+    bits of a search's bitmap are its newest plans and a page is read by
+    masking off everything at or after the cursor and taking the top `limit`
+    bits, without sorting the matches. New plans normally sort last and are
+    appended; a plan that sorts earlier (no created_at, backdated) rebuilds
+    the slots. A deleted plan leaves a free slot that an update to the same
+    plan reuses; once half the slots are free they're compacted.
+
+    Commits that change plans update this process's index in place and touch a
+    stamp file; other workers see the new stamp and reload on their next search.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        self._version = None
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.stamp_path = app.config['FLOORPLAN_INDEX_STAMP']
+        os.makedirs(os.path.dirname(self.stamp_path), exist_ok=True)
+        app.extensions['floorplan_index'] = self
+
+    def _reset(self):
+        self.rows = []  # slot -> plan row (None for free slots)
+        self.keys = []  # slot -> sort_key of the plan in it (kept for free slots, so it stays sorted)
+        self.slots = {}  # plan id -> slot
+        self.free_count = 0
+        self.all_mask = 0
+        self.bitmaps = {facet: {} for facet in FACETS}
+
+    def _load(self, rows):
+        self._reset()
+        for row in sorted(rows, key=_row_key):
+            self.rows.append(row)
+            self.keys.append(_row_key(row))
+            self._fill(len(self.rows) - 1, row)
+
+    def _stamp_version(self):
+        try:
+            st = os.stat(self.stamp_path)
+            return (st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def _touch_stamp(self):
+        temp_path = f"{self.stamp_path}.{uuid.uuid4().hex}"
+        with open(temp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(temp_path, self.stamp_path)
+
+    def invalidate(self):
+        """Make every process reload, e.g. after plans were written without the ORM"""
+        with self._lock:
+            self._touch_stamp()
+            self._version = None
+
+    def ensure_fresh(self):
+        """Reload from the database if another process changed plans since we loaded"""
+        version = self._stamp_version()
+        if self._version is not None and version == self._version:
+            return
+        with self._lock:
+            if self._version is not None and version == self._version:
+                return
+            self._load([_plan_row(plan) for plan in FloorPlan.query.all()])
+            self._version = version
+
+    def _add(self, row):
+        key = _row_key(row)
+        slot = bisect.bisect_left(self.keys, key)
+        if slot < len(self.rows) and self.keys[slot] == key and self.rows[slot] is None:
+            self.rows[slot] = row  # Its own free slot: an update that kept the plan's place
+            self.free_count -= 1
+        elif slot == len(self.rows):
+            self.rows.append(row)
+            self.keys.append(key)
+        else:
+            self._load([existing for existing in self.rows if existing is not None] + [row])
+            return
+        self._fill(slot, row)
+
+    def _fill(self, slot, row):
+        self.slots[row['id']] = slot
+        bit = 1 << slot
+        self.all_mask |= bit
+        for facet in FACETS:
+            values = self.bitmaps[facet]
+            values[row[facet]] = values.get(row[facet], 0) | bit
+
+    def _remove(self, plan_id):
+        slot = self.slots.pop(plan_id, None)
+        if slot is None:
+            return
+        row = self.rows[slot]
+        bit = 1 << slot
+        self.all_mask &= ~bit
+        for facet in FACETS:
+            values = self.bitmaps[facet]
+            values[row[facet]] &= ~bit
+            if not values[row[facet]]:
+                del values[row[facet]]
+        self.rows[slot] = None
+        self.free_count += 1
+
+    def apply_changes(self, changes):
+        """Apply {plan_id: row or None} from a committed transaction and tell other workers"""
+        with self._lock:
+            version_before = self._stamp_version()
+            self._touch_stamp()
+            if self._version is None:
+                return  # Not loaded yet; the next search loads everything anyway
+            for plan_id, row in changes.items():
+                self._remove(plan_id)
+                if row is not None:
+                    self._add(row)
+            if self.free_count > len(self.rows) // 2:
+                self._load([row for row in self.rows if row is not None])  # Mostly deleted plans: compact
+            # Only skip the reload if nobody else changed plans since we last loaded
+            if version_before == self._version:
+                self._version = self._stamp_version()
+
+    def _mask(self, filters, skip=None):
+        mask = self.all_mask
+        for facet, value in filters.items():
+            if facet != skip and value:
+                mask &= self.bitmaps[facet].get(value, 0)
+        return mask
+
+    def search(self, filters, cursor=None, limit=None):
+        """
+        Return (rows newest first, facet counts) for `filters`, a dict of
+        facet -> selected value (falsy values are ignored). The counts for each
+        facet apply all the *other* filters, i.e. how many plans each option
+        would return if chosen. Rows start after `cursor`, a decoded
+        (created_at, id) keyset cursor, and stop after `limit` rows if given.
+        """
+        self.ensure_fresh()
+        with self._lock:
+            mask = self._mask(filters)
+            if cursor is not None:
+                mask &= (1 << bisect.bisect_left(self.keys, sort_key(*cursor))) - 1
+            rows = []
+            while mask and (limit is None or len(rows) < limit):
+                slot = mask.bit_length() - 1
+                rows.append(self.rows[slot])
+                mask ^= 1 << slot
+
+            facets = {}
+            for facet, options in FACETS.items():
+                base = self._mask(filters, skip=facet)
+                values = self.bitmaps[facet]
+                counts = {option: (base & values.get(option, 0)).bit_count() for option in options}
+                for value, bitmap in values.items():
+                    if value not in counts:
+                        counts[value] = (base & bitmap).bit_count()
+                facets[facet] = counts
+
+        return rows, facets
+
+
+def get_floorplan_index():
+    return current_app.extensions['floorplan_index']
+
+
+@event.listens_for(FloorPlan, 'after_insert')
+@event.listens_for(FloorPlan, 'after_update')
+def _plan_saved(mapper, connection, target):
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault(CHANGES_KEY, {})[target.id] = _plan_row(target)
+
+
+@event.listens_for(FloorPlan, 'after_delete')
+def _plan_deleted(mapper, connection, target):
+    session = inspect(target).session
+    if session is not None:
+        session.info.setdefault(CHANGES_KEY, {})[target.id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_plan_changes(session):
+    changes = session.info.pop(CHANGES_KEY, None)
+    if changes:
+        index = current_app.extensions.get('floorplan_index')
+        if index is not None:
+            index.apply_changes(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_plan_changes(session):
+    session.info.pop(CHANGES_KEY, None)
@@ -1,19 +1,52 @@
-from flask import Blueprint, render_template, request, jsonify, current_app
+from flask import Blueprint, render_template, request, jsonify, current_app, url_for
 from werkzeug.utils import secure_filename
 import os
 from datetime import datetime
 from models import db, FloorPlan
 from constants import FACING_OPTIONS, PLAN_TYPES, FLOOR_COUNT_OPTIONS, SITE_DIMENSIONS
 import logging
-from helpers import send_to_s3, delete_from_s3
+from helpers import send_to_s3, delete_from_s3, large_upload
+from image_derivatives import prepare_derivatives, reused_derivatives, render_later, delete_derivatives, parse_derivatives
+from content_store import content_key
+from floorplan_index import get_floorplan_index
+from response_cache import cached
+from pagination import PaginationError, decode_cursor, page_size, parse_fields, paginate_query, paginate_rows
 
 bp = Blueprint('floorplan', __name__)
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 
+# Columns clients may ask for with ?fields=; the public feeds default to the first seven
+PLAN_FIELDS = ('id', 'site_dimension', 'facing', 'type', 'floors',
+               'floor_plan_path', 'elevation_path', 'created_at', 'updated_at')
+FEED_FIELDS = PLAN_FIELDS[:7]
+# Only returned when asked for, e.g. ?fields=elevation_path,elevation_derivatives
+DERIVATIVE_FIELDS = ('floor_plan_derivatives', 'elevation_derivatives')
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def _page_args(default_fields):
+    """Parse fields/cursor/limit from the query string; raises PaginationError"""
+    fields = parse_fields(request.args, PLAN_FIELDS + DERIVATIVE_FIELDS, default_fields)
+    return fields, decode_cursor(request.args.get('cursor')), page_size(request.args)
+
+def _plan_columns(fields):
+    # created_at and id are always selected because the cursor is built from them
+    return [getattr(FloorPlan, f) for f in dict.fromkeys(list(fields) + ['created_at', 'id'])]
+
+def _feed_item(plan, fields):
+    """Project a plan (any mapping) onto `fields`, turning stored keys into full S3 URLs"""
+    item = {}
+    for field in fields:
+        value = plan[field]
+        if field in ('floor_plan_path', 'elevation_path') and value and not value.startswith('http'):
+            value = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{value}"
+        elif field in DERIVATIVE_FIELDS:
+            value = parse_derivatives(value)
+        item[field] = value
+    return item
+
 @bp.route('/manage-floorplans')
 def manage_floorplans():
     plans = FloorPlan.query.order_by(FloorPlan.created_at.desc()).all()
@@ -26,10 +59,27 @@ def manage_floorplans():
 
 @bp.route('/api/plans', methods=['GET'])
 def get_plans():
-    plans = FloorPlan.query.order_by(FloorPlan.created_at.desc()).all()
-    return jsonify([plan.to_dict() for plan in plans])
+    try:
+        fields, cursor, limit = _page_args(PLAN_FIELDS)
+    except PaginationError as e:
+        return jsonify({'error': str(e)}), 400
+
+    plans, next_cursor = paginate_query(
+        db.session.query(*_plan_columns(fields)), FloorPlan.created_at, FloorPlan.id, cursor, limit
+    )
+    response = jsonify([{
+        field: parse_derivatives(getattr(plan, field)) if field in DERIVATIVE_FIELDS else getattr(plan, field)
+        for field in fields
+    } for plan in plans])
+    if next_cursor:
+        # Keep the plain list body; the next page is advertised in the headers
+        next_url = url_for('floorplan.get_plans', **dict(request.args.to_dict(), cursor=next_cursor))
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 @bp.route('/api/plans', methods=['POST'])
+@large_upload
 def create_plan():
     try:
         if 'floor_plan' not in request.files or 'elevation' not in request.files:
@@ -53,8 +103,15 @@ def create_plan():
         if not (elevation_ext in {'png', 'jpg', 'jpeg'}):
             return jsonify({'error': 'Invalid elevation file type. Must be PNG, JPG, or JPEG'}), 400
 
+        # Key the objects by their content, so re-uploads of the same drawing share it
+        floor_plan_filename = content_key(floor_plan, secure_filename(floor_plan.filename))
+        elevation_filename = content_key(elevation, secure_filename(elevation.filename))
+
+        # Read the drawings for their smaller WebP/AVIF copies while the uploads are still open
+        # (PDF floor plans are skipped)
+        prepared = prepare_derivatives([(floor_plan, floor_plan_filename), (elevation, elevation_filename)])
+
         # Upload floor plan to S3
-        floor_plan_filename = secure_filename(f"{datetime.now().timestamp()}_fp_{floor_plan.filename}")
         result = send_to_s3(floor_plan, current_app.config['S3_BUCKET'], floor_plan_filename)
         
         if result != 'success':
@@ -65,7 +122,6 @@ def create_plan():
         floor_plan_url = f"{s3_location}/{floor_plan_filename}"
 
         # Upload elevation to S3
-        elevation_filename = secure_filename(f"{datetime.now().timestamp()}_el_{elevation.filename}")
         result = send_to_s3(elevation, current_app.config['S3_BUCKET'], elevation_filename)
         
         if result != 'success':
@@ -76,6 +132,8 @@ def create_plan():
         # Create S3 URL for elevation
         elevation_url = f"{s3_location}/{elevation_filename}"
 
+        floor_plan_derivatives, elevation_derivatives = reused_derivatives(prepared)
+
         # Create new floor plan record
         new_plan = FloorPlan(
             site_dimension=request.form.get('site_dimension'),
@@ -83,11 +141,14 @@ def create_plan():
             type=request.form.get('type'),
             floors=request.form.get('floors'),
             floor_plan_path=floor_plan_url,
-            elevation_path=elevation_url
+            elevation_path=elevation_url,
+            floor_plan_derivatives=floor_plan_derivatives,
+            elevation_derivatives=elevation_derivatives
         )
 
         db.session.add(new_plan)
         db.session.commit()
+        render_later(prepared, [(new_plan, 'floor_plan_derivatives'), (new_plan, 'elevation_derivatives')])
 
         return jsonify(new_plan.to_dict()), 201
 
@@ -105,21 +166,20 @@ def get_plan(id):
 def delete_plan(id):
     try:
         plan = FloorPlan.query.get_or_404(id)
-
-        # Delete files from S3
-        if plan.floor_plan_path:
-            result = delete_from_s3(plan.floor_plan_path)
-            if result != 'success':
-                logging.error(f"Error deleting floor plan from S3: {result}")
-
-        if plan.elevation_path:
-            result = delete_from_s3(plan.elevation_path)
-            if result != 'success':
-                logging.error(f"Error deleting elevation from S3: {result}")
+        files = [(plan.floor_plan_path, plan.floor_plan_derivatives, 'floor plan'),
+                 (plan.elevation_path, plan.elevation_derivatives, 'elevation')]
 
         db.session.delete(plan)
         db.session.commit()
 
+        # Delete files from S3, except any still shared with other rows
+        for file_path, derivatives, label in files:
+            if file_path:
+                result = delete_from_s3(file_path)
+                if result != 'success':
+                    logging.error(f"Error deleting {label} from S3: {result}")
+                delete_derivatives(derivatives, file_path)
+
         return jsonify({'message': 'Floor plan deleted successfully'}), 200
 
     except Exception as e:
@@ -156,28 +216,20 @@ def check_floor_plan_and_elevation():
     use_type = request.args.get('use_type')
     view = request.args.get('view')
 
-    # Base query
-    query = FloorPlan.query
-
-    # Apply filters if they exist
-    if site_dimension:
-        query = query.filter(FloorPlan.site_dimension == site_dimension)
-    if facing:
-        query = query.filter(FloorPlan.facing == facing)
-    if floors:
-        query = query.filter(FloorPlan.floors == floors)
-    if use_type:
-        query = query.filter(FloorPlan.type == use_type)
-
-    # Get results ordered by creation date
-    floor_plans_and_elevations = query.order_by(FloorPlan.created_at.desc()).all()
+    # Filter through the in-memory facet index, newest first
+    floor_plans_and_elevations, facet_counts = get_floorplan_index().search({
+        'site_dimension': site_dimension,
+        'facing': facing,
+        'floors': floors,
+        'type': use_type
+    })
 
     # Convert to list of tuples for template
     plans_data = []
     for plan in floor_plans_and_elevations:
         # Ensure paths are properly formatted for display
-        floor_plan_path = plan.floor_plan_path
-        elevation_path = plan.elevation_path
+        floor_plan_path = plan['floor_plan_path']
+        elevation_path = plan['elevation_path']
         
         # If paths don't start with http/https, construct the full S3 URL
         if floor_plan_path and not (floor_plan_path.startswith('http://') or floor_plan_path.startswith('https://')):
@@ -186,13 +238,14 @@ def check_floor_plan_and_elevation():
             elevation_path = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{elevation_path.lstrip('/')}"
 
         plans_data.append((
-            plan.id,
-            plan.site_dimension,
-            plan.facing,
-            plan.type,
-            plan.floors,
+            plan['id'],
+            plan['site_dimension'],
+            plan['facing'],
+            plan['type'],
+            plan['floors'],
             floor_plan_path,
-            elevation_path
+            elevation_path,
+            parse_derivatives(plan['elevation_derivatives'], proxy=True)
         ))
 
     # Pass constants to template for dropdowns
@@ -204,41 +257,29 @@ def check_floor_plan_and_elevation():
         facing_options=FACING_OPTIONS,
         plan_types=PLAN_TYPES,
         floor_count_options=FLOOR_COUNT_OPTIONS,
-        site_dimensions=SITE_DIMENSIONS
+        site_dimensions=SITE_DIMENSIONS,
+        facet_counts=facet_counts
     )
 
 @bp.route('/api/floor-plans/featured')
+@cached(tags=['floor_plans'])
 def get_featured_plans():
     """Get featured floor plans"""
     try:
-        # Get all plans ordered by creation date
-        plans = FloorPlan.query.order_by(FloorPlan.created_at.desc()).all()
-        
-        plans_data = []
-        for plan in plans:
-            # Ensure paths are properly formatted
-            floor_plan_path = plan.floor_plan_path
-            elevation_path = plan.elevation_path
-            
-            # If paths are S3 URLs, use them directly
-            if not floor_plan_path.startswith('http'):
-                floor_plan_path = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{floor_plan_path}"
-            if not elevation_path.startswith('http'):
-                elevation_path = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{elevation_path}"
-
-            plans_data.append({
-                'id': plan.id,
-                'site_dimension': plan.site_dimension,
-                'facing': plan.facing,
-                'type': plan.type,
-                'floors': plan.floors,
-                'floor_plan_path': floor_plan_path,
-                'elevation_path': elevation_path
-            })
+        fields, cursor, limit = _page_args(FEED_FIELDS)
+    except PaginationError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    try:
+        # One page of plans, newest first
+        plans, next_cursor = paginate_query(
+            db.session.query(*_plan_columns(fields)), FloorPlan.created_at, FloorPlan.id, cursor, limit
+        )
 
         return jsonify({
             'success': True,
-            'data': plans_data
+            'data': [_feed_item(plan._mapping, fields) for plan in plans],
+            'next_cursor': next_cursor
         })
 
     except Exception as e:
@@ -251,6 +292,11 @@ def get_featured_plans():
 @bp.route('/api/floor-plans/search')
 def search_floor_plans():
     """API endpoint for searching floor plans"""
+    try:
+        fields, cursor, limit = _page_args(FEED_FIELDS)
+    except PaginationError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
     try:
         # Get query parameters
         site_dimension = request.args.get('site_dimension')
@@ -258,48 +304,20 @@ def search_floor_plans():
         floors = request.args.get('floors')
         use_type = request.args.get('use_type')
 
-        # Base query
-        query = FloorPlan.query
-
-        # Apply filters
-        if site_dimension:
-            query = query.filter(FloorPlan.site_dimension == site_dimension)
-        if facing:
-            query = query.filter(FloorPlan.facing == facing)
-        if floors:
-            query = query.filter(FloorPlan.floors == floors)
-        if use_type:
-            query = query.filter(FloorPlan.type == use_type)
-
-        # Get results
-        results = query.order_by(FloorPlan.created_at.desc()).all()
-        
-        # Convert to list of dicts
-        plans_data = []
-        for plan in results:
-            # Ensure paths are properly formatted
-            floor_plan_path = plan.floor_plan_path
-            elevation_path = plan.elevation_path
-            
-            # If paths are S3 URLs, use them directly
-            if not floor_plan_path.startswith('http'):
-                floor_plan_path = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{floor_plan_path}"
-            if not elevation_path.startswith('http'):
-                elevation_path = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{elevation_path}"
-
-            plans_data.append({
-                'id': plan.id,
-                'site_dimension': plan.site_dimension,
-                'facing': plan.facing,
-                'type': plan.type,
-                'floors': plan.floors,
-                'floor_plan_path': floor_plan_path,
-                'elevation_path': elevation_path
-            })
+        # Filter through the in-memory facet index: one page (and one more row, to know if there's another)
+        results, facet_counts = get_floorplan_index().search({
+            'site_dimension': site_dimension,
+            'facing': facing,
+            'floors': floors,
+            'type': use_type
+        }, cursor=cursor, limit=limit + 1)
+        plans, next_cursor = paginate_rows(results, None, limit)
 
         return jsonify({
             'success': True,
-            'data': plans_data
+            'data': [_feed_item(plan, fields) for plan in plans],
+            'next_cursor': next_cursor,
+            'facets': facet_counts
         })
 
     except Exception as e:
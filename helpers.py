@@ -1,41 +1,122 @@
-from flask import current_app
-from urllib.parse import urlparse
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from flask import current_app, request
+from content_store import existing_keys, keep_for_commit, releasing, unreferenced, object_key
 
-def send_to_s3(file, bucket_name, filename, acl="public-read", content_type=''):
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def large_upload(view):
+    """Let `view` accept request bodies up to UPLOAD_MAX_CONTENT_LENGTH (e.g. kiosk videos) instead of MAX_CONTENT_LENGTH"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        request.max_content_length = current_app.config['UPLOAD_MAX_CONTENT_LENGTH']
+        return view(*args, **kwargs)
+    return wrapper
+
+def get_transfer_config():
+    """Multipart settings used for every S3 upload; small files still go up in one PUT"""
+    return TransferConfig(
+        multipart_threshold=current_app.config['S3_MULTIPART_THRESHOLD'],
+        multipart_chunksize=current_app.config['S3_MULTIPART_CHUNKSIZE'],
+        max_concurrency=current_app.config['S3_MULTIPART_CONCURRENCY'],
+        use_threads=True
+    )
+
+def get_upload_executor():
+    """Process-wide pool shared by all batch uploads, so concurrent requests stay bounded"""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=current_app.config['S3_UPLOAD_WORKERS'],
+                    thread_name_prefix='s3-upload'
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+def _upload_fileobj(s3, file, bucket_name, filename, acl, content_type, transfer_config):
     try:
-        if content_type == '':
-            content_type = file.content_type
-        res = current_app.s3.upload_fileobj(
+        s3.upload_fileobj(
             file,
             bucket_name,
             filename,
             ExtraArgs={
                 "ACL": acl,
                 "ContentType": content_type  # Set appropriate content type as per the file
-            }
+            },
+            Config=transfer_config
         )
-        print(res)
     except Exception as e:
         print("Something Happened: ", e)
         return str(e)
     return 'success'
 
+def send_to_s3(file, bucket_name, filename, acl="public-read", content_type=''):
+    if content_type == '':
+        content_type = file.content_type
+    keep_for_commit(filename, file, content_type)
+    if existing_keys([filename]):
+        return 'success'  # Same content is already stored under this key
+    return _upload_fileobj(current_app.s3, file, bucket_name, filename, acl, content_type, get_transfer_config())
+
+def send_batch_to_s3(uploads, bucket_name, acl="public-read"):
+    """
+    Upload several files concurrently.
+
+    `uploads` is a list of (file, filename) or (file, filename, content_type)
+    tuples. Returns a list of results in the same order, each 'success' or the
+    error message, matching what send_to_s3 returns for a single file.
+    Content-addressed keys that are already stored are not uploaded again.
+    """
+    # Worker threads have no app context, so resolve everything they need here
+    s3 = current_app.s3
+    transfer_config = get_transfer_config()
+    executor = get_upload_executor()
+    existing = existing_keys([upload[1] for upload in uploads])
+
+    futures = []
+    for upload in uploads:
+        file, filename = upload[0], upload[1]
+        content_type = upload[2] if len(upload) > 2 and upload[2] else file.content_type
+        keep_for_commit(filename, file, content_type)
+        if filename in existing:
+            futures.append(None)
+            continue
+        futures.append(executor.submit(
+            _upload_fileobj, s3, file, bucket_name, filename, acl, content_type, transfer_config
+        ))
+    return ['success' if future is None else future.result() for future in futures]
+
 def delete_from_s3(file_path):
+    """Delete an object from S3, unless a row still references it (objects can be shared, see content_store.py)"""
     try:
-        # Parse the URL to get the object key
-        parsed_url = urlparse(file_path)
-        object_key = parsed_url.path.lstrip('/')
-        
-        # Delete the object from S3
-        current_app.s3.delete_object(
-            Bucket=current_app.config['S3_BUCKET'],
-            Key=object_key
-        )
+        with releasing(file_path) as unreferenced_now:
+            if not unreferenced_now:
+                print(f"Keeping {file_path} on S3: still referenced")
+                return 'success'
+            current_app.s3.delete_object(
+                Bucket=current_app.config['S3_BUCKET'],
+                Key=object_key(file_path)
+            )
         return 'success'
     except Exception as e:
         print("Error deleting from S3:", e)
         return str(e)
 
+def purge_unreferenced():
+    """Retry the deletes of unreferenced objects that failed (or never ran); returns how many are still pending"""
+    failed = 0
+    for file_path in unreferenced():
+        if delete_from_s3(file_path) != 'success':
+            failed += 1
+    return failed
+
 def allowed_file(filename):
     allowed = '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
     if not allowed:
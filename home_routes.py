@@ -1,17 +1,22 @@
 from flask import Blueprint,render_template, jsonify, request, current_app,flash, redirect, url_for
 from werkzeug.utils import secure_filename
-import time
+from sqlalchemy.orm import selectinload
 from models import db, Home, HomeMedia
-from helpers import allowed_file, send_to_s3, delete_from_s3
+from helpers import allowed_file, send_batch_to_s3, delete_from_s3, large_upload
+from response_cache import cached
+from query_budget import query_budget
+from image_derivatives import prepare_derivatives, reused_derivatives, render_later, delete_derivatives, parse_derivatives
+from content_store import content_key
 
 bp = Blueprint('home', __name__)
 
 @bp.route('/view-homes')
+@query_budget(2)
 def view_homes():
     """Route to display all homes in a grid layout."""
     try:
         # Get all homes with their media items
-        homes = Home.query.order_by(Home.created_at.desc()).all()
+        homes = Home.query.options(selectinload(Home.media_items)).order_by(Home.created_at.desc()).all()
         return render_template('view_homes.html', homes=homes)
     except Exception as e:
         current_app.logger.error(f"Error in view_homes: {str(e)}")
@@ -19,11 +24,13 @@ def view_homes():
         return redirect(url_for('kiosk.check_floor_plan_and_elevation')) 
 
 @bp.route('/manage-homes')
+@query_budget(1)
 def manage_homes():
     homes = Home.query.order_by(Home.created_at.desc()).all()
     return render_template('manage_homes.html', homes=homes) 
 
 @bp.route('/api/homes', methods=['POST'])
+@large_upload
 def create_home():
     if not all(x in request.files for x in ['photos', 'floor_plan', 'isometric']):
         return jsonify({'error': 'Missing required files'}), 400
@@ -41,95 +48,62 @@ def create_home():
         db.session.flush()  # Get the home ID
 
         bucket_name = current_app.config['S3_BUCKET']
-        uploaded_media = []
+        s3_location = current_app.config['S3_LOCATION'].rstrip('/')
+        pending = []
 
         # Handle photos (multiple)
         photos = request.files.getlist('photos')
         for photo in photos:
             if photo and allowed_file(photo.filename):
                 filename = secure_filename(photo.filename)
-                unique_filename = f"homes/{home.id}/photos/{int(time.time())}_{filename}"
-                
-                result = send_to_s3(photo, bucket_name, unique_filename)
-                if result != 'success':
-                    raise Exception(f"Failed to upload photo to S3: {result}")
-
-                s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-                file_path = f"{s3_location}/{unique_filename}"
-
-                media = HomeMedia(
-                    home_id=home.id,
-                    media_type='photo',
-                    file_path=file_path
-                )
-                db.session.add(media)
-                uploaded_media.append(file_path)
+                pending.append((photo, content_key(photo, filename), 'photo'))
 
         # Handle floor plan (single)
         floor_plan = request.files['floor_plan']
         if floor_plan and allowed_file(floor_plan.filename):
             filename = secure_filename(floor_plan.filename)
-            unique_filename = f"homes/{home.id}/floor_plan/{filename}"
-            
-            result = send_to_s3(floor_plan, bucket_name, unique_filename)
-            if result != 'success':
-                raise Exception(f"Failed to upload floor plan to S3: {result}")
-
-            s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-            file_path = f"{s3_location}/{unique_filename}"
-
-            media = HomeMedia(
-                home_id=home.id,
-                media_type='floor_plan',
-                file_path=file_path
-            )
-            db.session.add(media)
-            uploaded_media.append(file_path)
+            pending.append((floor_plan, content_key(floor_plan, filename), 'floor_plan'))
 
         # Handle isometric view (single)
         isometric = request.files['isometric']
         if isometric and allowed_file(isometric.filename):
             filename = secure_filename(isometric.filename)
-            unique_filename = f"homes/{home.id}/isometric/{filename}"
-            
-            result = send_to_s3(isometric, bucket_name, unique_filename)
-            if result != 'success':
-                raise Exception(f"Failed to upload isometric view to S3: {result}")
+            pending.append((isometric, content_key(isometric, filename), 'isometric'))
 
-            s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-            file_path = f"{s3_location}/{unique_filename}"
+        # Handle video (optional)
+        if 'video' in request.files:
+            video = request.files['video']
+            if video and allowed_file(video.filename):
+                filename = secure_filename(video.filename)
+                pending.append((video, content_key(video, filename), 'video'))
+
+        # Read the photos and drawings for their smaller WebP/AVIF copies before boto3 closes the files
+        # (videos are skipped)
+        prepared = prepare_derivatives([(file, unique_filename) for file, unique_filename, _ in pending])
+
+        # Upload everything in parallel
+        results = send_batch_to_s3([(file, unique_filename) for file, unique_filename, _ in pending], bucket_name)
+
+        failed = [f"{media_type} ({result})" for (_, _, media_type), result in zip(pending, results) if result != 'success']
+        if failed:
+            raise Exception(f"Failed to upload to S3: {', '.join(failed)}")
 
+        uploaded_media = []
+        targets = []
+        for (_, unique_filename, media_type), media_derivatives in zip(pending, reused_derivatives(prepared)):
+            file_path = f"{s3_location}/{unique_filename}"
             media = HomeMedia(
                 home_id=home.id,
-                media_type='isometric',
-                file_path=file_path
+                media_type=media_type,
+                file_path=file_path,
+                derivatives=media_derivatives
             )
             db.session.add(media)
             uploaded_media.append(file_path)
-
-        # Handle video (optional)
-        if 'video' in request.files:
-            video = request.files['video']
-            if video and allowed_file(video.filename):
-                filename = secure_filename(video.filename)
-                unique_filename = f"homes/{home.id}/video/{filename}"
-                
-                result = send_to_s3(video, bucket_name, unique_filename)
-                if result != 'success':
-                    raise Exception(f"Failed to upload video to S3: {result}")
-
-                s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-                file_path = f"{s3_location}/{unique_filename}"
-
-                media = HomeMedia(
-                    home_id=home.id,
-                    media_type='video',
-                    file_path=file_path
-                )
-                db.session.add(media)
-                uploaded_media.append(file_path)
+            targets.append((media, 'derivatives'))
 
         db.session.commit()
+        render_later(prepared, targets)
         return jsonify({
             'message': 'Home created successfully',
             'home_id': home.id,
@@ -142,6 +116,7 @@ def create_home():
         return jsonify({'error': str(e)}), 500 
 
 @bp.route('/api/homes/<int:id>', methods=['GET'])
+@cached(tags=lambda id: [f'homes:{id}'])
 def get_home(id):
     home = Home.query.get_or_404(id)
     return jsonify({
@@ -152,28 +127,31 @@ def get_home(id):
         'media_items': [{
             'id': media.id,
             'media_type': media.media_type,
-            'file_path': media.file_path
+            'file_path': media.file_path,
+            'derivatives': parse_derivatives(media.derivatives)
         } for media in home.media_items]
     })
 
 @bp.route('/api/homes/<int:id>', methods=['DELETE'])
 def delete_home(id):
     home = Home.query.get_or_404(id)
+    files = [(media.file_path, media.derivatives) for media in home.media_items]
     
     try:
-        # Delete all media files from S3
-        for media in home.media_items:
-            delete_from_s3(media.file_path)
-        
         # Delete home and all associated media (cascade will handle this)
         db.session.delete(home)
         db.session.commit()
-        
-        return jsonify({'message': 'Home deleted successfully'})
     except Exception as e:
         db.session.rollback()
         print(f"Error deleting home: {str(e)}")
         return jsonify({'error': str(e)}), 500 
+    
+    # Delete the media files from S3, except any still shared with other rows
+    for file_path, derivatives in files:
+        delete_from_s3(file_path)
+        delete_derivatives(derivatives, file_path)
+    
+    return jsonify({'message': 'Home deleted successfully'})
 
 @bp.route('/api/homes/<int:id>/details', methods=['PUT'])
 def update_home_details(id):
@@ -0,0 +1,332 @@
+"""
+Responsive image derivatives.
+
+When a photo or elevation is uploaded we also store a few smaller widths in
+AVIF and WebP (whichever the installed Pillow can encode) plus a tiny
+placeholder, and keep the result as JSON next to the original on its row:
+
+    {"width": 4000, "height": 3000,
+     "placeholder": "data:image/jpeg;base64,...",
+     "sources": {"image/avif": [[320, url], [640, url], ...],
+                 "image/webp": [[320, url], [640, url], ...]}}
+
+Templates render it with the responsive_image macro as a <picture> with
+srcset, so a grid card downloads a ~30KB derivative instead of a multi-MB
+original. Without Pillow nothing is generated and the templates fall back to
+the original file.
+
+Rendering takes the best part of a second per large photo, so uploads don't
+wait for it: the request stores the original and commits its row, and the
+derivatives are rendered on the upload executor and saved on the row when
+they're done. Until then the templates show the original.
+
+    python image_derivatives.py backfill   # rows uploaded before derivatives existed
+"""
+import base64
+import io
+import json
+import os
+from urllib.parse import urlparse
+from flask import current_app
+from sqlalchemy import inspect
+from helpers import send_to_s3, send_batch_to_s3, delete_from_s3, get_upload_executor
+from models import db, Media, ButtonMedia, HomeMedia, FloorPlan
+from content_store import KEY_PREFIX, existing_keys, is_referenced, object_key
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Derivatives are optional; originals are served as before
+    Image = None
+
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp'}
+
+# (mime type, Pillow format, file extension, encoder options), best compression first
+FORMATS = [
+    ('image/avif', 'AVIF', 'avif', {'quality': 50, 'speed': 8}),
+    ('image/webp', 'WEBP', 'webp', {'quality': 75, 'method': 4}),
+]
+
+PLACEHOLDER_WIDTH = 24
+BACKFILL_BATCH = 25  # Rows per commit when backfilling
+
+# (model, original path column, derivatives column)
+DERIVATIVE_COLUMNS = [
+    (Media, 'file_path', 'derivatives'),
+    (ButtonMedia, 'file_path', 'derivatives'),
+    (HomeMedia, 'file_path', 'derivatives'),
+    (FloorPlan, 'floor_plan_path', 'floor_plan_derivatives'),
+    (FloorPlan, 'elevation_path', 'elevation_derivatives'),
+]
+
+
+def available_formats():
+    if Image is None:
+        return []
+    return [fmt for fmt in FORMATS if features.check(fmt[1].lower())]
+
+
+def is_derivable(filename):
+    """Whether `filename` (a name, key or URL) is an image we make derivatives for"""
+    extension = urlparse(filename).path.rsplit('.', 1)[-1].lower()
+    return Image is not None and extension in IMAGE_EXTENSIONS
+
+
+def _derivative_key(s3_key, width, extension):
+    return f"derivatives/{os.path.splitext(s3_key)[0]}_{width}w.{extension}"
+
+
+def _render(data, s3_key):
+    """Return (info, uploads) for one image; uploads are (BytesIO, key, content_type, mime, width)"""
+    image = Image.open(io.BytesIO(data))
+    if image.format == 'JPEG':
+        # Let the decoder skip detail we are about to throw away anyway
+        largest = max(current_app.config['IMAGE_DERIVATIVE_WIDTHS'])
+        image.draft('RGB', (largest, round(image.height * largest / image.width)))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    width, height = image.size
+
+    widths = [w for w in current_app.config['IMAGE_DERIVATIVE_WIDTHS'] if w < width] or [width]
+    uploads = []
+    for target in widths:
+        resized = image if target == width else image.resize(
+            (target, max(1, round(height * target / width))), Image.LANCZOS
+        )
+        for mime, pil_format, extension, options in available_formats():
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, **options)
+            buffer.seek(0)
+            uploads.append((buffer, _derivative_key(s3_key, target, extension), mime, mime, target))
+
+    # A few hundred bytes inline in the page, shown blurred until the real image loads
+    tiny = image.resize((PLACEHOLDER_WIDTH, max(1, round(height * PLACEHOLDER_WIDTH / width))), Image.BILINEAR)
+    buffer = io.BytesIO()
+    tiny.convert('RGB').save(buffer, 'JPEG', quality=40)
+    placeholder = f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+    return {'width': width, 'height': height, 'placeholder': placeholder}, uploads
+
+
+def _read(source):
+    if isinstance(source, bytes):
+        return source
+    stream = getattr(source, 'stream', source)
+    stream.seek(0)
+    data = stream.read()
+    stream.seek(0)
+    return data
+
+
+def _existing_derivatives(file_path):
+    """Derivatives another row already has for the same stored object, if any"""
+    for model, path_attr, derivatives_attr in DERIVATIVE_COLUMNS:
+        column = getattr(model, derivatives_attr)
+        value = db.session.query(column).filter(
+            getattr(model, path_attr) == file_path, column.isnot(None)
+        ).limit(1).scalar()
+        if value:
+            return value
+    return None
+
+
+def prepare_derivatives(items):
+    """
+    Get `items`, a list of (file or bytes, s3_key), ready for render_later.
+
+    Call this before uploading the originals: boto3 closes file objects once
+    it has sent them, so the bytes of each image are read here. Returns a list
+    in the same order: the stored JSON where the same content already has
+    derivatives, (bytes, s3_key) where they still need rendering, and None
+    for anything that isn't an image.
+    """
+    prepared = [None] * len(items)
+    if not available_formats():
+        return prepared
+    s3_location = current_app.config['S3_LOCATION'].rstrip('/')
+    stored = existing_keys([s3_key for _, s3_key in items])
+    for index, (source, s3_key) in enumerate(items):
+        if not is_derivable(s3_key):
+            continue
+        if s3_key in stored:
+            prepared[index] = _existing_derivatives(f"{s3_location}/{s3_key}")
+            if prepared[index] is not None:
+                continue
+        prepared[index] = (_read(source), s3_key)
+    return prepared
+
+
+def reused_derivatives(prepared):
+    """The JSON to store on each new row straight away: derivatives reused from an earlier upload, else None"""
+    return [item if isinstance(item, str) else None for item in prepared]
+
+
+def render_later(prepared, targets):
+    """
+    Render and upload the derivatives prepare_derivatives left to do, on the
+    upload executor, and save them on their rows when done. `targets` has a
+    (row, derivatives column) per prepared item, or None to skip it (e.g. its
+    original failed to upload). Call once the rows are committed. Anything
+    not rendered, e.g. because the process exited first, is picked up by
+    `python image_derivatives.py backfill`.
+    """
+    pending = {}
+    for item, target in zip(prepared, targets):
+        if isinstance(item, tuple) and target is not None:
+            data, s3_key = item
+            row, column = target
+            # The identity survives the commit; reading row.id would reload the row
+            row_id, = inspect(row).identity
+            pending.setdefault(s3_key, (data, []))[1].append((type(row), row_id, column))
+    if not pending:
+        return
+    app = current_app._get_current_object()
+    executor = get_upload_executor()
+    for s3_key, (data, rows) in pending.items():
+        executor.submit(_render_and_save, app, data, s3_key, rows)
+
+
+def _render_and_save(app, data, s3_key, rows):
+    """Runs on the upload executor: render one image, upload its derivatives and set them on `rows`"""
+    with app.app_context():
+        try:
+            info, uploads = _render(data, s3_key)
+            bucket = current_app.config['S3_BUCKET']
+            # One at a time: this already runs on the executor send_batch_to_s3 would queue them on
+            results = [send_to_s3(buffer, bucket, key, content_type=content_type)
+                       for buffer, key, content_type, _, _ in uploads]
+            value = _derivatives_json(info, uploads, results)
+            if value is None:
+                return
+            for model, row_id, column in rows:
+                row = db.session.get(model, row_id)
+                if row is not None and getattr(row, column) is None:
+                    setattr(row, column, value)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.warning(f"Could not create derivatives for {s3_key}: {str(e)}")
+
+
+def _derivatives_json(info, uploads, results):
+    """The column value for one rendered image, given each derivative's upload result"""
+    s3_location = current_app.config['S3_LOCATION'].rstrip('/')
+    sources = {}
+    for (_, key, _, mime, width), result in zip(uploads, results):
+        if result == 'success':
+            sources.setdefault(mime, []).append([width, f"{s3_location}/{key}"])
+    return json.dumps(dict(info, sources=sources)) if sources else None
+
+
+def create_derivatives(items):
+    """
+    Render and upload derivatives for `items`, a list of (bytes, s3_key), in
+    this thread, and return the JSON to store on each row (None where there
+    is nothing). For scripts such as the backfill.
+    """
+    rendered = []
+    for data, s3_key in items:
+        try:
+            rendered.append(_render(data, s3_key) if is_derivable(s3_key) and available_formats() else None)
+        except Exception as e:
+            current_app.logger.warning(f"Could not create derivatives for {s3_key}: {str(e)}")
+            rendered.append(None)
+    all_uploads = [upload for item in rendered if item is not None for upload in item[1]]
+    outcomes = iter(send_batch_to_s3(
+        [(buffer, key, content_type) for buffer, key, content_type, _, _ in all_uploads],
+        current_app.config['S3_BUCKET']
+    ))
+    results = []
+    for item in rendered:
+        if item is None:
+            results.append(None)
+            continue
+        info, uploads = item
+        results.append(_derivatives_json(info, uploads, [next(outcomes) for _ in uploads]))
+    return results
+
+
+def parse_derivatives(value, proxy=False):
+    """
+    Decode a stored derivatives column for templates and APIs.
+    With `proxy`, URLs point at the local /media cache instead of S3.
+    """
+    if not value:
+        return None
+    try:
+        info = json.loads(value)
+    except ValueError:
+        return None
+    if proxy:
+        info['sources'] = {
+            mime: [[width, f"/media/{object_key(url)}"] for width, url in entries]
+            for mime, entries in info['sources'].items()
+        }
+    return info
+
+
+def delete_derivatives(value, file_path):
+    """Remove a row's derivatives from S3 along with its original at `file_path`, once nothing references it"""
+    if is_referenced(file_path):
+        return
+    s3_key = object_key(file_path)
+    if s3_key.startswith(KEY_PREFIX):
+        # Shared objects: the last row to go may not be the one whose column lists the derivatives,
+        # but their keys follow from the digest
+        bucket = current_app.config['S3_BUCKET']
+        prefix = f"derivatives/{os.path.splitext(s3_key)[0]}_"
+        listing = current_app.s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        keys = [{'Key': obj['Key']} for obj in listing.get('Contents', [])]
+        if keys:
+            current_app.s3.delete_objects(Bucket=bucket, Delete={'Objects': keys})
+        return
+    info = parse_derivatives(value)
+    if info is None:
+        return
+    for entries in info['sources'].values():
+        for _, url in entries:
+            result = delete_from_s3(url)
+            if result != 'success':
+                current_app.logger.error(f"Error deleting derivative {url} from S3: {result}")
+
+
+def init_app(app):
+    app.add_template_filter(parse_derivatives, 'image_derivatives')
+
+
+def _download(file_path):
+    response = current_app.s3.get_object(
+        Bucket=current_app.config['S3_BUCKET'],
+        Key=object_key(file_path)
+    )
+    return response['Body'].read()
+
+
+def backfill():
+    """Generate derivatives for every image row that doesn't have them yet"""
+    for model, path_attr, derivatives_attr in DERIVATIVE_COLUMNS:
+        rows = model.query.filter(getattr(model, derivatives_attr).is_(None)).all()
+        rows = [row for row in rows if is_derivable(getattr(row, path_attr))]
+        for count, row in enumerate(rows, 1):
+            file_path = getattr(row, path_attr)
+            try:
+                data = _download(file_path)
+            except Exception as e:
+                print(f"Skipping {file_path}: {e}")
+                continue
+            derivatives, = create_derivatives([(data, object_key(file_path))])
+            setattr(row, derivatives_attr, derivatives)
+            if count % BACKFILL_BATCH == 0:
+                db.session.commit()
+        db.session.commit()
+        print(f"{model.__tablename__}.{derivatives_attr}: processed {len(rows)} images")
+
+
+if __name__ == '__main__':
+    import sys
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'backfill'
+    if command != 'backfill':
+        sys.exit(f"Unknown command: {command}")
+    with app.app_context():
+        backfill()
@@ -0,0 +1,21 @@
+from flask import Blueprint, jsonify
+from upload_jobs import get_upload_queue
+from transcode import get_transcode_queue
+
+bp = Blueprint('jobs', __name__)
+
+@bp.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report the status and progress of a background upload"""
+    job = get_upload_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@bp.route('/api/videos/<int:video_id>/transcode', methods=['GET'])
+def get_transcode_job(video_id):
+    """Report whether a video's HLS renditions are queued, running, done or failed"""
+    job = get_transcode_queue().get(video_id)
+    if job is None:
+        return jsonify({'error': 'No transcode job for this video'}), 404
+    return jsonify(job)
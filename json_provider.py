@@ -0,0 +1,54 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library encoder
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    jsonify() backed by orjson when it is installed.
+
+    Output matches Flask's default provider where clients can tell: keys are
+    sorted, datetimes are RFC 822 strings and anything orjson doesn't know is
+    passed to the same `default` hook. Non-ASCII text is written as UTF-8
+    rather than \\u escapes.
+    """
+
+    def _orjson_options(self, kwargs):
+        if orjson is None or set(kwargs) - {'indent', 'separators'}:
+            return None
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        options = self._orjson_options(kwargs)
+        if options is not None:
+            try:
+                return orjson.dumps(obj, default=self.default, option=options).decode()
+            except TypeError:
+                pass  # e.g. integers wider than 64 bits; let the standard encoder handle it
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        options = self._orjson_options({})
+        if options is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            options |= orjson.OPT_INDENT_2
+        try:
+            body = orjson.dumps(obj, default=self.default, option=options | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
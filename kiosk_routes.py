@@ -1,14 +1,23 @@
-from flask import Blueprint, render_template, request, jsonify, current_app
+from flask import Blueprint, render_template, request, jsonify, current_app, Response
+from sqlalchemy.orm import selectinload
 from models import db, Kiosk, Video, Button, ButtonMedia, Home
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import os
-import time
-from helpers import send_to_s3, delete_from_s3
+from helpers import send_batch_to_s3, delete_from_s3, large_upload
+from upload_jobs import get_upload_queue, register_handler
+from manifests import get_manifest_etag, get_manifest_body
+from response_cache import cached
+from query_budget import query_budget
+from image_derivatives import prepare_derivatives, reused_derivatives, render_later, delete_derivatives
+from transcode import get_transcode_queue, parse_hls, delete_renditions
+from content_store import content_key
+from bulk_edit import rename_titles, summarize
 
 bp = Blueprint('kiosks', __name__)
 
 @bp.route('/manage-kiosks')
+@query_budget(1)
 def manage_kiosks():
     """Render the kiosk management page"""
     kiosks = Kiosk.query.order_by(Kiosk.created_at.desc()).all()
@@ -43,6 +52,7 @@ def create_kiosk():
         return jsonify({'error': str(e)}), 500
 
 @bp.route('/api/videos', methods=['POST'])
+@large_upload
 def upload_video():
     """Upload a new video"""
     if 'video' not in request.files:
@@ -56,63 +66,75 @@ def upload_video():
         return jsonify({'error': 'Invalid video format. Please upload MP4, WebM, or OGG files.'}), 400
 
     try:
-        # Generate unique filename with timestamp
+        # Key the object by its content, so re-uploads of the same file share it
         filename = secure_filename(video_file.filename)
-        kiosk_id = request.form.get('kiosk_id')
-        unique_filename = f"videos/{kiosk_id}_{int(time.time())}_{filename}"
+        unique_filename = content_key(video_file, filename)
         
-        # Upload to S3
-        bucket_name = current_app.config['S3_BUCKET']
-        result = send_to_s3(video_file, bucket_name, unique_filename)
-        
-        if result != 'success':
-            return jsonify({'error': f'Failed to upload to S3: {result}'}), 500
+        # Spool the file and let a background worker push it to S3
+        job_id = get_upload_queue().enqueue('video', video_file, unique_filename, {
+            'kiosk_id': request.form.get('kiosk_id', type=int),
+            'title': request.form.get('title', ''),
+            'description': request.form.get('description', '')
+        })
         
-        # Create S3 URL
-        s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-        file_path = f"{s3_location}/{unique_filename}"
+        return jsonify({
+            'message': 'Video upload queued',
+            'job_id': job_id,
+            'status_url': f'/api/jobs/{job_id}'
+        }), 202
         
-        # Create video record
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@register_handler('video')
+def create_uploaded_video(job_id, payload, file_path):
+    """Create the Video row once a queued upload has reached S3; a retried job gets the row it already made"""
+    video = Video.query.filter_by(upload_job_id=job_id).first()
+    if video is None:
         video = Video(
-            kiosk_id=request.form.get('kiosk_id', type=int),
-            title=request.form.get('title', ''),
-            description=request.form.get('description', ''),
-            file_path=file_path
+            kiosk_id=payload['kiosk_id'],
+            title=payload['title'],
+            description=payload['description'],
+            file_path=file_path,
+            upload_job_id=job_id
         )
-        
         db.session.add(video)
         db.session.commit()
-        
-        return jsonify({
-            'message': 'Video uploaded successfully',
-            'video': {
-                'id': video.id,
-                'title': video.title,
-                'file_path': video.file_path
-            }
-        }), 201
-        
+    
+    # Cut the HLS ladder in the background; kiosks play the original until it's ready
+    try:
+        get_transcode_queue().enqueue(video.id)
     except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+        current_app.logger.error(f"Error queueing video {video.id} for transcoding (transcode.py backfill will): {str(e)}")
+    
+    return {
+        'id': video.id,
+        'title': video.title,
+        'file_path': video.file_path
+    }
 
 @bp.route('/api/videos/<int:video_id>', methods=['DELETE'])
 def delete_video(video_id):
     """Delete a video"""
     video = Video.query.get_or_404(video_id)
+    file_path = video.file_path
     
     try:
-        # Delete from S3
-        result = delete_from_s3(video.file_path)
-        if result != 'success':
-            return jsonify({'error': f'Failed to delete from S3: {result}'}), 500
-            
         db.session.delete(video)
         db.session.commit()
-        return jsonify({'message': 'Video deleted successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    
+    # Delete from S3 unless other rows still share the file
+    result = delete_from_s3(file_path)
+    if result != 'success':
+        current_app.logger.error(f"Error deleting {file_path} from S3: {result}")
+    try:
+        delete_renditions(file_path)
+    except Exception as e:
+        current_app.logger.error(f"Error deleting HLS renditions of {file_path}: {str(e)}")
+    return jsonify({'message': 'Video deleted successfully'})
 
 @bp.route('/api/videos/<int:video_id>', methods=['PUT'])
 def update_video(video_id):
@@ -185,6 +207,7 @@ def preview_video(video_id):
     })
 
 @bp.route('/videos/<int:video_id>/manage-buttons')
+@query_budget(2)
 def manage_buttons(video_id):
     """Render the button management page for a specific video"""
     video = Video.query.get_or_404(video_id)
@@ -240,6 +263,7 @@ def update_button(button_id):
         return jsonify({'error': str(e)}), 500
 
 @bp.route('/buttons/<int:button_id>/manage-media')
+@query_budget(2)
 def manage_button_media(button_id):
     """Render the media management page for a specific button"""
     button = Button.query.get_or_404(button_id)
@@ -277,6 +301,7 @@ def determine_file_type(filename):
     return 'other'
 
 @bp.route('/api/button-media', methods=['POST'])
+@large_upload
 def upload_button_media():
     """Upload new media for a button"""
     if 'media' not in request.files:
@@ -305,45 +330,52 @@ def upload_button_media():
         if not all([button_id, title]):
             return jsonify({'error': 'Missing required fields'}), 400
             
-        # Generate unique filename
+        # Key the object by its content, so re-uploads of the same file share it
         filename = secure_filename(media_file.filename)
-        unique_filename = f"uploads/buttons/{button_id}_{int(time.time())}_{filename}"
-        
-        # Upload to S3
-        bucket_name = current_app.config['S3_BUCKET']
-        s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-        result = send_to_s3(media_file, bucket_name, unique_filename)
+        unique_filename = content_key(media_file, filename)
+        
+        # Spool the file and let a background worker push it to S3
+        job_id = get_upload_queue().enqueue('button_media', media_file, unique_filename, {
+            'button_id': int(button_id),
+            'type': media_type,
+            'title': title,
+            'description': description
+        })
         
-        if result != 'success':
-            return jsonify({'error': f'Failed to upload to S3: {result}'}), 500
+        return jsonify({
+            'message': 'Media upload queued',
+            'job_id': job_id,
+            'status_url': f'/api/jobs/{job_id}'
+        }), 202
         
-        # Create media record
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@register_handler('button_media')
+def create_uploaded_button_media(job_id, payload, file_path):
+    """Create the ButtonMedia row once a queued upload has reached S3; a retried job gets the row it already made"""
+    media = ButtonMedia.query.filter_by(upload_job_id=job_id).first()
+    if media is None:
         media = ButtonMedia(
-            button_id=button_id,
-            type=media_type,
-            title=title,
-            description=description,
-            file_path=f"{s3_location}/{unique_filename}"
+            button_id=payload['button_id'],
+            type=payload['type'],
+            title=payload['title'],
+            description=payload['description'],
+            file_path=file_path,
+            upload_job_id=job_id
         )
-        
         db.session.add(media)
         db.session.commit()
-        
-        return jsonify({
-            'message': 'Media uploaded successfully',
-            'media': {
-                'id': media.id,
-                'type': media_type,
-                'title': title,
-                'file_path': f"{s3_location}/{unique_filename}"
-            }
-        }), 201
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    
+    return {
+        'id': media.id,
+        'type': media.type,
+        'title': media.title,
+        'file_path': media.file_path
+    }
 
 @bp.route('/api/button-media/batch', methods=['POST'])
+@large_upload
 def upload_button_media_batch():
     """Upload multiple media files for a button"""
     try:
@@ -390,11 +422,11 @@ def upload_button_media_batch():
             print(error_msg)
             return jsonify({'error': error_msg}), 400
 
-        uploaded_media = []
         s3_location = s3_location.rstrip('/')
         
         # Track processed files to avoid duplicates
         processed_files = set()
+        pending = []
         
         for file in files:
             if not file or not file.filename:
@@ -411,58 +443,65 @@ def upload_button_media_batch():
                 print(f"Skipping file with unsupported extension: {file_ext}")
                 continue
                 
-            try:
-                # Generate unique filename
-                filename = secure_filename(file.filename)
-                timestamp = int(time.time() * 1000)  # Use milliseconds for better uniqueness
-                unique_filename = f"uploads/buttons/{button_id}_{timestamp}_{filename}"
-                print(f"Processing file: {filename} -> {unique_filename}")
-                
-                # Determine media type
-                media_type = 'image' if file_ext in ['.jpg', '.jpeg', '.png', '.gif'] else 'video'
-                
-                # Upload to S3
-                result = send_to_s3(file, bucket_name, unique_filename)
-                print(f"S3 upload result for {filename}: {result}")
-                
-                if result != 'success':
-                    print(f"S3 upload failed for {filename}: {result}")
-                    continue
-                
-                # Create media record
-                media = ButtonMedia(
-                    button_id=button_id,
-                    type=media_type,
-                    title=title,
-                    description=description,
-                    file_path=f"{s3_location}/{unique_filename}"
-                )
-                
-                db.session.add(media)
-                uploaded_media.append({
-                    'type': media_type,
-                    'title': title,
-                    'file_path': f"{s3_location}/{unique_filename}"
-                })
-                print(f"Added media record for {filename}")
-                
-                # Mark file as processed
-                processed_files.add(file.filename)
-                
-            except Exception as e:
-                print(f"Error processing file {filename}: {str(e)}")
+            # Key the object by its content, so re-uploads of the same file share it
+            filename = secure_filename(file.filename)
+            unique_filename = content_key(file, filename)
+            print(f"Processing file: {filename} -> {unique_filename}")
+            
+            # Determine media type
+            media_type = 'image' if file_ext in ['.jpg', '.jpeg', '.png', '.gif'] else 'video'
+            pending.append((file, filename, unique_filename, media_type))
+            
+            # Mark file as processed
+            processed_files.add(file.filename)
+        
+        # Read the images for their smaller WebP/AVIF copies before boto3 closes the files
+        prepared = prepare_derivatives([(file, unique_filename) for file, _, unique_filename, _ in pending])
+        
+        # Upload all files to S3 in parallel
+        results = send_batch_to_s3([(file, unique_filename) for file, _, unique_filename, _ in pending], bucket_name)
+        
+        uploaded_media = []
+        failed = []
+        # Derivatives are only rendered for the files that made it to S3
+        targets = [None] * len(pending)
+        for index, ((file, filename, unique_filename, media_type), result, media_derivatives) in enumerate(
+                zip(pending, results, reused_derivatives(prepared))):
+            print(f"S3 upload result for {filename}: {result}")
+            if result != 'success':
+                failed.append({'filename': filename, 'error': result})
                 continue
+            
+            # Create media record
+            media = ButtonMedia(
+                button_id=button_id,
+                type=media_type,
+                title=title,
+                description=description,
+                file_path=f"{s3_location}/{unique_filename}",
+                derivatives=media_derivatives
+            )
+            
+            db.session.add(media)
+            targets[index] = (media, 'derivatives')
+            uploaded_media.append({
+                'type': media_type,
+                'title': title,
+                'file_path': f"{s3_location}/{unique_filename}"
+            })
         
         if not uploaded_media:
             print("No files were successfully uploaded")
-            return jsonify({'error': 'No files were successfully uploaded'}), 400
+            return jsonify({'error': 'No files were successfully uploaded', 'failed': failed}), 400
         
         try:
             print(f"Committing {len(uploaded_media)} media records to database")
             db.session.commit()
+            render_later(prepared, targets)
             return jsonify({
                 'message': f'Successfully uploaded {len(uploaded_media)} files',
-                'media': uploaded_media
+                'media': uploaded_media,
+                'failed': failed
             })
         except Exception as e:
             print(f"Database commit error: {str(e)}")
@@ -486,17 +525,12 @@ def update_button_media_title():
             return jsonify({'error': 'Missing required fields'}), 400
             
         # Update all media items with the original title
-        media_items = ButtonMedia.query.filter_by(title=original_title).all()
-        if not media_items:
+        updated = rename_titles('button_media', [(original_title, new_title, new_description)])
+        if not updated:
             return jsonify({'error': 'No media items found with the given title'}), 404
             
-        for media in media_items:
-            media.title = new_title
-            if new_description is not None:
-                media.description = new_description
-            
         db.session.commit()
-        return jsonify({'message': 'Successfully updated media titles'})
+        return jsonify(dict(summarize(updated), message='Successfully updated media titles'))
         
     except Exception as e:
         print(f"Error updating media titles: {str(e)}")
@@ -507,19 +541,21 @@ def update_button_media_title():
 def delete_button_media(media_id):
     """Delete button media"""
     media = ButtonMedia.query.get_or_404(media_id)
+    file_path, derivatives = media.file_path, media.derivatives
     
     try:
-        # Delete the media file
-        file_path = os.path.join(current_app.root_path, 'static', media.file_path)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            
         db.session.delete(media)
         db.session.commit()
-        return jsonify({'message': 'Media deleted successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    
+    # Delete the media file unless other rows (e.g. the subsection media it was mapped from) still share it
+    result = delete_from_s3(file_path)
+    if result != 'success':
+        current_app.logger.error(f"Error deleting {file_path} from S3: {result}")
+    delete_derivatives(derivatives, file_path)
+    return jsonify({'message': 'Media deleted successfully'})
 
 @bp.route('/api/button-media/<int:media_id>', methods=['PUT'])
 def update_button_media(media_id):
@@ -572,13 +608,78 @@ def update_home_details(id):
         current_app.logger.error(f"Error updating home details: {str(e)}")
         return jsonify({'error': 'Failed to update home details'}), 500
 
+def kiosk_tree_query():
+    """Kiosk query that loads videos, buttons and button media up front (one query per level)"""
+    return Kiosk.query.options(
+        selectinload(Kiosk.videos)
+        .selectinload(Video.buttons)
+        .selectinload(Button.media_items)
+    )
+
+def serialize_kiosk_tree(kiosk):
+    """Nested kiosk -> videos -> buttons -> media document for the kiosk front end"""
+    return {
+        'id': kiosk.id,
+        'title': kiosk.title,
+        'description': kiosk.description,
+        'videos': [{
+            'id': video.id,
+            'title': video.title,
+            'description': video.description,
+            'file_path': video.file_path,
+            'hls': parse_hls(video.hls_manifest),
+            'buttons': [{
+                'id': button.id,
+                'title': button.title,
+                'media': [{
+                    'id': media.id,
+                    'type': media.type,
+                    'title': media.title,
+                    'description': media.description,
+                    'file_path': media.file_path
+                } for media in sorted(button.media_items, key=lambda m: m.created_at or datetime.min, reverse=True)]
+            } for button in video.buttons]
+        } for video in kiosk.videos]
+    }
+
 @bp.route('/view-kiosks')
+@query_budget(4)
 def view_kiosks():
     """Render the kiosk viewing page"""
-    kiosks = Kiosk.query.order_by(Kiosk.created_at.desc()).all()
-    return render_template('view_kiosks.html', kiosks=kiosks)
+    kiosks = kiosk_tree_query().order_by(Kiosk.created_at.desc()).all()
+    return render_template('view_kiosks.html', kiosks=kiosks,
+                           kiosk_trees=[serialize_kiosk_tree(kiosk) for kiosk in kiosks])
+
+@bp.route('/kiosks/<int:kiosk_id>/view')
+@query_budget(4)
+def view_kiosk(kiosk_id):
+    """Render the viewing page for a single kiosk"""
+    kiosk = kiosk_tree_query().filter(Kiosk.id == kiosk_id).first_or_404()
+    return render_template('view_kiosks.html', kiosks=[kiosk],
+                           kiosk_trees=[serialize_kiosk_tree(kiosk)])
+
+@bp.route('/api/kiosks/<int:kiosk_id>/tree')
+@query_budget(4)
+def get_kiosk_tree(kiosk_id):
+    """Get a kiosk with all its videos, buttons and button media in one document"""
+    kiosk = kiosk_tree_query().filter(Kiosk.id == kiosk_id).first_or_404()
+    return jsonify(serialize_kiosk_tree(kiosk))
+
+@bp.route('/api/kiosks/<int:kiosk_id>/manifest')
+def get_kiosk_manifest(kiosk_id):
+    """Serve the precomputed kiosk manifest, answering unchanged polls with 304"""
+    etag = get_manifest_etag(kiosk_id)
+    if etag is None:
+        return jsonify({'error': 'Kiosk not found'}), 404
+
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+
+    return Response(get_manifest_body(kiosk_id), headers=headers, mimetype='application/json')
 
 @bp.route('/api/buttons/<int:button_id>/media')
+@cached(tags=lambda button_id: [f'button:{button_id}'])
 def get_button_media(button_id):
     """Get all media items for a button"""
     try:
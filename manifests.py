@@ -0,0 +1,383 @@
+"""
+Per-kiosk manifests.
+
+Each kiosk's manifest lists every video, button and media URL with its size and
+content hash. It is stored in kiosk_manifests together with a strong ETag, so a
+kiosk poll is a single-column lookup and usually a 304. Inserts, updates and
+deletes of Kiosk/Video/Button/ButtonMedia record the affected kiosk IDs on the
+session, and once the transaction commits those kiosks are queued for a
+rebuild (ManifestQueue), off the request: a rebuild may stat new files on S3.
+
+Hashes are SHA-256. A content-addressed object's hash is in its key
+(objects/<sha256>.<ext>); other objects are read and hashed once, and the
+result is kept in media_objects.
+"""
+import json
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session, selectinload
+from models import db, Kiosk, Video, Button, ButtonMedia, MediaObject, KioskManifest
+from content_store import HASH_CHUNK_SIZE, object_key
+from sqlite_config import apply_pragmas
+
+DIRTY_KEY = 'dirty_kiosk_ids'
+STALE_JOB_SECONDS = 300  # A running rebuild with no progress for this long is assumed dead
+POLL_INTERVAL = 2
+MAX_ATTEMPTS = 3
+CONTENT_KEY = re.compile(r'objects/([0-9a-f]{64})\.\w+$')
+
+
+def _mark_dirty(target, *kiosk_ids):
+    session = inspect(target).session
+    if session is None:
+        return
+    rebuild_on_commit(session, kiosk_ids)
+
+
+def rebuild_on_commit(session, kiosk_ids):
+    """Rebuild these kiosks' manifests once `session` commits, for writes that bypass the ORM (bulk statements)"""
+    session.info.setdefault(DIRTY_KEY, set()).update(k for k in kiosk_ids if k is not None)
+
+
+def kiosks_for_buttons(connection, button_ids):
+    return set(connection.execute(
+        db.select(Video.kiosk_id).join(Button, Button.video_id == Video.id).where(Button.id.in_(button_ids)).distinct()
+    ).scalars())
+
+
+def _kiosk_for_video(connection, video_id):
+    return connection.execute(
+        db.select(Video.kiosk_id).where(Video.id == video_id)
+    ).scalar()
+
+
+def _kiosk_for_button(connection, button_id):
+    return connection.execute(
+        db.select(Video.kiosk_id).join(Button, Button.video_id == Video.id).where(Button.id == button_id)
+    ).scalar()
+
+
+@event.listens_for(Kiosk, 'after_insert')
+@event.listens_for(Kiosk, 'after_update')
+@event.listens_for(Kiosk, 'after_delete')
+def _kiosk_changed(mapper, connection, target):
+    _mark_dirty(target, target.id)
+
+
+@event.listens_for(Video, 'after_insert')
+@event.listens_for(Video, 'after_update')
+@event.listens_for(Video, 'after_delete')
+def _video_changed(mapper, connection, target):
+    # A video moved to another kiosk changes both manifests
+    previous = inspect(target).attrs.kiosk_id.history.deleted or []
+    _mark_dirty(target, target.kiosk_id, *previous)
+
+
+@event.listens_for(Button, 'after_insert')
+@event.listens_for(Button, 'after_update')
+@event.listens_for(Button, 'after_delete')
+def _button_changed(mapper, connection, target):
+    _mark_dirty(target, _kiosk_for_video(connection, target.video_id))
+
+
+@event.listens_for(ButtonMedia, 'after_insert')
+@event.listens_for(ButtonMedia, 'after_update')
+@event.listens_for(ButtonMedia, 'after_delete')
+def _button_media_changed(mapper, connection, target):
+    _mark_dirty(target, _kiosk_for_button(connection, target.button_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _rebuild_dirty_manifests(session):
+    kiosk_ids = session.info.pop(DIRTY_KEY, None)
+    if kiosk_ids:
+        try:
+            get_manifest_queue().enqueue(kiosk_ids)
+        except Exception as e:
+            current_app.logger.error(f"Error queuing kiosk manifests {sorted(kiosk_ids)}: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_dirty_manifests(session):
+    session.info.pop(DIRTY_KEY, None)
+
+
+class ManifestQueue:
+    """
+    Durable queue of kiosks whose manifests need rebuilding, one row per kiosk.
+
+    Lives next to the upload jobs in UPLOAD_JOBS_DB. Queuing a kiosk that is
+    already queued is a no-op, and queuing one that is being rebuilt queues it
+    again, so a change committed mid-rebuild isn't lost. Each process runs
+    MANIFEST_WORKERS threads.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.db_path = app.config['UPLOAD_JOBS_DB']
+        self.worker_count = app.config['MANIFEST_WORKERS']
+        self.pragmas = app.config['SQLITE_PRAGMAS']
+        with self._connect() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS manifest_jobs (
+                kiosk_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_manifest_jobs_status ON manifest_jobs (status, created_at)')
+        app.extensions['manifests'] = self
+        app.before_request(self.ensure_workers)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        apply_pragmas(conn, self.pragmas)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def ensure_workers(self):
+        """Start this process's worker threads (once per process, so forked workers get their own)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.worker_count):
+                threading.Thread(target=self._work, name=f'manifest-{i}', daemon=True).start()
+
+    def enqueue(self, kiosk_ids):
+        """Queue `kiosk_ids` for a rebuild"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO manifest_jobs (kiosk_id, status, created_at, updated_at) VALUES (?, 'queued', ?, ?) "
+                "ON CONFLICT (kiosk_id) DO UPDATE SET status = 'queued', attempts = 0, error = NULL, "
+                "created_at = excluded.created_at, updated_at = excluded.updated_at WHERE status != 'queued'",
+                [(kiosk_id, now, now) for kiosk_id in kiosk_ids]
+            )
+        self.ensure_workers()
+        self._wakeup.set()
+
+    def pending(self):
+        """IDs of the kiosks waiting for (or in) a rebuild"""
+        with self._connect() as conn:
+            return {row['kiosk_id'] for row in conn.execute(
+                "SELECT kiosk_id FROM manifest_jobs WHERE status IN ('queued', 'running')"
+            )}
+
+    def _claim(self):
+        """Atomically take the oldest queued job (or a stale running one) for this worker"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT * FROM manifest_jobs WHERE status = 'queued' "
+                    "OR (status = 'running' AND updated_at < ?) ORDER BY created_at LIMIT 1",
+                    (now - STALE_JOB_SECONDS,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE manifest_jobs SET status = 'running', attempts = attempts + 1, "
+                        "updated_at = ? WHERE kiosk_id = ?",
+                        (now, row['kiosk_id'])
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return row
+
+    def _finish(self, kiosk_id, status, error=None):
+        """Record the outcome, unless the kiosk was queued again while it was being rebuilt"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE manifest_jobs SET status = ?, error = ?, updated_at = ? "
+                "WHERE kiosk_id = ? AND status = 'running'",
+                (status, error, time.time(), kiosk_id)
+            )
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                self.app.logger.error(f"Error claiming manifest job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        kiosk_id = job['kiosk_id']
+        try:
+            with self.app.app_context():
+                rebuild_manifests({kiosk_id})
+            self._finish(kiosk_id, 'done')
+        except Exception as e:
+            self.app.logger.error(f"Error rebuilding the manifest of kiosk {kiosk_id}: {e}")
+            self._finish(kiosk_id, 'failed' if job['attempts'] + 1 >= MAX_ATTEMPTS else 'queued', str(e))
+
+
+def get_manifest_queue():
+    return current_app.extensions['manifests']
+
+
+def _stat(file_path):
+    """(size, SHA-256) of a stored object"""
+    bucket = current_app.config['S3_BUCKET']
+    key = object_key(file_path)
+    match = CONTENT_KEY.search(key)
+    if match:
+        return current_app.s3.head_object(Bucket=bucket, Key=key)['ContentLength'], match.group(1)
+    # Not content-addressed (uploaded before content_store.py): hash the bytes
+    body = current_app.s3.get_object(Bucket=bucket, Key=key)['Body']
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def _object_info(session, file_paths):
+    """Return {file_path: (size, hash)}, asking S3 for anything not seen before"""
+    info = {
+        file_path: (size, content_hash)
+        for file_path, size, content_hash in session.query(
+            MediaObject.file_path, MediaObject.size, MediaObject.content_hash
+        ).filter(MediaObject.file_path.in_(file_paths), MediaObject.size.isnot(None))
+    }
+    stats = []
+    for file_path in file_paths - info.keys():
+        # Rows created by reference counting (content_store.py) haven't been stat'ed yet
+        try:
+            info[file_path] = _stat(file_path)
+        except Exception as e:
+            current_app.logger.warning(f"Could not stat {file_path} on S3: {str(e)}")
+            continue
+        size, content_hash = info[file_path]
+        stats.append({'file_path': file_path, 'size': size, 'content_hash': content_hash, 'now': datetime.utcnow()})
+    if stats:
+        # The same upsert as content_store.adjust_references, so it can't collide with a request counting
+        # a new reference; every path here is referenced, so a row only goes missing in a race with its delete
+        session.execute(text(
+            'INSERT INTO media_objects (file_path, ref_count, size, content_hash, checked_at) '
+            'VALUES (:file_path, 0, :size, :content_hash, :now) '
+            'ON CONFLICT (file_path) DO UPDATE SET size = excluded.size, content_hash = excluded.content_hash'
+        ), stats)
+    return info
+
+
+def build_manifest(session, kiosk):
+    """Build the manifest document for one kiosk (without version metadata)"""
+    file_paths = set()
+    for video in kiosk.videos:
+        file_paths.add(video.file_path)
+        for button in video.buttons:
+            file_paths.update(media.file_path for media in button.media_items)
+    info = _object_info(session, file_paths)
+
+    def entry(file_path):
+        size, content_hash = info.get(file_path, (None, None))
+        return {'url': file_path, 'size': size, 'hash': content_hash}
+
+    return {
+        'kiosk_id': kiosk.id,
+        'title': kiosk.title,
+        'description': kiosk.description,
+        'videos': [dict(entry(video.file_path), **{
+            'id': video.id,
+            'title': video.title,
+            'description': video.description,
+            'hls': json.loads(video.hls_manifest) if video.hls_manifest else None,
+            'buttons': [{
+                'id': button.id,
+                'title': button.title,
+                'media': [dict(entry(media.file_path), **{
+                    'id': media.id,
+                    'type': media.type,
+                    'title': media.title,
+                    'description': media.description
+                }) for media in sorted(button.media_items, key=lambda m: m.id)]
+            } for button in sorted(video.buttons, key=lambda b: b.id)]
+        }) for video in sorted(kiosk.videos, key=lambda v: v.id)]
+    }
+
+
+def rebuild_manifests(kiosk_ids):
+    """Regenerate the stored manifests for `kiosk_ids`, bumping the version only on real changes"""
+    with Session(db.engine) as session:
+        kiosks = {
+            kiosk.id: kiosk
+            for kiosk in session.query(Kiosk).options(
+                selectinload(Kiosk.videos).selectinload(Video.buttons).selectinload(Button.media_items)
+            ).filter(Kiosk.id.in_(kiosk_ids))
+        }
+        stored = {
+            manifest.kiosk_id: manifest
+            for manifest in session.query(KioskManifest).filter(KioskManifest.kiosk_id.in_(kiosk_ids))
+        }
+
+        for kiosk_id in kiosk_ids:
+            manifest = stored.get(kiosk_id)
+            kiosk = kiosks.get(kiosk_id)
+            if kiosk is None:
+                if manifest is not None:
+                    session.delete(manifest)
+                continue
+
+            content = build_manifest(session, kiosk)
+            etag = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+            if manifest is not None and manifest.etag == etag:
+                continue
+
+            version = manifest.version + 1 if manifest is not None else 1
+            body = json.dumps(dict(content, version=version, generated_at=datetime.utcnow().isoformat()))
+            if manifest is None:
+                session.add(KioskManifest(kiosk_id=kiosk_id, version=version, etag=etag, body=body))
+            else:
+                manifest.version = version
+                manifest.etag = etag
+                manifest.body = body
+
+        session.commit()
+
+
+def get_manifest_etag(kiosk_id):
+    """Return the current ETag for a kiosk's manifest, building it on first request"""
+    etag = db.session.query(KioskManifest.etag).filter_by(kiosk_id=kiosk_id).scalar()
+    if etag is None and db.session.get(Kiosk, kiosk_id) is not None:
+        rebuild_manifests({kiosk_id})
+        etag = db.session.query(KioskManifest.etag).filter_by(kiosk_id=kiosk_id).scalar()
+    return etag
+
+
+def get_manifest_body(kiosk_id):
+    return db.session.query(KioskManifest.body).filter_by(kiosk_id=kiosk_id).scalar()
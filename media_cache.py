@@ -0,0 +1,497 @@
+import os
+import fcntl
+import json
+import mimetypes
+import threading
+import time
+from flask import current_app, request, Response, send_file, abort
+from werkzeug.security import safe_join
+from upstream import get_upstream_client
+from static_serving import IMMUTABLE_CACHE_CONTROL, is_content_hashed
+
+CHUNK_SIZE = 256 * 1024  # Bytes read from S3 / sent to the client at a time
+WAIT_TIMEOUT = 30  # Seconds a reader waits for new bytes before fetching the rest from S3 itself
+POLL_INTERVAL = 0.1  # Seconds between checks on a download running in another worker
+EVICT_TO = 0.9  # Eviction frees space down to this fraction of max_bytes, so it doesn't rescan on every miss
+RESCAN_SECONDS = 600  # Other workers' downloads aren't in this worker's running total; rescan this often
+STALE_LOCK_SECONDS = 3600  # Lock files this old, left by a worker that died, are swept by eviction
+TEMP_SUFFIX = '.part'
+LOCK_SUFFIX = '.lock'
+META_SUFFIX = '.meta'
+SIDECAR_SUFFIXES = (TEMP_SUFFIX, LOCK_SUFFIX, META_SUFFIX)
+
+
+class _Fill:
+    """An in-progress download of one S3 object into the cache"""
+
+    def __init__(self, name, temp_path):
+        self.name = name
+        self.temp_path = temp_path
+        self.size = None  # Total size from Content-Length, if S3 sent one
+        self.content_type = None
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.started = threading.Event()  # Set once headers are known (or the fetch failed)
+        self.cond = threading.Condition()
+
+    def wait_for(self, position):
+        """Block until more than `position` bytes are on disk, or the fill ends.
+        Returns the number of bytes currently available."""
+        with self.cond:
+            while self.written <= position and not self.done and self.error is None:
+                if not self.cond.wait(WAIT_TIMEOUT):
+                    break
+            return self.written
+
+    def progress(self, written):
+        with self.cond:
+            if written > self.written:
+                self.written = written
+                self.cond.notify_all()
+
+    def finish(self, size):
+        with self.cond:
+            self.size = size
+            self.written = size
+            self.done = True
+            self.cond.notify_all()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+        self.started.set()
+
+
+def _write_meta(path, meta):
+    """Atomically write the JSON sidecar describing a cached object"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, path)
+
+
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _is_current(lock_file, lock_path):
+    """Whether `lock_file` is still the file at `lock_path` (and not one removed since it was opened)"""
+    try:
+        return os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+    except OSError:
+        return False
+
+
+def _lock(lock_path):
+    """
+    Open `lock_path` and try for its exclusive flock. Returns (file, True) if we
+    hold it, or (file, False) if another worker does. Whoever holds a lock file
+    removes it when done, so a file locked after that happened is retried.
+    """
+    while True:
+        lock_file = open(lock_path, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return lock_file, False
+        if _is_current(lock_file, lock_path):
+            return lock_file, True
+        lock_file.close()
+
+
+def _release(lock_file, lock_path):
+    """Remove a lock file we hold exclusively, then let go of it"""
+    _remove(lock_path)
+    lock_file.close()
+
+
+def _sweep_lock(lock_path):
+    """Remove a lock file left behind by a worker that died, unless someone holds it"""
+    try:
+        if time.time() - os.stat(lock_path).st_mtime < STALE_LOCK_SECONDS:
+            return
+        lock_file = open(lock_path, 'a+')
+    except OSError:
+        return
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return
+    if _is_current(lock_file, lock_path):
+        _release(lock_file, lock_path)
+    else:
+        lock_file.close()
+
+
+class MediaCache:
+    """
+    Read-through disk cache for objects under S3_LOCATION.
+
+    A miss starts a background download into `<name>.part`; the request (and any
+    other request for the same object) streams from that file as it grows, so
+    playback starts after the first chunk instead of after the whole object.
+    Completed files are renamed into place and the cache is kept under
+    `max_bytes` by evicting the least recently used files. Completed downloads
+    are added to a running total, so the cache directory is only walked when
+    that total goes over `max_bytes` or every RESCAN_SECONDS.
+
+    Misses are single-flight across gunicorn workers: the worker holding the
+    exclusive flock on `<name>.lock` downloads, and every other worker tails the
+    `.part` file using the size and type the leader publishes in `<name>.meta`.
+    The leader removes the lock file when it's done. A reader that gets no new
+    bytes for WAIT_TIMEOUT (or whose download failed) fetches the rest of its
+    range from S3 directly, since its headers have already been sent.
+
+    The meta sidecar also keeps the object's ETag and Last-Modified so entries
+    older than `revalidate_after` seconds are checked with a conditional GET.
+    """
+
+    def __init__(self, root, max_bytes, upstream, revalidate_after=3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.upstream = upstream
+        self.revalidate_after = revalidate_after
+        self._fills = {}
+        self._lock = threading.Lock()
+        self._evicting = threading.Lock()
+        self._size = None  # Bytes cached as of the last scan plus downloads since; None before the first scan
+        self._scanned_at = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, name):
+        return safe_join(self.root, name)
+
+    def lookup(self, name):
+        """Return the cached path for `name` or None, marking it as recently used"""
+        path = self.path_for(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        try:
+            # Atime is the LRU clock; mtime is left alone so ETags stay stable
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+        return path
+
+    def revalidate(self, name, url):
+        """
+        Check a cached copy against S3 once it is older than `revalidate_after`.
+        Returns False if S3 has a newer object, in which case the stale copy is
+        dropped and the caller should treat the request as a miss.
+        """
+        final_path = self.path_for(name)
+        meta_path = final_path + META_SUFFIX
+        meta = _read_meta(meta_path)
+        if meta is None or time.time() - meta.get('checked_at', 0) < self.revalidate_after:
+            return True
+
+        # Record the check up front so concurrent hits don't all revalidate
+        meta['checked_at'] = time.time()
+        _write_meta(meta_path, meta)
+        try:
+            with self.upstream.get(url, stream=True, etag=meta.get('etag'),
+                                   last_modified=meta.get('last_modified')) as response:
+                if response.status_code != 200:
+                    return True
+        except Exception as e:
+            print(f"Error revalidating {name}, serving cached copy: {e}")
+            return True
+
+        _remove(final_path)
+        _remove(meta_path)
+        return False
+
+    def get_fill(self, name, url):
+        """
+        Return the in-progress fill for `name`, joining or starting one as needed.
+        Returns None if the object landed in the cache while we were looking.
+        """
+        with self._lock:
+            fill = self._fills.get(name)
+            if fill is not None:
+                return fill
+
+            final_path = self.path_for(name)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            lock_file, leader = _lock(final_path + LOCK_SUFFIX)
+
+            if leader and os.path.isfile(final_path):
+                # Another worker finished the download between our lookup and the lock
+                _release(lock_file, final_path + LOCK_SUFFIX)
+                return None
+
+            fill = _Fill(name, final_path + TEMP_SUFFIX)
+            self._fills[name] = fill
+            if leader:
+                target, args = self._download, (fill, url, final_path, lock_file)
+            else:
+                target, args = self._follow, (fill, final_path, lock_file)
+            threading.Thread(target=target, args=args, daemon=True).start()
+        return fill
+
+    def _download(self, fill, url, final_path, lock_file):
+        """Fetch `url` into the cache; runs while holding the object's flock"""
+        meta_path = final_path + META_SUFFIX
+        try:
+            _remove(meta_path)  # Left behind by a worker that died mid-download
+            with self.upstream.get(url, stream=True) as response:
+                if response.status_code != 200:
+                    raise FileNotFoundError(f"S3 returned {response.status_code} for {fill.name}")
+
+                length = response.headers.get('Content-Length')
+                fill.size = int(length) if length is not None else None
+                fill.content_type = response.headers.get('Content-Type')
+
+                with open(fill.temp_path, 'wb') as f:
+                    _write_meta(meta_path, {
+                        'size': fill.size,
+                        'content_type': fill.content_type,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'checked_at': time.time()
+                    })
+                    fill.started.set()
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        if not chunk:
+                            continue
+                        f.write(chunk)
+                        f.flush()
+                        fill.progress(fill.written + len(chunk))
+
+            if fill.size is not None and fill.written != fill.size:
+                raise IOError(f"Short read for {fill.name}: {fill.written} of {fill.size} bytes")
+
+            os.replace(fill.temp_path, final_path)
+            fill.finish(fill.written)
+        except Exception as e:
+            print(f"Error caching {fill.name}: {e}")
+            _remove(fill.temp_path)
+            _remove(meta_path)
+            fill.fail(e)
+        finally:
+            _release(lock_file, final_path + LOCK_SUFFIX)
+            with self._lock:
+                self._fills.pop(fill.name, None)
+        if fill.done:
+            self._added(fill.written)
+
+    def _follow(self, fill, final_path, lock_file):
+        """Track a download running in another worker by watching its files"""
+        meta_path = final_path + META_SUFFIX
+        try:
+            while True:
+                try:
+                    # A shared lock only succeeds once the leader has let go
+                    fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    leader_running = False
+                except BlockingIOError:
+                    leader_running = True
+
+                if not fill.started.is_set():
+                    meta = _read_meta(meta_path)
+                    if meta is not None:
+                        fill.size = meta.get('size')
+                        fill.content_type = meta.get('content_type')
+                        fill.started.set()
+
+                if not leader_running:
+                    if not os.path.isfile(final_path):
+                        raise FileNotFoundError(f"Download of {fill.name} failed in another worker")
+                    fill.started.set()
+                    fill.finish(os.path.getsize(final_path))
+                    return
+
+                try:
+                    fill.progress(os.path.getsize(fill.temp_path))
+                except OSError:
+                    pass
+                time.sleep(POLL_INTERVAL)
+        except Exception as e:
+            fill.fail(e)
+        finally:
+            lock_file.close()
+            with self._lock:
+                self._fills.pop(fill.name, None)
+
+    def _added(self, size):
+        """Count a completed download, evicting once the cache may have outgrown max_bytes"""
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            due = (self._size is None or self._size > self.max_bytes
+                   or time.time() - self._scanned_at > RESCAN_SECONDS)
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Rescan the cache and, if it's over max_bytes, delete least recently used files until it fits in EVICT_TO of it"""
+        if not self._evicting.acquire(blocking=False):
+            return  # Another download thread is already at it
+        try:
+            entries = []
+            total = 0
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if filename.endswith(LOCK_SUFFIX):
+                        _sweep_lock(path)
+                        continue
+                    if filename.endswith(SIDECAR_SUFFIXES) or filename.endswith('.tmp'):
+                        continue
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_atime, st.st_size, path))
+                    total += st.st_size
+
+            if total > self.max_bytes:
+                target = self.max_bytes * EVICT_TO
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except OSError:
+                        continue
+                    _remove(path + META_SUFFIX)
+
+            with self._lock:
+                self._size = total
+                self._scanned_at = time.time()
+        finally:
+            self._evicting.release()
+
+
+def get_media_cache():
+    """Return the media cache for the current app, creating it on first use"""
+    cache = current_app.extensions.get('media_cache')
+    if cache is None:
+        cache = MediaCache(
+            current_app.config['MEDIA_CACHE_DIR'],
+            current_app.config['MEDIA_CACHE_MAX_BYTES'],
+            get_upstream_client(),
+            current_app.config['MEDIA_CACHE_REVALIDATE_SECONDS']
+        )
+        current_app.extensions['media_cache'] = cache
+    return cache
+
+
+def _open_fill(fill, final_path):
+    """Open the file backing a fill; it may already have been renamed into place"""
+    try:
+        return open(fill.temp_path, 'rb')
+    except FileNotFoundError:
+        return open(final_path, 'rb')
+
+
+def _stream(fill, fh, start, stop, upstream, url):
+    """
+    Yield bytes [start, stop) of a growing file, waiting for the download as
+    needed. If the download stalls or fails first, the rest comes from S3.
+    """
+    position = start
+    with fh:
+        while stop is None or position < stop:
+            available = fill.wait_for(position)
+            if position >= available:
+                break
+            end = available if stop is None else min(available, stop)
+            fh.seek(position)
+            while position < end:
+                chunk = fh.read(min(CHUNK_SIZE, end - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+
+    complete = position >= stop if stop is not None else fill.done and position >= fill.written
+    if not complete:
+        print(f"Cache fill of {fill.name} stopped at {position} bytes, fetching the rest from S3")
+        yield from _fetch_rest(upstream, url, fill.name, position, stop)
+
+
+def _fetch_rest(upstream, url, name, position, stop):
+    """Yield bytes [position, stop) of `url` straight from S3 (to the end if stop is None)"""
+    with upstream.get(url, stream=True, byte_range=(position, stop)) as response:
+        if response.status_code == 416 and stop is None:
+            return  # Nothing past `position`: the object ended exactly there
+        if response.status_code != 206:
+            raise IOError(f"S3 returned {response.status_code} for the rest of {name}")
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if stop is not None:
+                chunk = chunk[:stop - position]
+            if not chunk:
+                continue
+            position += len(chunk)
+            yield chunk
+    if stop is not None and position < stop:
+        # Headers promised more; failing the response beats a silently short body
+        raise IOError(f"Short read for the rest of {name}: stopped at {position} of {stop} bytes")
+
+
+def _cache_control(response, filename):
+    # Content-addressed objects and their derivatives carry the hash in their own name and never change.
+    # HLS playlists sit under their original's hashed key but change when the ladder does, so the
+    # directories don't count
+    if is_content_hashed(os.path.basename(filename)):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def serve_cached_media(filename, url):
+    """Serve `filename` from the media cache, fetching it from `url` on a miss"""
+    cache = get_media_cache()
+    final_path = cache.path_for(filename)
+    if final_path is None:
+        abort(404)
+
+    cached_path = cache.lookup(filename)
+    if cached_path and cache.revalidate(filename, url):
+        return _cache_control(send_file(cached_path, conditional=True), filename)
+
+    fill = cache.get_fill(filename, url)
+    if fill is None:
+        return _cache_control(send_file(final_path, conditional=True), filename)
+    fill.started.wait(WAIT_TIMEOUT)
+    if fill.error is not None or not fill.started.is_set():
+        abort(404, description="File not found on S3")
+
+    content_type = fill.content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    headers = {'Accept-Ranges': 'bytes'}
+    start, stop, status = 0, None, 200
+
+    if fill.size is not None:
+        stop = fill.size
+        if request.range is not None:
+            byte_range = request.range.range_for_length(fill.size)
+            if byte_range is None:
+                return Response(status=416, headers={'Content-Range': f'bytes */{fill.size}'})
+            start, stop = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{fill.size}'
+        headers['Content-Length'] = str(stop - start)
+
+    try:
+        fh = _open_fill(fill, final_path)
+    except FileNotFoundError:
+        abort(404, description="File not found on S3")
+    response = Response(_stream(fill, fh, start, stop, cache.upstream, url), status=status, headers=headers,
+                        content_type=content_type, direct_passthrough=True)
+    return _cache_control(response, filename)
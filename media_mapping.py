@@ -0,0 +1,90 @@
+"""
+Set-based mapping of section media onto kiosk buttons.
+
+Mapping copies every Media row with the given titles onto each of the given
+buttons as ButtonMedia rows, in a single INSERT ... SELECT; unmapping is a
+single DELETE of the buttons' rows with those titles. Each copy records the
+Media row it came from in source_media_id, and the unique index on
+(button_id, source_media_id) makes mapping the same media twice a no-op.
+Deleting a Media row unlinks its copies (they keep their content), and media
+ids are never reused, so a stale pair can't stop a new row being mapped.
+
+The statements bypass the ORM, so the session hooks never see the rows. Both
+functions do the hooks' work themselves, in the caller's transaction: the
+media_objects reference counts, and the cache tags and kiosk manifests to
+purge and rebuild once the session commits. The caller commits.
+"""
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import event, literal, true
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from models import db, Media, Button, ButtonMedia
+from content_store import adjust_references
+from manifests import kiosks_for_buttons, rebuild_on_commit
+from response_cache import invalidate_on_commit
+
+COPIED_COLUMNS = ('type', 'file_path', 'title', 'description', 'derivatives')
+
+
+def map_media(titles, button_ids):
+    """Copy the media with `titles` onto every button in `button_ids`; returns the new rows' ids"""
+    now = datetime.utcnow()
+    table = ButtonMedia.__table__
+    source = (
+        db.select(Button.id, Media.id, *(getattr(Media, column) for column in COPIED_COLUMNS),
+                  literal(now), literal(now))
+        .select_from(Media).join(Button, true())
+        .where(Media.title.in_(titles), Button.id.in_(button_ids))
+    )
+    statement = (
+        insert(table)
+        .from_select(['button_id', 'source_media_id', *COPIED_COLUMNS, 'created_at', 'updated_at'], source)
+        .on_conflict_do_nothing(index_elements=['button_id', 'source_media_id'])
+        .returning(table.c.id, table.c.button_id, table.c.file_path, table.c.source_media_id)
+    )
+    rows = db.session.execute(statement).all()
+    _bookkeeping(rows, 1)
+    return sorted(row.id for row in rows)
+
+
+def unmap_media(titles, button_ids):
+    """Delete the rows with `titles` from every button in `button_ids`; returns the deleted rows' ids"""
+    table = ButtonMedia.__table__
+    statement = (
+        table.delete()
+        .where(table.c.button_id.in_(button_ids), table.c.title.in_(titles))
+        .returning(table.c.id, table.c.button_id, table.c.file_path, table.c.source_media_id)
+    )
+    rows = db.session.execute(statement).all()
+    _bookkeeping(rows, -1)
+    return sorted(row.id for row in rows)
+
+
+def _bookkeeping(rows, delta):
+    """What the session hooks would have done for these inserted (1) or deleted (-1) rows"""
+    if not rows:
+        return
+    session = db.session()
+    connection = session.connection()
+    references = Counter()
+    tags = {'button_media'}
+    for row in rows:
+        references[row.file_path] += delta
+        tags.update((f"button_media:{row.id}", f"button:{row.button_id}"))
+        if row.source_media_id is not None:
+            tags.add(f"media:{row.source_media_id}")
+    adjust_references(connection, references)
+    invalidate_on_commit(session, tags)
+    rebuild_on_commit(session, kiosks_for_buttons(connection, {row.button_id for row in rows}))
+
+
+@event.listens_for(Session, 'after_flush')
+def _unlink_deleted_sources(session, flush_context):
+    """Clear source_media_id on the copies of Media rows deleted in this flush (SQLite doesn't enforce the FK)"""
+    media_ids = [obj.id for obj in session.deleted if isinstance(obj, Media)]
+    if media_ids:
+        table = ButtonMedia.__table__
+        session.connection().execute(
+            table.update().where(table.c.source_media_id.in_(media_ids)).values(source_media_id=None)
+        )
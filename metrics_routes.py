@@ -0,0 +1,9 @@
+from flask import Blueprint, Response
+from profiling import get_request_metrics
+
+bp = Blueprint('metrics', __name__)
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, SQL and S3 metrics of every worker in Prometheus text format"""
+    return Response(get_request_metrics().render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,270 @@
+"""
+Schema migrations for the SQLAlchemy database.
+
+db.create_all() only creates missing tables, so anything that has to change an
+existing database (indexes, new columns) is added here as a numbered migration.
+Migrations are applied in order on startup and recorded in schema_migrations;
+each one must also be safe to run against a database freshly built by
+create_all().
+
+    python migrations.py upgrade   # apply pending migrations
+    python migrations.py check     # verify the hot queries use an index
+"""
+import re
+import sys
+from datetime import datetime
+from sqlalchemy import text
+
+
+def _create_index(conn, name, table, columns, unique=False):
+    conn.execute(text(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {table} ({columns})"
+    ))
+
+
+def _add_column(conn, table, column, ddl):
+    existing = {row[1] for row in conn.execute(text(f'PRAGMA table_info("{table}")'))}
+    if column not in existing:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+
+def _0001_query_indexes(conn):
+    # Section/subsection media listings and title-based bulk edits
+    _create_index(conn, 'ix_subsection_section_id', 'subsection', 'section_id')
+    _create_index(conn, 'ix_media_subsection_type', 'media', 'subsection_id, type')
+    _create_index(conn, 'ix_media_title', 'media', 'title')
+
+    # Kiosk tree: kiosk -> videos -> buttons -> media
+    _create_index(conn, 'ix_kiosk_created_at', 'kiosk', 'created_at')
+    _create_index(conn, 'ix_video_kiosk_created', 'video', 'kiosk_id, created_at')
+    _create_index(conn, 'ix_button_video_id', 'button', 'video_id')
+    _create_index(conn, 'ix_button_title_lower', 'button', 'lower(title)')
+    _create_index(conn, 'ix_button_media_button_created', 'button_media', 'button_id, created_at')
+    _create_index(conn, 'ix_button_media_title', 'button_media', 'title')
+
+    # Homes
+    _create_index(conn, 'ix_homes_created_at', 'homes', 'created_at')
+    _create_index(conn, 'ix_home_media_home_id', 'home_media', 'home_id')
+
+    # Floor plan search: every filter is optional and results are newest first
+    _create_index(conn, 'ix_floor_plans_created_at', 'floor_plans', 'created_at')
+    _create_index(conn, 'ix_floor_plans_site_dimension', 'floor_plans', 'site_dimension, created_at')
+    _create_index(conn, 'ix_floor_plans_facing', 'floor_plans', 'facing, created_at')
+    _create_index(conn, 'ix_floor_plans_floors', 'floor_plans', 'floors, created_at')
+    _create_index(conn, 'ix_floor_plans_type', 'floor_plans', 'type, created_at')
+
+
+def _0002_image_derivatives(conn):
+    # JSON describing the resized WebP/AVIF copies of an uploaded image
+    _add_column(conn, 'media', 'derivatives', 'TEXT')
+    _add_column(conn, 'button_media', 'derivatives', 'TEXT')
+    _add_column(conn, 'home_media', 'derivatives', 'TEXT')
+    _add_column(conn, 'floor_plans', 'floor_plan_derivatives', 'TEXT')
+    _add_column(conn, 'floor_plans', 'elevation_derivatives', 'TEXT')
+
+
+def _0003_video_hls(conn):
+    # JSON describing a kiosk video's adaptive HLS renditions and poster frame
+    _add_column(conn, 'video', 'hls_manifest', 'TEXT')
+
+
+def _0004_content_addressed_storage(conn):
+    # Uploads are deduplicated by content, so an object may be shared by several rows
+    _add_column(conn, 'media_objects', 'ref_count', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute(text('''
+        INSERT INTO media_objects (file_path, ref_count, checked_at)
+        SELECT file_path, COUNT(*), CURRENT_TIMESTAMP FROM (
+            SELECT file_path FROM media
+            UNION ALL SELECT file_path FROM button_media
+            UNION ALL SELECT file_path FROM home_media
+            UNION ALL SELECT file_path FROM video
+            UNION ALL SELECT floor_plan_path FROM floor_plans
+            UNION ALL SELECT elevation_path FROM floor_plans
+        ) WHERE file_path IS NOT NULL GROUP BY file_path
+        ON CONFLICT (file_path) DO UPDATE SET ref_count = excluded.ref_count
+    '''))
+
+    # Finding another row that already has derivatives for an uploaded object
+    _create_index(conn, 'ix_media_file_path', 'media', 'file_path')
+    _create_index(conn, 'ix_button_media_file_path', 'button_media', 'file_path')
+    _create_index(conn, 'ix_home_media_file_path', 'home_media', 'file_path')
+
+
+def _0005_button_media_source(conn):
+    # The Media row a mapped ButtonMedia copy came from; mapping the same media onto a button twice is a no-op
+    _add_column(conn, 'button_media', 'source_media_id', 'INTEGER REFERENCES media(id)')
+
+    # Copies made before this column existed: pair the nth copy of a (title, file) on a button with the
+    # nth Media row of that (title, file), so copies mapped twice keep only one source
+    conn.execute(text('''
+        WITH copies AS (
+            SELECT id, title, file_path,
+                   ROW_NUMBER() OVER (PARTITION BY button_id, title, file_path ORDER BY id) AS n
+            FROM button_media WHERE source_media_id IS NULL AND title IS NOT NULL
+        ), sources AS (
+            SELECT id, title, file_path, ROW_NUMBER() OVER (PARTITION BY title, file_path ORDER BY id) AS n
+            FROM media
+        )
+        UPDATE button_media SET source_media_id = (
+            SELECT sources.id FROM copies JOIN sources
+                ON sources.title = copies.title AND sources.file_path = copies.file_path AND sources.n = copies.n
+            WHERE copies.id = button_media.id
+        )
+        WHERE source_media_id IS NULL AND title IS NOT NULL
+    '''))
+    _create_index(conn, 'ux_button_media_source', 'button_media', 'button_id, source_media_id', unique=True)
+
+
+def _0006_upload_job_ids(conn):
+    # The upload job a row was created by, so a retried job finds its row instead of inserting another
+    for table in ('video', 'button_media'):
+        _add_column(conn, table, 'upload_job_id', 'VARCHAR(32)')
+        _create_index(conn, f'ux_{table}_upload_job', table, 'upload_job_id', unique=True)
+
+
+def _0007_media_autoincrement(conn):
+    # Copies whose source is gone; media deletes clear this from now on (see media_mapping.py)
+    conn.execute(text(
+        'UPDATE button_media SET source_media_id = NULL '
+        'WHERE source_media_id IS NOT NULL AND source_media_id NOT IN (SELECT id FROM media)'
+    ))
+
+    # Without AUTOINCREMENT SQLite gives the id of the newest deleted media row to the next insert, which
+    # could then collide with a stale (button_id, source_media_id) pair. SQLite can't add it in place, so
+    # rebuild the table from its own DDL
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'media'")).scalar()
+    if 'AUTOINCREMENT' in ddl.upper():
+        return
+    new_ddl, inline = re.subn(r'\bid INTEGER NOT NULL,', 'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,', ddl, count=1)
+    new_ddl, constraint = re.subn(r'PRIMARY KEY \(id\),\s*', '', new_ddl, count=1)
+    if not (inline and constraint):
+        raise RuntimeError(f"Unexpected media table definition, not rebuilding it: {ddl}")
+    new_ddl = new_ddl.replace('CREATE TABLE media', 'CREATE TABLE media_rebuild', 1)
+
+    indexes = [sql for sql, in conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'media' AND sql IS NOT NULL"
+    ))]
+    columns = ', '.join(f'"{row[1]}"' for row in conn.execute(text('PRAGMA table_info("media")')))
+    conn.execute(text(new_ddl))
+    conn.execute(text(f'INSERT INTO media_rebuild ({columns}) SELECT {columns} FROM media'))
+    conn.execute(text('DROP TABLE media'))
+    conn.execute(text('ALTER TABLE media_rebuild RENAME TO media'))
+    for sql in indexes:
+        conn.execute(text(sql))
+
+
+def _0008_sha256_hashes(conn):
+    # Manifest hashes used to be S3 ETags, which aren't MD5s (or SHA-256s) for multipart uploads. Forget
+    # them and the manifests built from them; manifests are rebuilt, and objects stat'ed again, on first request
+    conn.execute(text(
+        'UPDATE media_objects SET size = NULL, content_hash = NULL '
+        'WHERE content_hash IS NOT NULL AND length(content_hash) != 64'
+    ))
+    conn.execute(text('DELETE FROM kiosk_manifests'))
+
+
+MIGRATIONS = [
+    ('0001_query_indexes', _0001_query_indexes),
+    ('0002_image_derivatives', _0002_image_derivatives),
+    ('0003_video_hls', _0003_video_hls),
+    ('0004_content_addressed_storage', _0004_content_addressed_storage),
+    ('0005_button_media_source', _0005_button_media_source),
+    ('0006_upload_job_ids', _0006_upload_job_ids),
+    ('0007_media_autoincrement', _0007_media_autoincrement),
+    ('0008_sha256_hashes', _0008_sha256_hashes),
+]
+
+
+def run_migrations(engine):
+    """Apply every migration not yet recorded in schema_migrations"""
+    with engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations (id TEXT PRIMARY KEY, applied_at DATETIME NOT NULL)'
+        ))
+        applied = {row[0] for row in conn.execute(text('SELECT id FROM schema_migrations'))}
+
+    for migration_id, migrate in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(
+                text('INSERT INTO schema_migrations (id, applied_at) VALUES (:id, :applied_at)'),
+                {'id': migration_id, 'applied_at': datetime.utcnow()}
+            )
+        print(f"Applied migration {migration_id}")
+
+
+# The statements the routes run most, written the way SQLAlchemy emits them
+HOT_QUERIES = [
+    ('subsections by section',
+     'SELECT * FROM subsection WHERE section_id = :v', 'ix_subsection_section_id'),
+    ('media by subsection',
+     'SELECT * FROM media WHERE subsection_id = :v', 'ix_media_subsection_type'),
+    ('media counts by subsection',
+     'SELECT subsection_id, type, count(id) FROM media GROUP BY subsection_id, type', 'ix_media_subsection_type'),
+    ('media counts for a section',
+     'SELECT subsection_id, type, count(id) FROM media WHERE subsection_id IN '
+     '(SELECT id FROM subsection WHERE section_id = :v) GROUP BY subsection_id, type', 'ix_media_subsection_type'),
+    ('media by title',
+     'SELECT * FROM media WHERE title = :v', 'ix_media_title'),
+    ('videos by kiosk',
+     'SELECT * FROM video WHERE kiosk_id = :v ORDER BY created_at DESC', 'ix_video_kiosk_created'),
+    ('buttons by video',
+     'SELECT * FROM button WHERE video_id = :v', 'ix_button_video_id'),
+    ('button by title (case insensitive)',
+     'SELECT * FROM button WHERE lower(button.title) = lower(:v) LIMIT 1', 'ix_button_title_lower'),
+    ('button media by button',
+     'SELECT * FROM button_media WHERE button_id = :v ORDER BY created_at DESC', 'ix_button_media_button_created'),
+    ('button media by title',
+     'SELECT * FROM button_media WHERE title = :v', 'ix_button_media_title'),
+    ('home media by home',
+     'SELECT * FROM home_media WHERE home_id = :v', 'ix_home_media_home_id'),
+    ('kiosks newest first',
+     'SELECT * FROM kiosk ORDER BY created_at DESC', 'ix_kiosk_created_at'),
+    ('homes newest first',
+     'SELECT * FROM homes ORDER BY created_at DESC', 'ix_homes_created_at'),
+    ('floor plans newest first',
+     'SELECT * FROM floor_plans ORDER BY created_at DESC', 'ix_floor_plans_created_at'),
+    ('floor plans by site dimension',
+     'SELECT * FROM floor_plans WHERE site_dimension = :v ORDER BY created_at DESC', 'ix_floor_plans_site_dimension'),
+    ('floor plans by facing',
+     'SELECT * FROM floor_plans WHERE facing = :v ORDER BY created_at DESC', 'ix_floor_plans_facing'),
+    ('floor plans by floors',
+     'SELECT * FROM floor_plans WHERE floors = :v ORDER BY created_at DESC', 'ix_floor_plans_floors'),
+    ('floor plans by type',
+     'SELECT * FROM floor_plans WHERE type = :v ORDER BY created_at DESC', 'ix_floor_plans_type'),
+]
+
+
+def check_query_plans(engine):
+    """
+    Run EXPLAIN QUERY PLAN for every hot query and return a list of
+    (name, plan) for the ones that don't use their expected index.
+    """
+    failures = []
+    with engine.connect() as conn:
+        for name, sql, index in HOT_QUERIES:
+            plan = ' / '.join(row[-1] for row in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'), {'v': ''}))
+            if f'INDEX {index}' not in plan:
+                failures.append((name, plan))
+    return failures
+
+
+if __name__ == '__main__':
+    from app import app
+    from models import db
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    with app.app_context():
+        if command == 'upgrade':
+            run_migrations(db.engine)
+        elif command == 'check':
+            failures = check_query_plans(db.engine)
+            for name, plan in failures:
+                print(f"{name}: no index used ({plan})")
+            if failures:
+                sys.exit(1)
+            print(f"All {len(HOT_QUERIES)} hot queries use an index")
+        else:
+            sys.exit(f"Unknown command: {command}")
@@ -18,12 +18,16 @@ class Subsection(db.Model):
 
 class Media(db.Model):
     """Media items (images, videos, PDFs) for subsections"""
+    # Never reuse a deleted row's id: ButtonMedia.source_media_id pairs are unique per button
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(db.Integer, primary_key=True)
     subsection_id = db.Column(db.Integer, db.ForeignKey('subsection.id'), nullable=False)
     type = db.Column(db.String(20), nullable=False)  # 'image', 'video', or 'pdf'
     file_path = db.Column(db.String(255), nullable=False)
     title = db.Column(db.String(100))
     description = db.Column(db.Text)
+    derivatives = db.Column(db.Text)  # Responsive image sizes (JSON, see image_derivatives.py)
     order = db.Column(db.Integer, default=0)  # For custom ordering of media
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -46,12 +50,17 @@ class Video(db.Model):
     title = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     file_path = db.Column(db.String(255), nullable=False)
+    hls_manifest = db.Column(db.Text)  # JSON describing the HLS renditions and poster, see transcode.py
+    upload_job_id = db.Column(db.String(32))  # Upload job that created this row, if any, see upload_jobs.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship with buttons
     buttons = db.relationship('Button', backref='video', lazy=True, cascade='all, delete-orphan')
 
+    # A retried upload job finds its row instead of inserting another
+    __table_args__ = (db.Index('ux_video_upload_job', 'upload_job_id', unique=True),)
+
 class Button(db.Model):
     """Buttons for videos"""
     id = db.Column(db.Integer, primary_key=True)
@@ -69,12 +78,22 @@ class ButtonMedia(db.Model):
     file_path = db.Column(db.String(255), nullable=False)
     title = db.Column(db.String(100))
     description = db.Column(db.Text)
+    derivatives = db.Column(db.Text)  # Responsive image sizes (JSON, see image_derivatives.py)
+    source_media_id = db.Column(db.Integer, db.ForeignKey('media.id', ondelete='SET NULL'))  # Media row this was mapped from, if any
+    upload_job_id = db.Column(db.String(32))  # Upload job that created this row, if any, see upload_jobs.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Relationship with Button
     button = db.relationship('Button', backref=db.backref('media_items', lazy=True, cascade='all, delete-orphan'))
 
+    # Mapping the same media onto a button twice is a no-op (see media_mapping.py), and a retried
+    # upload job finds its row instead of inserting another
+    __table_args__ = (
+        db.Index('ux_button_media_source', 'button_id', 'source_media_id', unique=True),
+        db.Index('ux_button_media_upload_job', 'upload_job_id', unique=True),
+    )
+
 class Home(db.Model):
     __tablename__ = 'homes'
     
@@ -91,6 +110,7 @@ class HomeMedia(db.Model):
     home_id = db.Column(db.Integer, db.ForeignKey('homes.id', ondelete='CASCADE'), nullable=False)
     media_type = db.Column(db.String(50), nullable=False)  # 'photo', 'floor_plan', 'isometric', 'video'
     file_path = db.Column(db.String(512), nullable=False)
+    derivatives = db.Column(db.Text)  # Responsive image sizes (JSON, see image_derivatives.py)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Relationship
@@ -106,6 +126,8 @@ class FloorPlan(db.Model):
     floors = db.Column(db.String(20), nullable=False)
     floor_plan_path = db.Column(db.String(500), nullable=False)
     elevation_path = db.Column(db.String(500), nullable=False)
+    floor_plan_derivatives = db.Column(db.Text)  # Responsive image sizes (JSON, see image_derivatives.py)
+    elevation_derivatives = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -120,4 +142,24 @@ class FloorPlan(db.Model):
             'elevation_path': self.elevation_path,
             'created_at': self.created_at,
             'updated_at': self.updated_at
-        } 
\ No newline at end of file
+        } 
+
+class MediaObject(db.Model):
+    """A stored media file: its size and content hash for manifests, and how many rows reference it"""
+    __tablename__ = 'media_objects'
+
+    file_path = db.Column(db.String(512), primary_key=True)
+    size = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64))
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Maintained by content_store.py
+    checked_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class KioskManifest(db.Model):
+    """Precomputed JSON manifest of everything a kiosk screen needs to play offline"""
+    __tablename__ = 'kiosk_manifests'
+
+    kiosk_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    etag = db.Column(db.String(64), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -0,0 +1,100 @@
+import base64
+import json
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import and_, or_, tuple_
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(created_at, id):
+    """Opaque cursor pointing just past the row (created_at, id)"""
+    raw = json.dumps([created_at.isoformat() if created_at else None, id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (created_at, id) a cursor points past, or None if no cursor was given"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return (datetime.fromisoformat(created_at) if created_at else None, int(id))
+    except (ValueError, TypeError):
+        raise PaginationError('Invalid cursor')
+
+
+def page_size(args):
+    """`limit` from the query string, defaulting to and capped at the configured sizes"""
+    max_size = current_app.config['API_MAX_PAGE_SIZE']
+    try:
+        limit = int(args.get('limit', current_app.config['API_DEFAULT_PAGE_SIZE']))
+    except ValueError:
+        raise PaginationError('limit must be an integer')
+    if limit < 1:
+        raise PaginationError('limit must be at least 1')
+    return min(limit, max_size)
+
+
+def parse_fields(args, allowed, default):
+    """Columns requested with `fields=a,b,c`; `id` is always included"""
+    value = args.get('fields')
+    if not value:
+        return list(default)
+    fields = [f.strip() for f in value.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise PaginationError(f"Unknown fields: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields
+
+
+def sort_key(created_at, id):
+    """
+    (created_at, id) as a key that sorts like SQLite's ORDER BY created_at, id:
+    rows without a created_at before every dated row, so they come last newest first
+    """
+    return (created_at is not None, created_at or datetime.min, id)
+
+
+def paginate_rows(rows, cursor, limit):
+    """
+    Keyset-paginate rows already sorted newest first by sort_key(created_at, id).
+    Returns (page, next_cursor); next_cursor is None on the last page.
+    """
+    if cursor is not None:
+        after = sort_key(*cursor)
+        rows = [row for row in rows if sort_key(row['created_at'], row['id']) < after]
+    page = rows[:limit + 1]
+    return _split_page(page, limit, lambda row: (row['created_at'], row['id']))
+
+
+def paginate_query(query, created_at_column, id_column, cursor, limit):
+    """
+    Keyset-paginate a SQLAlchemy query on (created_at, id), newest first,
+    with rows without a created_at last. The query must select both columns.
+    Returns (page, next_cursor).
+    """
+    if cursor is not None:
+        created_at, id = cursor
+        if created_at is None:
+            # Already into the undated rows at the end
+            query = query.filter(and_(created_at_column.is_(None), id_column < id))
+        else:
+            # A row-value comparison lets SQLite range-scan the (created_at, rowid) index;
+            # it's NULL for undated rows, which all come after any dated one
+            query = query.filter(or_(tuple_(created_at_column, id_column) < cursor, created_at_column.is_(None)))
+    # SQLite sorts NULLs first, so they're last descending, as sort_key has them
+    page = query.order_by(created_at_column.desc(), id_column.desc()).limit(limit + 1).all()
+    return _split_page(page, limit, lambda row: (getattr(row, created_at_column.key), getattr(row, id_column.key)))
+
+
+def _split_page(page, limit, key):
+    if len(page) <= limit:
+        return list(page), None
+    page = list(page[:limit])
+    return page, encode_cursor(*key(page[-1]))
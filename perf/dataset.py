@@ -0,0 +1,86 @@
+"""
+Seed the app's database and S3 bucket with a load-test catalog and write
+perf/dataset.json, which tells perf/locustfile.py what exists.
+
+    python perf/dataset.py [--scale 1000] [--seed 42] [--append] [--out perf/dataset.json]
+
+The catalog comes from seed_data.py (see there for sizes and distributions),
+with the placeholder files uploaded to S3, so run it with the environment
+perf/s3_local.py prints and, ideally, DATABASE_URL/SQLITE_DATABASE pointing
+at scratch files. dataset.json holds a sample of the seeded ids and titles
+(at most SAMPLE_SIZE of each), picked with the same seed.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app, sqlite_pool  # noqa: E402
+from models import db, Media, ButtonMedia, Button  # noqa: E402
+from seed_data import SeedError, seed, write_placeholders  # noqa: E402
+
+PERF_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_SIZE = 2000
+
+
+def _ids(ranges, table):
+    first, count = ranges[table]
+    return range(first, first + count)
+
+
+def _sample(rng, values):
+    values = list(values)
+    return sorted(rng.sample(values, min(len(values), SAMPLE_SIZE)))
+
+
+def _distinct(rng, column, first_id, model):
+    return _sample(rng, (value for value, in db.session.query(column).filter(model.id >= first_id).distinct()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--append', action='store_true')
+    parser.add_argument('--out', default=os.path.join(PERF_DIR, 'dataset.json'))
+    args = parser.parse_args()
+
+    if not app.config['S3_BUCKET']:
+        sys.exit('S3_BUCKET and S3_LOCATION must be set (see perf/s3_local.py)')
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        placeholders = write_placeholders(app, args.seed)
+        try:
+            ranges = seed(app, sqlite_pool, args.scale, args.seed, upload=True, append=args.append,
+                          placeholders=placeholders)
+        except SeedError as e:
+            sys.exit(str(e))
+
+        dataset = {
+            'seed': args.seed,
+            'scale': args.scale,
+            'kiosk_ids': _sample(rng, _ids(ranges, 'kiosk')),
+            'button_ids': _sample(rng, _ids(ranges, 'button')),
+            'subsection_ids': _sample(rng, _ids(ranges, 'subsection')),
+            'home_ids': _sample(rng, _ids(ranges, 'homes')),
+            'media_titles': _distinct(rng, Media.title, ranges['media'][0], Media),
+            'button_media_titles': _distinct(rng, ButtonMedia.title, ranges['button_media'][0], ButtonMedia),
+            'button_titles': _distinct(rng, Button.title, ranges['button'][0], Button),
+            # Keys under S3_LOCATION, for /media/<key>
+            'image_keys': [item['key'] for item in placeholders['image']],
+            'video_keys': [item['key'] for item in placeholders['video']],
+            'upload_files': [item['path'] for item in placeholders['image']],
+            # Paths under UPLOAD_FOLDER, for /uploads/<path>
+            'upload_names': [item['name'] for kind in ('image', 'pdf') for item in placeholders[kind]],
+        }
+
+    with open(args.out, 'w') as f:
+        json.dump(dataset, f, indent=2)
+    print(f"Seeded scale {args.scale}: {ranges['kiosk'][1]} kiosks, {ranges['button'][1]} buttons; wrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,189 @@
-from locust import HttpUser, task, between
+"""
+Load test of the showroom, kiosk and admin traffic.
 
-class FloorPlanUser(HttpUser):
-    wait_time = between(1, 2)  # simulate wait time between requests
+    python perf/s3_local.py                     # terminal 1: S3 stand-in, prints the env to export
+    export DATABASE_URL=sqlite:////tmp/loadtest.db SQLITE_DATABASE=/tmp/loadtest_raw.db
+    python perf/dataset.py --scale 100000       # with that env: seed a scratch catalog
+    gunicorn -w 4 -k gthread --threads 8 --keep-alive 10 -b 127.0.0.1:5000 app:app   # (same env)
+    locust -f perf/locustfile.py --host http://127.0.0.1:5000 --headless \\
+        -u 100 -r 10 -t 5m --csv perf/results/run1
+    python perf/report.py perf/results/run1_stats.csv --baseline perf/results/run0_stats.csv
 
-    @task
-    def show_featured_plans(self):
-        self.client.get("/uploads/el_2_1743749885_DSC_2562.JPG")
+Requests are named by endpoint (e.g. /api/kiosks/[id]/tree), so each
+endpoint is one row in the stats whatever ids and filters were used. Every
+user picks ids and titles from perf/dataset.json (or $LOADTEST_DATASET),
+seeded from the same random seed, so two runs against the same dataset send
+the same mix. Keep gunicorn's keep-alive above the users' wait times, or
+reused connections get reset by the server closing them.
+"""
+import io
+import json
+import os
+import random
+import sys
+
+from locust import HttpUser, between, events, task
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from constants import FACING_OPTIONS, PLAN_TYPES, FLOOR_COUNT_OPTIONS, SITE_DIMENSIONS  # noqa: E402
+
+DATASET_PATH = os.environ.get('LOADTEST_DATASET', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset.json'))
+SEED = int(os.environ.get('LOADTEST_SEED', 42))
+
+# Plan search filters and the probability a shopper sets each one
+SEARCH_FACETS = [
+    ('site_dimension', SITE_DIMENSIONS, 0.6),
+    ('facing', FACING_OPTIONS, 0.5),
+    ('use_type', PLAN_TYPES, 0.3),
+    ('floors', FLOOR_COUNT_OPTIONS, 0.3),
+]
+VIDEO_RANGE_BYTES = 512 * 1024
+
+dataset = None
+_user_seeds = random.Random(SEED)
+
+
+@events.init.add_listener
+def load_dataset(environment, **kwargs):
+    global dataset
+    with open(DATASET_PATH) as f:
+        dataset = json.load(f)
+
+
+class CatalogUser(HttpUser):
+    abstract = True
+
+    def on_start(self):
+        self.rng = random.Random(_user_seeds.random())
+
+
+class ShowroomUser(CatalogUser):
+    """A shopper on the showroom screens: faceted plan search, the featured feed, elevation images and local uploads"""
+    weight = 6
+    wait_time = between(1, 3)
+
+    @task(5)
+    def search_plans(self):
+        params = {name: self.rng.choice(values) for name, values, p in SEARCH_FACETS if self.rng.random() < p}
+        response = self.client.get('/api/floor-plans/search', params=params, name='/api/floor-plans/search')
+        if response.ok and self.rng.random() < 0.3:
+            self._next_page('/api/floor-plans/search', params, response)
+
+    @task(3)
+    def featured_feed(self):
+        params = {'limit': 20}
+        response = self.client.get('/api/floor-plans/featured', params=params, name='/api/floor-plans/featured')
+        if response.ok and self.rng.random() < 0.5:
+            self._next_page('/api/floor-plans/featured', params, response)
+
+    @task(4)
+    def view_elevation(self):
+        key = self.rng.choice(dataset['image_keys'])
+        self.client.get(f"/media/{key}", name='/media/[image]')
+
+    @task(4)
+    def view_upload(self):
+        # Files served from UPLOAD_FOLDER by /uploads/<path> (sendfile or the front server)
+        self.client.get(f"/uploads/{self.rng.choice(dataset['upload_names'])}", name='/uploads/[file]')
+
+    @task(1)
+    def browse_homes(self):
+        self.client.get(f"/api/homes/{self.rng.choice(dataset['home_ids'])}", name='/api/homes/[id]')
+
+    def _next_page(self, path, params, response):
+        cursor = response.json().get('next_cursor')
+        if cursor:
+            self.client.get(path, params=dict(params, cursor=cursor), name=f"{path} (next page)")
+
+
+class KioskUser(CatalogUser):
+    """A kiosk screen: polls its manifest, loads its tree, opens buttons and streams video by range"""
+    weight = 3
+    wait_time = between(2, 5)
+
+    def on_start(self):
+        super().on_start()
+        self.kiosk_id = self.rng.choice(dataset['kiosk_ids'])
+        self.manifest_etag = None
+
+    @task(4)
+    def poll_manifest(self):
+        headers = {'If-None-Match': self.manifest_etag} if self.manifest_etag else {}
+        with self.client.get(f"/api/kiosks/{self.kiosk_id}/manifest", headers=headers,
+                             name='/api/kiosks/[id]/manifest', catch_response=True) as response:
+            if response.status_code in (200, 304):
+                self.manifest_etag = response.headers.get('ETag', self.manifest_etag)
+                response.success()
+
+    @task(2)
+    def load_tree(self):
+        self.client.get(f"/api/kiosks/{self.kiosk_id}/tree", name='/api/kiosks/[id]/tree')
+
+    @task(4)
+    def open_button(self):
+        self.client.get(f"/api/buttons/{self.rng.choice(dataset['button_ids'])}/media", name='/api/buttons/[id]/media')
+
+    @task(3)
+    def stream_video(self):
+        # Players fetch the start, then seek
+        start = self.rng.choice([0, 0, self.rng.randrange(0, 4 * VIDEO_RANGE_BYTES)])
+        headers = {'Range': f"bytes={start}-{start + VIDEO_RANGE_BYTES - 1}"}
+        with self.client.get(f"/media/{self.rng.choice(dataset['video_keys'])}", headers=headers,
+                             name='/media/[video] (range)', catch_response=True) as response:
+            if response.status_code in (200, 206, 416):
+                response.success()
+
+
+class AdminUser(CatalogUser):
+    """Staff managing content: batch uploads, bulk title edits and mapping media onto kiosk buttons"""
+    weight = 1
+    wait_time = between(3, 8)
+
+    def _files(self, count):
+        # Mostly new content; sometimes an exact re-upload, which is stored already
+        files = []
+        for n in range(count):
+            path = self.rng.choice(dataset['upload_files'])
+            with open(path, 'rb') as f:
+                data = f.read()
+            if self.rng.random() < 0.8:
+                data += self.rng.randbytes(16)  # Trailing bytes after the JPEG end marker still decode
+            files.append(('files[]', (f"upload_{n}.jpg", io.BytesIO(data), 'image/jpeg')))
+        return files
+
+    @task(2)
+    def upload_media_batch(self):
+        self.client.post('/api/media/batch', files=self._files(self.rng.randint(1, 4)), data={
+            'subsection_id': self.rng.choice(dataset['subsection_ids']),
+            'title': self.rng.choice(dataset['media_titles']),
+            'description': 'Uploaded by the load test'
+        }, name='/api/media/batch')
+
+    @task(1)
+    def upload_button_media_batch(self):
+        self.client.post('/api/button-media/batch', files=self._files(self.rng.randint(1, 3)), data={
+            'button_id': self.rng.choice(dataset['button_ids']),
+            'title': self.rng.choice(dataset['button_media_titles']),
+            'description': 'Uploaded by the load test'
+        }, name='/api/button-media/batch')
+
+    @task(2)
+    def update_titles(self):
+        # Titles stay the same so other users keep finding them; the rows are still all rewritten
+        title = self.rng.choice(dataset['media_titles'])
+        self.client.put('/api/media/update-title', json={
+            'original_title': title, 'new_title': title, 'description': f"Edited {self.rng.randrange(10**6)}"
+        }, name='/api/media/update-title')
+        title = self.rng.choice(dataset['button_media_titles'])
+        self.client.put('/api/button-media/update-title', json={
+            'original_title': title, 'new_title': title, 'new_description': f"Edited {self.rng.randrange(10**6)}"
+        }, name='/api/button-media/update-title')
+
+    @task(2)
+    def map_toggle(self):
+        # Map then unmap, so button media doesn't grow without bound over a long run
+        payload = {'title': self.rng.choice(dataset['media_titles']),
+                   'subsection_name': self.rng.choice(dataset['button_titles'])}
+        for action in ('map', 'unmap'):
+            self.client.post('/api/media/map-toggle', json=dict(payload, action=action),
+                             name=f"/api/media/map-toggle ({action})")
@@ -0,0 +1,30 @@
+"""
+Render every page against a seeded catalog and fail on query budget overruns.
+
+    python perf/query_budget_check.py [--scale 1000] [--growth 4] [pytest options...]
+
+Runs tests/test_query_budgets.py (see there for what is checked) at the
+given catalog sizes; the exit status is pytest's.
+"""
+import argparse
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scale', type=int, default=1000, help='catalog size for the first pass')
+    parser.add_argument('--growth', type=int, default=4, help='catalog appended for the second pass, as a multiple of --scale')
+    args, pytest_args = parser.parse_known_args()
+
+    os.environ['QUERY_BUDGET_SCALE'] = str(args.scale)
+    os.environ['QUERY_BUDGET_GROWTH'] = str(args.growth)
+    sys.exit(pytest.main([os.path.join(ROOT_DIR, 'tests', 'test_query_budgets.py'), '-q', *pytest_args]))
+
+
+if __name__ == '__main__':
+    main()
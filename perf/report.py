@@ -0,0 +1,78 @@
+"""
+p50/p95/p99 per endpoint from a locust run, optionally against a baseline run.
+
+    python perf/report.py perf/results/run1_stats.csv [--baseline perf/results/run0_stats.csv]
+
+Reads the *_stats.csv that `locust --csv <prefix>` writes. With --baseline,
+each percentile is followed by its change from the baseline, and endpoints
+that only appear in one of the runs are marked. Times are milliseconds.
+"""
+import argparse
+import csv
+
+PERCENTILES = ('50%', '95%', '99%')
+
+
+def load(path):
+    """{(method, name): row} for every endpoint in a locust stats CSV, plus the aggregate"""
+    with open(path, newline='') as f:
+        return {(row['Type'], row['Name']): row for row in csv.DictReader(f)}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cell(value, baseline):
+    value = _number(value)
+    if value is None:
+        return f"{'-':>8}{'':>9}"
+    if baseline is None:
+        return f"{value:>8,.0f}{'':>9}"
+    base = _number(baseline)
+    if not base:
+        return f"{value:>8,.0f}{'':>9}"
+    return f"{value:>8,.0f}{(value - base) / base:>+9.0%}"
+
+
+def report(run, baseline=None):
+    lines = []
+    width = max([len(f"{method} {name}") for method, name in run] + [20])
+    header = f"{'endpoint':<{width}} {'requests':>9} {'fail':>6}"
+    for percentile in PERCENTILES:
+        header += f" {'p' + percentile.rstrip('%'):>8}{'(vs base)' if baseline else '':>9}"
+    lines.append(header)
+
+    # The Aggregated row goes last
+    keys = sorted(run, key=lambda key: (key[1] == 'Aggregated', key[1], key[0]))
+    for key in keys:
+        row = run[key]
+        base = baseline.get(key) if baseline else None
+        label = f"{key[0]} {key[1]}".strip()
+        line = f"{label:<{width}} {int(row['Request Count']):>9,} {int(row['Failure Count']):>6,}"
+        for percentile in PERCENTILES:
+            line += f" {_cell(row[percentile], base[percentile] if base else None)}"
+        if baseline is not None and base is None:
+            line += '  (new)'
+        lines.append(line)
+
+    if baseline:
+        for key in sorted(set(baseline) - set(run), key=lambda key: key[1]):
+            lines.append(f"{f'{key[0]} {key[1]}'.strip():<{width}} (only in baseline)")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('stats', help='*_stats.csv of the run to report')
+    parser.add_argument('--baseline', help='*_stats.csv of an earlier run to compare against')
+    args = parser.parse_args()
+
+    print(report(load(args.stats), load(args.baseline) if args.baseline else None))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+A local stand-in for S3, so the load suite runs offline.
+
+    python perf/s3_local.py [--port 5100] [--bucket loadtest]
+
+Runs moto's S3 server (pip install "moto[server]") in the foreground with the
+bucket created, and prints the environment the app and perf/dataset.py need
+to use it instead of AWS. boto3 finds the server through AWS_ENDPOINT_URL_S3;
+S3_LOCATION is path-style, so the file_path URLs stored on rows, and the /media
+cache's upstream fetches of them, resolve against it as well.
+"""
+import argparse
+import logging
+import time
+
+import boto3
+
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+
+def environment(port, bucket):
+    endpoint = f"http://127.0.0.1:{port}"
+    return {
+        'AWS_ENDPOINT_URL_S3': endpoint,
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'S3_KEY': 'loadtest',
+        'S3_SECRET': 'loadtest',
+        'S3_BUCKET': bucket,
+        'S3_LOCATION': f"{endpoint}/{bucket}/",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--bucket', default='loadtest')
+    args = parser.parse_args()
+
+    if ThreadedMotoServer is None:
+        parser.exit(1, 'moto is not installed: pip install "moto[server]"\n')
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No line per request
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=args.port, verbose=False)
+    server.start()
+    env = environment(args.port, args.bucket)
+    boto3.client(
+        's3', endpoint_url=env['AWS_ENDPOINT_URL_S3'], region_name=env['AWS_DEFAULT_REGION'],
+        aws_access_key_id=env['S3_KEY'], aws_secret_access_key=env['S3_SECRET']
+    ).create_bucket(Bucket=args.bucket)
+
+    print('S3 stand-in running; in the shells for the app and perf/dataset.py:')
+    for key, value in env.items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
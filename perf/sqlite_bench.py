@@ -0,0 +1,125 @@
+"""
+Read throughput of SQLite while another process is writing, with the default
+rollback journal versus the pragmas from sqlite_config.DEFAULT_PRAGMAS.
+
+    python perf/sqlite_bench.py [--readers 4] [--seconds 5] [--rows 20000]
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlite_config import DEFAULT_PRAGMAS, apply_pragmas  # noqa: E402
+
+FACINGS = ['North', 'South', 'East', 'West']
+
+
+def connect(path, pragmas):
+    conn = sqlite3.connect(path)
+    apply_pragmas(conn, pragmas)
+    return conn
+
+
+def seed(path, rows):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+    CREATE TABLE floor_plans (
+        id INTEGER PRIMARY KEY,
+        site_dimension TEXT NOT NULL,
+        facing TEXT NOT NULL,
+        floor_plan_path TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+    conn.execute('CREATE INDEX ix_floor_plans_facing ON floor_plans (facing, created_at)')
+    conn.executemany(
+        'INSERT INTO floor_plans (site_dimension, facing, floor_plan_path, created_at) VALUES (?, ?, ?, ?)',
+        ((f'{30 + i % 5 * 10} X 40', FACINGS[i % 4], f'https://bucket.s3.amazonaws.com/{i}.jpg', i)
+         for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def writer(path, pragmas, stop):
+    conn = connect(path, pragmas)
+    i = 0
+    while not stop.is_set():
+        try:
+            with conn:
+                for _ in range(50):
+                    conn.execute(
+                        'INSERT INTO floor_plans (site_dimension, facing, floor_plan_path, created_at) '
+                        'VALUES (?, ?, ?, ?)', ('30 X 40', FACINGS[i % 4], 'new.jpg', time.time())
+                    )
+                    i += 1
+        except sqlite3.OperationalError:
+            pass
+    conn.close()
+
+
+def reader(path, pragmas, stop, results):
+    conn = connect(path, pragmas)
+    reads = errors = 0
+    i = 0
+    while not stop.is_set():
+        try:
+            conn.execute(
+                'SELECT * FROM floor_plans WHERE facing = ? ORDER BY created_at DESC LIMIT 50',
+                (FACINGS[i % 4],)
+            ).fetchall()
+            reads += 1
+        except sqlite3.OperationalError:
+            errors += 1
+        i += 1
+    conn.close()
+    results.put((reads, errors))
+
+
+def run(label, pragmas, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        seed(path, args.rows)
+        if pragmas:
+            # journal_mode=WAL is persistent, so set it once before the workers start
+            connect(path, pragmas).close()
+
+        stop = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=writer, args=(path, pragmas, stop))]
+        processes += [multiprocessing.Process(target=reader, args=(path, pragmas, stop, results))
+                      for _ in range(args.readers)]
+        for process in processes:
+            process.start()
+        time.sleep(args.seconds)
+        stop.set()
+
+        reads = errors = 0
+        for _ in range(args.readers):
+            r, e = results.get()
+            reads += r
+            errors += e
+        for process in processes:
+            process.join()
+
+    print(f"{label:<10} {reads / args.seconds:>12,.0f} reads/s {errors:>8} locked errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--rows', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{args.readers} reader processes, 1 writer, {args.seconds}s, {args.rows} rows")
+    run('default', {}, args)
+    run('tuned', DEFAULT_PRAGMAS, args)
+
+
+if __name__ == '__main__':
+    main()
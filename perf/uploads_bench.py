@@ -0,0 +1,150 @@
+"""
+Requests/s for /uploads/<path>: the old send_from_directory handler versus
+static_serving.serve_upload in each UPLOADS_SERVE_MODE, plus the 304 a
+revalidating client gets.
+
+    python perf/uploads_bench.py [--clients 8] [--seconds 5] [--size-kb 512]
+
+Runs the server under gunicorn (gthread workers, which use os.sendfile for the
+WSGI file wrapper) when it is installed, otherwise Werkzeug's threaded server,
+which copies the file through Python either way. The x-accel and x-sendfile
+rows measure only the app's side of the offload; the proxy then sends the file.
+The benchmarked file has a timestamped legacy name, so it gets a short max-age
+and the 304 row is what its repeat views cost. Content-addressed objects are
+served from /media as immutable, so a browser that has one sends no request at
+all, which no row here can show.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from flask import Flask, send_from_directory  # noqa: E402
+from static_serving import serve_upload  # noqa: E402
+
+# The file perf/locustfile.py requests
+FILENAME = 'el_2_1743749885_DSC_2562.JPG'
+PORT = 5099
+
+
+def make_app(upload_dir, mode):
+    app = Flask(__name__)
+    app.config.update(UPLOADS_SERVE_MODE=mode, UPLOADS_ACCEL_PREFIX='/_uploads/', UPLOADS_MAX_AGE=3600,
+                      COMPRESS_MIMETYPES=set(), COMPRESS_MIN_SIZE=1024, COMPRESS_GZIP_LEVEL=6)
+
+    @app.route('/before/<path:filename>')
+    def before(filename):
+        return send_from_directory(upload_dir, filename)
+
+    @app.route('/uploads/<path:filename>')
+    def uploaded_file(filename):
+        return serve_upload(upload_dir, filename)
+
+    return app
+
+
+def serve(upload_dir, mode, threads):
+    app = make_app(upload_dir, mode)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        from werkzeug.serving import make_server
+        make_server('127.0.0.1', PORT, app, threaded=True).serve_forever()
+        return
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in {'bind': f'127.0.0.1:{PORT}', 'workers': 1, 'worker_class': 'gthread',
+                               'threads': threads, 'loglevel': 'warning', 'keepalive': 5}.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
+def client(path, headers, stop, counts):
+    conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+    done = received = 0
+    while not stop.is_set():
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        received += len(response.read())
+        if response.status not in (200, 304):
+            raise RuntimeError(f"{path}: HTTP {response.status}")
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+        done += 1
+    conn.close()
+    counts.append((done, received))
+
+
+def wait_for_server():
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection('127.0.0.1', PORT, timeout=1).request('HEAD', '/')
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Server did not start')
+
+
+def run(label, upload_dir, mode, path, args, revalidate=False):
+    server = multiprocessing.Process(target=serve, args=(upload_dir, mode, args.clients), daemon=True)
+    server.start()
+    try:
+        wait_for_server()
+        headers = {}
+        if revalidate:
+            conn = http.client.HTTPConnection('127.0.0.1', PORT)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            headers['If-None-Match'] = response.getheader('ETag')
+            conn.close()
+
+        stop = threading.Event()
+        counts = []
+        clients = [threading.Thread(target=client, args=(path, headers, stop, counts)) for _ in range(args.clients)]
+        for thread in clients:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in clients:
+            thread.join()
+    finally:
+        server.terminate()
+        server.join()
+
+    requests = sum(done for done, _ in counts)
+    received = sum(size for _, size in counts)
+    print(f"{label:<28} {requests / args.seconds:>10,.0f} req/s {received / args.seconds / 2**20:>10,.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--size-kb', type=int, default=512)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as upload_dir:
+        with open(os.path.join(upload_dir, FILENAME), 'wb') as f:
+            f.write(os.urandom(args.size_kb * 1024))
+
+        print(f"{args.clients} keep-alive clients, {args.seconds}s, {args.size_kb}KB file")
+        run('before (send_from_directory)', upload_dir, 'sendfile', f'/before/{FILENAME}', args)
+        run('sendfile', upload_dir, 'sendfile', f'/uploads/{FILENAME}', args)
+        run('sendfile, revalidated (304)', upload_dir, 'sendfile', f'/uploads/{FILENAME}', args, revalidate=True)
+        run('x-accel (app side only)', upload_dir, 'x-accel', f'/uploads/{FILENAME}', args)
+        run('x-sendfile (app side only)', upload_dir, 'x-sendfile', f'/uploads/{FILENAME}', args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""
+Per-request instrumentation.
+
+Every request records its wall time, the number and total time of SQL
+statements (SQLAlchemy cursor events), the number and time of S3 calls
+(botocore events on app.s3, plus the upstream session behind /media) and its
+response size, per endpoint. An N+1 regression shows up as a jump in
+db_queries_per_request for its endpoint.
+
+/metrics serves the totals in Prometheus text format. Each worker writes its
+own to METRICS_DIR at most every METRICS_FLUSH_SECONDS and /metrics sums the
+files of the workers that are still alive, so whichever worker answers the
+scrape reports for all of them.
+
+With PROFILE_SLOW_MS set, requests (a PROFILE_SAMPLE_RATE fraction of them)
+run under pyinstrument, or cProfile when it isn't installed, and any that
+take longer than the threshold leave a profile in PROFILE_DIR (.html from
+pyinstrument, .prof for `python -m pstats` / snakeviz). cProfile slows
+requests down noticeably; pyinstrument samples and costs little.
+
+Responses also carry a Server-Timing header (db, s3, total), which browser
+dev tools show next to each request. Times are to the end of the view; the
+body of a streamed response isn't included.
+"""
+import cProfile
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # cProfile instead
+    Profiler = None
+
+STATS_KEY = '_request_stats'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# name -> (type, help, label names, histogram buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled', ('endpoint', 'method', 'status'), None),
+    'http_request_duration_seconds': ('histogram', 'Wall time per request', ('endpoint',), DURATION_BUCKETS),
+    'http_response_bytes_total': ('counter', 'Response body bytes (when the length is known)', ('endpoint',), None),
+    'db_queries_per_request': ('histogram', 'SQL statements per request', ('endpoint',), QUERY_BUCKETS),
+    'db_query_duration_seconds_total': ('counter', 'Time spent in SQL statements', ('endpoint',), None),
+    's3_calls_total': ('counter', 'S3 API and upstream fetches', ('endpoint',), None),
+    's3_duration_seconds_total': ('counter', 'Time spent waiting on S3', ('endpoint',), None),
+}
+
+
+class RequestStats:
+    """What one request spent, filled in by the event hooks"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.s3_calls = 0
+        self.s3_time = 0.0
+        self.profiler = None
+        self.statements = None  # Counter of SQL text when query budgets are checked
+
+
+def current_stats():
+    """The running request's RequestStats, or None outside a request (e.g. worker threads)"""
+    if has_request_context():
+        return g.get(STATS_KEY)
+    return None
+
+
+def record_s3_call(seconds):
+    stats = current_stats()
+    if stats is not None:
+        stats.s3_calls += 1
+        stats.s3_time += seconds
+
+
+class RequestMetrics:
+    """This worker's metric values, flushed to METRICS_DIR for /metrics to merge"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.values = {}  # (name, labels) -> number, or [bucket counts..., sum, count] for histograms
+        self._dirty = False
+        self._flusher_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['METRICS_DIR']
+        self.flush_seconds = app.config['METRICS_FLUSH_SECONDS']
+        self.slow_ms = app.config['PROFILE_SLOW_MS']
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.profile_dir = app.config['PROFILE_DIR']
+        os.makedirs(self.directory, exist_ok=True)
+        if self.slow_ms is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._stop_profiler)
+        app.s3.meta.events.register('before-call.s3', _before_s3_call)
+        app.s3.meta.events.register('after-call.s3', _after_s3_call)
+        app.extensions['request_metrics'] = self
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            key = (name, labels)
+            self.values[key] = self.values.get(key, 0) + amount
+            self._dirty = True
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][3]
+        with self._lock:
+            key = (name, labels)
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            self._dirty = True
+
+    def _start(self):
+        stats = g.setdefault(STATS_KEY, RequestStats())
+        if self.slow_ms is not None and random.random() < self.sample_rate:
+            stats.profiler = _start_profiler()
+
+    def _finish(self, response):
+        stats = g.get(STATS_KEY)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+
+        self.inc('http_requests_total', (endpoint, request.method, str(response.status_code)))
+        self.observe('http_request_duration_seconds', (endpoint,), elapsed)
+        self.observe('db_queries_per_request', (endpoint,), stats.queries)
+        self.inc('db_query_duration_seconds_total', (endpoint,), stats.query_time)
+        if stats.s3_calls:
+            self.inc('s3_calls_total', (endpoint,), stats.s3_calls)
+            self.inc('s3_duration_seconds_total', (endpoint,), stats.s3_time)
+        if response.content_length is not None:
+            self.inc('http_response_bytes_total', (endpoint,), response.content_length)
+
+        response.headers['Server-Timing'] = (
+            f"db;desc=\"{stats.queries} queries\";dur={stats.query_time * 1000:.1f}, "
+            f"s3;desc=\"{stats.s3_calls} calls\";dur={stats.s3_time * 1000:.1f}, "
+            f"total;dur={elapsed * 1000:.1f}"
+        )
+
+        profiler = self._stop_profiler()
+        if profiler is not None and elapsed * 1000 >= self.slow_ms:
+            self._dump_profile(profiler, stats, endpoint, elapsed)
+
+        self._ensure_flusher()
+        return response
+
+    def _stop_profiler(self, exc=None):
+        stats = g.get(STATS_KEY)
+        if stats is None or stats.profiler is None:
+            return None
+        profiler, stats.profiler = stats.profiler, None
+        if Profiler is not None:
+            profiler.stop()
+        else:
+            profiler.disable()
+        return profiler
+
+    def _dump_profile(self, profiler, stats, endpoint, elapsed):
+        safe_endpoint = re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint)
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S}_{request.method}_{safe_endpoint}_{elapsed * 1000:.0f}ms_{os.getpid()}"
+        if Profiler is not None:
+            path = os.path.join(self.profile_dir, f"{name}.html")
+            with open(path, 'w') as f:
+                f.write(profiler.output_html())
+        else:
+            path = os.path.join(self.profile_dir, f"{name}.prof")
+            profiler.dump_stats(path)
+        current_app.logger.warning(
+            f"Slow request {request.method} {request.full_path} took {elapsed * 1000:.0f}ms "
+            f"({stats.queries} queries in {stats.query_time * 1000:.0f}ms, "
+            f"{stats.s3_calls} S3 calls in {stats.s3_time * 1000:.0f}ms); profile: {path}"
+        )
+
+    def _ensure_flusher(self):
+        # One thread per worker process, started by its first request (threads don't survive a fork)
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, name='metrics-flush', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            if self._dirty:
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Could not write metrics: {e}")
+            time.sleep(self.flush_seconds)
+
+    def flush(self):
+        """Write this worker's values to METRICS_DIR"""
+        with self._lock:
+            values = [[name, list(labels), value] for (name, labels), value in self.values.items()]
+            self._dirty = False
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(values, f)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """Sum the flushed values of every live worker, dropping files left by dead ones"""
+        self.flush()
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            pid = int(os.path.basename(path).split('.')[0])
+            if not _alive(pid):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    values = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in values:
+                key = (name, tuple(labels))
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    merged[key] = [a + b for a, b in zip(total, value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format"""
+        merged = self.collect()
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(merged.items()):
+                if metric != name:
+                    continue
+                label_text = ','.join(f'{label}="{_escape(v)}"' for label, v in zip(label_names, labels))
+                if kind != 'histogram':
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                    continue
+                for bound, count in zip(buckets + ('+Inf',), value[:len(buckets)] + [value[-1]]):
+                    lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {count}')
+                lines.append(f"{name}_sum{{{label_text}}} {value[-2]}")
+                lines.append(f"{name}_count{{{label_text}}} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def get_request_metrics():
+    return current_app.extensions['request_metrics']
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _start_profiler():
+    if Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # Another thread's profiler is active (one at a time on Python 3.12+)
+        return None
+    return profiler
+
+
+def _before_s3_call(context, **kwargs):
+    context['profiling_started'] = time.perf_counter()
+
+
+def _after_s3_call(context, **kwargs):
+    started = context.get('profiling_started')
+    if started is not None:
+        record_s3_call(time.perf_counter() - started)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is not None:
+        conn.info.setdefault('profiling_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = conn.info.get('profiling_started')
+    if stats is not None and started:
+        stats.queries += 1
+        stats.query_time += time.perf_counter() - started.pop()
+        if stats.statements is not None:
+            stats.statements[statement] += 1
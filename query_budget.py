@@ -0,0 +1,104 @@
+"""
+Query budgets: the most SQL statements a route may run per request.
+
+Views declare theirs with @query_budget(n), placed directly under the
+route decorator; the rest get QUERY_BUDGET_DEFAULT. A budget is a constant,
+so a route that starts running a statement per row (a lazy-loaded
+relationship in a loop) goes over it once there are enough rows.
+
+QUERY_BUDGET_MODE decides what happens to a request over budget:
+
+    off     nothing is checked (the default)
+    warn    a warning is logged with the statements that repeated
+    strict  QueryBudgetExceeded is raised, which fails the request (and,
+            with app.testing, surfaces in the test client)
+
+perf/query_budget_check.py renders every page against a seeded catalog in
+strict mode, at two catalog sizes, and fails when a route goes over budget
+or its statement count grows with the catalog.
+"""
+import re
+from collections import Counter
+from flask import current_app, request
+
+from profiling import current_stats
+
+MODES = ('off', 'warn', 'strict')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more SQL statements than its route's budget"""
+
+    def __init__(self, endpoint, queries, budget, shapes):
+        self.endpoint = endpoint
+        self.queries = queries
+        self.budget = budget
+        self.shapes = shapes
+        super().__init__(format_report(endpoint, queries, budget, shapes))
+
+
+def query_budget(max_queries):
+    """Declare the most SQL statements a view may run per request"""
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+def budget_for(endpoint, app=None):
+    app = app or current_app
+    view = app.view_functions.get(endpoint)
+    return getattr(view, 'query_budget', app.config['QUERY_BUDGET_DEFAULT'])
+
+
+def statement_shape(statement):
+    """SQL text with whitespace collapsed and expanded IN lists folded, so repeats group together"""
+    shape = ' '.join(statement.split())
+    return re.sub(r'\(\?(?:, \?)+\)', '(?, ...)', shape)
+
+
+def repeated_shapes(statements):
+    """[(count, shape)] of the statement shapes run more than once, most repeated first"""
+    shapes = Counter()
+    for statement, count in statements.items():
+        shapes[statement_shape(statement)] += count
+    return [(count, shape) for shape, count in shapes.most_common() if count > 1]
+
+
+def format_report(endpoint, queries, budget, shapes):
+    lines = [f"{endpoint} ran {queries} SQL statements, over its budget of {budget}"]
+    for count, shape in shapes[:5]:
+        lines.append(f"  {count} x {shape[:200]}")
+    return '\n'.join(lines)
+
+
+def init_app(app):
+    """Count statements per request and check them against the route's budget"""
+    mode = app.config['QUERY_BUDGET_MODE']
+    if mode not in MODES:
+        raise ValueError(f"QUERY_BUDGET_MODE must be one of {', '.join(MODES)}, not {mode!r}")
+    if mode == 'off':
+        return
+
+    # Registered after RequestMetrics, so its before_request has made the stats
+    # and this after_request runs before its own
+    @app.before_request
+    def _record_statements():
+        stats = current_stats()
+        if stats is not None:
+            stats.statements = Counter()
+
+    @app.after_request
+    def _check_budget(response):
+        stats = current_stats()
+        if stats is None or stats.statements is None or request.endpoint is None:
+            return response
+        budget = budget_for(request.endpoint)
+        if budget is None or stats.queries <= budget:
+            return response
+
+        shapes = repeated_shapes(stats.statements)
+        if mode == 'strict':
+            raise QueryBudgetExceeded(request.endpoint, stats.queries, budget, shapes)
+        current_app.logger.warning(format_report(request.endpoint, stats.queries, budget, shapes))
+        return response
@@ -0,0 +1,430 @@
+"""
+Response cache for read-heavy JSON endpoints.
+
+Views decorated with @cached store their response body under the request path
+and query string, tagged with the rows it was built from ('subsection:5',
+'homes:2', or a bare table name for whole-table listings). When a session
+commits, every inserted, updated or deleted row purges its own tags plus the
+tags of the rows its foreign keys point at, so a new Media row for subsection 5
+drops /api/subsections/5/media and nothing else.
+
+Bodies at least COMPRESS_MIN_SIZE long are stored with pre-compressed gzip
+(and brotli, when installed) variants, so a hit costs no encoding work at all.
+
+Two backends:
+- 'memory': per-process LRU with TTL (the default). Purges reach the other
+  worker processes through an InvalidationLog in RESPONSE_CACHE_DB, which
+  every worker replays before serving a hit
+- 'sqlite': a shared SQLite file, so every worker sees the same entries and
+  an edit served by one worker purges the cache for all of them
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, request, Response
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlite_config import apply_pragmas
+from compression import compress_variants, compressible, negotiate, set_encoded_body
+
+TAGS_KEY = 'response_cache_tags'
+INVALIDATION_LOG_SECONDS = 3600  # A worker that hasn't looked at the log for longer clears its whole cache
+
+
+def row_tags(obj):
+    """Tags purged when `obj` changes: its table, its own row and every row it references"""
+    state = inspect(obj)
+    mapper = state.mapper
+    table = mapper.local_table.name
+    tags = {table}
+    identity = state.identity or mapper.primary_key_from_instance(obj)
+    if identity and None not in identity:
+        tags.add(f"{table}:{':'.join(str(v) for v in identity)}")
+
+    for column in mapper.local_table.columns:
+        for fk in column.foreign_keys:
+            attr = state.attrs[mapper.get_property_by_column(column).key]
+            values = [attr.value] + list(attr.history.deleted or [])
+            tags.update(f"{fk.column.table.name}:{v}" for v in values if v is not None)
+    return tags
+
+
+class InvalidationLog:
+    """
+    The tags purged by every worker process, in a SQLite file they share.
+
+    A worker appends what it purges and reads what the others appended since
+    it last looked; PRAGMA data_version changes only when another connection
+    has written, so looking when nothing happened is one cheap pragma.
+    """
+
+    def __init__(self, path, pragmas=None):
+        self.path = path
+        self.pragmas = pragmas or {}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._data_version = None
+        with self._lock:
+            conn = self._connection()
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_invalidations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tags TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            ''')
+            self.last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM cache_invalidations').fetchone()[0]
+
+    def _connection(self):
+        # One connection per process; a forked worker opens its own
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            apply_pragmas(self._conn, self.pragmas)
+            self._pid = os.getpid()
+            self._data_version = None
+        return self._conn
+
+    def append(self, tags):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('INSERT INTO cache_invalidations (tags, created_at) VALUES (?, ?)',
+                         (json.dumps(sorted(tags)), now))
+            conn.execute('DELETE FROM cache_invalidations WHERE created_at < ?', (now - INVALIDATION_LOG_SECONDS,))
+
+    def unseen(self):
+        """Tags appended since the last call, or None when some were pruned unseen and everything must go"""
+        with self._lock:
+            conn = self._connection()
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self._data_version:
+                return set()
+            self._data_version = data_version
+            rows = conn.execute(
+                'SELECT id, tags FROM cache_invalidations WHERE id > ? ORDER BY id', (self.last_id,)
+            ).fetchall()
+            if not rows:
+                return set()
+            complete = rows[0][0] == self.last_id + 1
+            self.last_id = rows[-1][0]
+        if not complete:
+            return None
+        return {tag for _, tags in rows for tag in json.loads(tags)}
+
+
+class MemoryBackend:
+    """Per-process LRU of (expires_at, entry, tags); with a `log`, purges reach every process"""
+
+    def __init__(self, max_entries=1000, log=None):
+        self.max_entries = max_entries
+        self.log = log
+        self._entries = OrderedDict()
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._replay()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, entry, tags = item
+            if expires_at <= time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl, tags):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.time() + ttl, entry, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        self._purge(tags)
+        if self.log is not None:
+            self.log.append(tags)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _replay(self):
+        """Purge what the other processes invalidated"""
+        if self.log is None:
+            return
+        tags = self.log.unseen()
+        if tags is None:
+            self.clear()
+        elif tags:
+            self._purge(tags)
+
+    def _purge(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._drop(key)
+
+    def _drop(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SQLiteBackend:
+    """Entries and their tags in a SQLite file shared by every worker process"""
+
+    def __init__(self, path, pragmas=None, max_entries=10000):
+        self.path = path
+        self.pragmas = pragmas or {}
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                content_type TEXT NOT NULL,
+                body BLOB NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_tags (
+                tag TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (tag, key)
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_variants (
+                key TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                body BLOB NOT NULL,
+                PRIMARY KEY (key, encoding)
+            )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_tags_key ON cache_tags (key)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_entries_expires ON cache_entries (expires_at)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        apply_pragmas(conn, self.pragmas)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT status, content_type, body FROM cache_entries WHERE key = ? AND expires_at > ?',
+                (key, time.time())
+            ).fetchone()
+            if row is None:
+                return None
+            variants = dict(conn.execute('SELECT encoding, body FROM cache_variants WHERE key = ?', (key,)))
+        return {'status': row[0], 'content_type': row[1], 'body': row[2], 'variants': variants}
+
+    def set(self, key, entry, ttl, tags):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache_entries (key, status, content_type, body, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, entry['status'], entry['content_type'], entry['body'], time.time() + ttl)
+                )
+                conn.execute('DELETE FROM cache_tags WHERE key = ?', (key,))
+                conn.execute('DELETE FROM cache_variants WHERE key = ?', (key,))
+                conn.executemany('INSERT INTO cache_variants (key, encoding, body) VALUES (?, ?, ?)',
+                                 ((key, encoding, body) for encoding, body in entry['variants'].items()))
+                conn.executemany('INSERT INTO cache_tags (tag, key) VALUES (?, ?)', ((tag, key) for tag in tags))
+                self._prune(conn)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _prune(self, conn):
+        conn.execute('DELETE FROM cache_entries WHERE expires_at <= ?', (time.time(),))
+        conn.execute(
+            'DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries '
+            'ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+        )
+        conn.execute('DELETE FROM cache_tags WHERE key NOT IN (SELECT key FROM cache_entries)')
+        conn.execute('DELETE FROM cache_variants WHERE key NOT IN (SELECT key FROM cache_entries)')
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        placeholders = ','.join('?' * len(tags))
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                f'DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_tags WHERE tag IN ({placeholders}))',
+                tags
+            )
+            conn.execute(f'DELETE FROM cache_tags WHERE tag IN ({placeholders})', tags)
+            conn.execute('DELETE FROM cache_variants WHERE key NOT IN (SELECT key FROM cache_entries)')
+            conn.execute('COMMIT')
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM cache_entries')
+            conn.execute('DELETE FROM cache_tags')
+            conn.execute('DELETE FROM cache_variants')
+
+
+class ResponseCache:
+    """Holds the configured backend and this process's hit/miss counters"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self._stats_lock = threading.Lock()
+        self.stats = {}  # endpoint -> {'hits': n, 'misses': n}
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.default_ttl = app.config['RESPONSE_CACHE_TTL']
+        backend = app.config['RESPONSE_CACHE_BACKEND']
+        if backend in ('memory', 'sqlite'):
+            os.makedirs(os.path.dirname(app.config['RESPONSE_CACHE_DB']), exist_ok=True)
+        if backend == 'memory':
+            log = InvalidationLog(app.config['RESPONSE_CACHE_DB'], pragmas=app.config['SQLITE_PRAGMAS'])
+            self.backend = MemoryBackend(app.config['RESPONSE_CACHE_MAX_ENTRIES'], log=log)
+        elif backend == 'sqlite':
+            self.backend = SQLiteBackend(
+                app.config['RESPONSE_CACHE_DB'],
+                pragmas=app.config['SQLITE_PRAGMAS'],
+                max_entries=app.config['RESPONSE_CACHE_MAX_ENTRIES']
+            )
+        elif backend is not None:
+            raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND: {backend}")
+        app.extensions['response_cache'] = self
+
+    def count(self, endpoint, outcome):
+        with self._stats_lock:
+            counters = self.stats.setdefault(endpoint, {'hits': 0, 'misses': 0})
+            counters[outcome] += 1
+
+    def invalidate(self, tags):
+        if self.backend is not None and tags:
+            self.backend.invalidate(tags)
+            with self._stats_lock:
+                self.invalidations += 1
+
+    def get_stats(self):
+        with self._stats_lock:
+            endpoints = {name: dict(counters) for name, counters in self.stats.items()}
+        hits = sum(c['hits'] for c in endpoints.values())
+        misses = sum(c['misses'] for c in endpoints.values())
+        return {
+            'pid': os.getpid(),
+            'backend': type(self.backend).__name__ if self.backend else None,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / (hits + misses) if hits + misses else None,
+            'invalidations': self.invalidations,
+            'endpoints': endpoints
+        }
+
+
+def get_response_cache():
+    return current_app.extensions['response_cache']
+
+
+def _entry_response(entry, cache_status):
+    response = Response(entry['body'], status=entry['status'], content_type=entry['content_type'])
+    if compressible(response):
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate(entry['variants'])
+        if encoding is not None:
+            set_encoded_body(response, encoding, entry['variants'][encoding])
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+def cached(tags, ttl=None):
+    """
+    Cache a GET view's successful response.
+
+    `tags` is a list of tags, or a function called with the view's URL
+    arguments that returns one, e.g. lambda id: [f'subsection:{id}'].
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            cache = get_response_cache()
+            if cache.backend is None or request.method != 'GET':
+                return view(**kwargs)
+
+            key = f"{request.endpoint}|{request.full_path}"
+            entry = cache.backend.get(key)
+            if entry is not None:
+                cache.count(request.endpoint, 'hits')
+                return _entry_response(entry, 'HIT')
+
+            cache.count(request.endpoint, 'misses')
+            response = current_app.make_response(view(**kwargs))
+            if response.status_code != 200 or response.direct_passthrough:
+                return response
+
+            body = response.get_data()
+            entry = {
+                'status': response.status_code,
+                'content_type': response.content_type,
+                'body': body,
+                'variants': compress_variants(body) if compressible(response) else {}
+            }
+            entry_tags = tags(**kwargs) if callable(tags) else tags
+            cache.backend.set(key, entry, ttl or cache.default_ttl, set(entry_tags))
+            return _entry_response(entry, 'MISS')
+        return wrapper
+    return decorator
+
+
+def invalidate_on_commit(session, tags):
+    """Purge `tags` once `session` commits, for writes that bypass the ORM (bulk statements)"""
+    session.info.setdefault(TAGS_KEY, set()).update(tags)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_tags(session, flush_context):
+    tags = session.info.setdefault(TAGS_KEY, set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        tags.update(row_tags(obj))
+
+
+@event.listens_for(Session, 'after_commit')
+def _purge_tags(session):
+    tags = session.info.pop(TAGS_KEY, None)
+    if tags:
+        cache = current_app.extensions.get('response_cache')
+        if cache is not None:
+            try:
+                cache.invalidate(tags)
+            except Exception as e:
+                current_app.logger.error(f"Error purging response cache: {str(e)}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_tags(session):
+    session.info.pop(TAGS_KEY, None)
@@ -1,11 +1,17 @@
-import os
-import time
-from flask import Blueprint, render_template, request, jsonify, send_from_directory, current_app, send_file, abort
+from flask import Blueprint, render_template, request, jsonify, current_app
+from sqlalchemy import func
 from werkzeug.utils import secure_filename
-from models import db, Subsection, Media, Home, HomeMedia, Button, ButtonMedia
+from models import db, Subsection, Media, Button
 from constants import SECTIONS, get_section_by_id
-from helpers import send_to_s3, delete_from_s3
-import requests
+from helpers import send_to_s3, send_batch_to_s3, delete_from_s3, large_upload
+from media_cache import serve_cached_media
+from static_serving import serve_upload
+from response_cache import cached
+from query_budget import query_budget
+from image_derivatives import prepare_derivatives, reused_derivatives, render_later, delete_derivatives
+from content_store import content_key
+from media_mapping import map_media, unmap_media
+from bulk_edit import rename_titles, summarize
 
 # Create blueprint
 bp = Blueprint('sections', __name__)
@@ -16,10 +22,28 @@ def allowed_file(filename):
         print(f"File extension not allowed: {filename.rsplit('.', 1)[1].lower() if '.' in filename else 'no extension'}")
     return allowed
 
+def media_counts(section_id=None):
+    """
+    {subsection_id: {type: count}} from one grouped query, optionally for one
+    section's subsections. Counts come from the (subsection_id, type) index
+    without loading any media rows.
+    """
+    query = db.session.query(Media.subsection_id, Media.type, func.count(Media.id))
+    if section_id is not None:
+        query = query.filter(Media.subsection_id.in_(
+            db.session.query(Subsection.id).filter(Subsection.section_id == section_id)
+        ))
+    counts = {}
+    for subsection_id, media_type, count in query.group_by(Media.subsection_id, Media.type):
+        counts.setdefault(subsection_id, {})[media_type] = count
+    return counts
+
 # Page Routes
 @bp.route('/manage-sections')
+@query_budget(2)
 def manage_sections():
     subsections = Subsection.query.all()
+    counts = media_counts()
     # Add section info to subsections
     subsections_with_sections = []
     for subsection in subsections:
@@ -31,7 +55,7 @@ def manage_sections():
                 'description': subsection.description,
                 'section_id': subsection.section_id,
                 'section_name': section['name'],
-                'media_count': len(subsection.media_items)
+                'media_count': sum(counts.get(subsection.id, {}).values())
             }
             subsections_with_sections.append(subsection_dict)
     
@@ -41,6 +65,8 @@ def manage_sections():
 
 # API Routes - Remove section-related routes since they're now constants
 @bp.route('/api/subsections', methods=['GET'])
+@query_budget(1)
+@cached(tags=['subsection'])
 def get_subsections():
     subsections = Subsection.query.all()
     return jsonify([{
@@ -112,6 +138,7 @@ def delete_subsection(id):
 
 # Media Routes
 @bp.route('/api/subsections/<int:id>/media', methods=['GET'])
+@cached(tags=lambda id: [f'subsection:{id}'])
 def get_subsection_media(id):
     media_items = Media.query.filter_by(subsection_id=id).all()
     return jsonify([{
@@ -123,6 +150,7 @@ def get_subsection_media(id):
     } for m in media_items])
 
 @bp.route('/api/media', methods=['POST'])
+@large_upload
 def upload_media():
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
@@ -136,10 +164,13 @@ def upload_media():
     if not all([file, subsection_id, media_type, title]):
         return jsonify({'error': 'Missing required fields'}), 400
         
-    # Generate unique filename
+    # Key the object by its content, so re-uploads of the same file share it
     filename = secure_filename(file.filename)
-    unique_filename = f"{subsection_id}_{int(time.time())}_{filename}"
+    unique_filename = content_key(file, filename)
     
+    # Read the image for its smaller WebP/AVIF copies before boto3 closes the upload
+    prepared = prepare_derivatives([(file, unique_filename)] if media_type == 'image' else [])
+
     # Upload to S3
     bucket_name = current_app.config['S3_BUCKET']
     result = send_to_s3(file, bucket_name, unique_filename)
@@ -150,6 +181,7 @@ def upload_media():
     # Create S3 URL - Remove any trailing slash from S3_LOCATION
     s3_location = current_app.config['S3_LOCATION'].rstrip('/')
     s3_url = f"{s3_location}/{unique_filename}"
+    derivatives = reused_derivatives(prepared)[0] if prepared else None
     
     # Create media record
     media = Media(
@@ -157,12 +189,14 @@ def upload_media():
         type=media_type,
         title=title,
         description=description,
-        file_path=s3_url
+        file_path=s3_url,
+        derivatives=derivatives
     )
     
     try:
         db.session.add(media)
         db.session.commit()
+        render_later(prepared, [(media, 'derivatives')])
         
         return jsonify({
             'id': media.id,
@@ -178,20 +212,22 @@ def upload_media():
 @bp.route('/api/media/<int:media_id>', methods=['DELETE'])
 def delete_media(media_id):
     media = Media.query.get_or_404(media_id)
-    
-    # Delete file from S3
-    result = delete_from_s3(media.file_path)
-    if result != 'success':
-        return jsonify({'error': f'Failed to delete from S3: {result}'}), 500
+    file_path, derivatives = media.file_path, media.derivatives
     
     # Delete record from database
     try:
         db.session.delete(media)
         db.session.commit()
-        return jsonify({'message': 'Media deleted successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+    
+    # Delete file from S3 unless other rows still share it
+    result = delete_from_s3(file_path)
+    if result != 'success':
+        current_app.logger.error(f"Error deleting {file_path} from S3: {result}")
+    delete_derivatives(derivatives, file_path)
+    return jsonify({'message': 'Media deleted successfully'})
 
 @bp.route('/api/media/update-title', methods=['PUT'])
 def update_media_title():
@@ -200,18 +236,16 @@ def update_media_title():
         return jsonify({'error': 'Missing required fields'}), 400
     
     try:
-        # Update all media items with the same title
-        Media.query.filter_by(title=data['original_title']).update({
-            'title': data['new_title'],
-            'description': data.get('description', '')
-        })
+        # Update all media items with the same title; the description only when one is given
+        updated = rename_titles('media', [(data['original_title'], data['new_title'], data.get('description'))])
         db.session.commit()
-        return jsonify({'message': 'Media updated successfully'})
+        return jsonify(dict(summarize(updated), message='Media updated successfully'))
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @bp.route('/api/media/batch', methods=['POST'])
+@large_upload
 def upload_media_batch():
     if 'files[]' not in request.files:
         return jsonify({'error': 'No files provided'}), 400
@@ -224,74 +258,75 @@ def upload_media_batch():
     if not all([files, subsection_id, title]):
         return jsonify({'error': 'Missing required fields'}), 400
 
-    uploaded_media = []
     bucket_name = current_app.config['S3_BUCKET']
-    
+    s3_location = current_app.config['S3_LOCATION'].rstrip('/')
+
+    # Work out keys and types first, then upload everything in parallel
+    pending = []
     for file in files:
         if file and allowed_file(file.filename):
-            try:
-                # Generate unique filename
-                filename = secure_filename(file.filename)
-                unique_filename = f"{subsection_id}_{int(time.time())}_{filename}"
-                
-                # Determine media type from file extension
-                file_ext = filename.rsplit('.', 1)[1].lower()
-                if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
-                    media_type = 'image'
-                elif file_ext in ['mp4', 'mkv', 'mov']:
-                    media_type = 'video'
-                elif file_ext == 'pdf':
-                    media_type = 'pdf'
-                else:
-                    continue  # Skip unsupported file types
-                
-                # Upload to S3
-                result = send_to_s3(file, bucket_name, unique_filename)
-                
-                if result != 'success':
-                    raise Exception(f"Failed to upload to S3: {result}")
-                
-                # Create S3 URL - Remove any trailing slash from S3_LOCATION
-                s3_location = current_app.config['S3_LOCATION'].rstrip('/')
-                s3_url = f"{s3_location}/{unique_filename}"
-                
-                # Create media record with the same title and description for all files
-                media = Media(
-                    subsection_id=subsection_id,
-                    type=media_type,
-                    title=title,
-                    description=description,
-                    file_path=s3_url
-                )
-                
-                db.session.add(media)
-                uploaded_media.append({
-                    'type': media_type,
-                    'title': title,
-                    'description': description,
-                    'file_path': s3_url
-                })
-            except Exception as e:
-                print(f"Error uploading file {filename}: {str(e)}")
-                continue
-    
+            # Key the object by its content, so re-uploads of the same file share it
+            filename = secure_filename(file.filename)
+            unique_filename = content_key(file, filename)
+
+            # Determine media type from file extension
+            file_ext = filename.rsplit('.', 1)[1].lower()
+            if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
+                media_type = 'image'
+            elif file_ext in ['mp4', 'mkv', 'mov']:
+                media_type = 'video'
+            elif file_ext == 'pdf':
+                media_type = 'pdf'
+            else:
+                continue  # Skip unsupported file types
+
+            pending.append((file, filename, unique_filename, media_type))
+
+    # Read the images for their smaller WebP/AVIF copies before boto3 closes the files
+    prepared = prepare_derivatives([(file, unique_filename) for file, _, unique_filename, _ in pending])
+
+    results = send_batch_to_s3([(file, unique_filename) for file, _, unique_filename, _ in pending], bucket_name)
+
+    uploaded_media = []
+    failed = []
+    # Derivatives are only rendered for the files that made it to S3
+    targets = [None] * len(pending)
+    for index, ((file, filename, unique_filename, media_type), result, media_derivatives) in enumerate(
+            zip(pending, results, reused_derivatives(prepared))):
+        if result != 'success':
+            print(f"Error uploading file {filename}: {result}")
+            failed.append({'filename': filename, 'error': result})
+            continue
+
+        # Create media record with the same title and description for all files
+        media = Media(
+            subsection_id=subsection_id,
+            type=media_type,
+            title=title,
+            description=description,
+            file_path=f"{s3_location}/{unique_filename}",
+            derivatives=media_derivatives
+        )
+        db.session.add(media)
+        uploaded_media.append(media)
+        targets[index] = (media, 'derivatives')
+
     if not uploaded_media:
-        return jsonify({'error': 'No files were successfully uploaded'}), 400
-    
+        return jsonify({'error': 'No files were successfully uploaded', 'failed': failed}), 400
+
     try:
         db.session.commit()
-        # Update the IDs after commit
-        for media_item in uploaded_media:
-            media_record = Media.query.filter_by(
-                subsection_id=subsection_id,
-                title=media_item['title']
-            ).first()
-            if media_record:
-                media_item['id'] = media_record.id
-                
+        render_later(prepared, targets)
         return jsonify({
             'message': f'Successfully uploaded {len(uploaded_media)} files',
-            'media': uploaded_media
+            'media': [{
+                'id': media.id,
+                'type': media.type,
+                'title': media.title,
+                'description': media.description,
+                'file_path': media.file_path
+            } for media in uploaded_media],
+            'failed': failed
         })
     except Exception as e:
         db.session.rollback()
@@ -300,9 +335,10 @@ def upload_media_batch():
 # Serve uploaded files
 @bp.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    return serve_upload(current_app.config['UPLOAD_FOLDER'], filename)
 
 @bp.route('/sections/<int:section_id>/subsections')
+@query_budget(2)
 def view_section_subsections(section_id):
     # Get section info
     section = get_section_by_id(section_id)
@@ -313,23 +349,16 @@ def view_section_subsections(section_id):
     subsections = Subsection.query.filter_by(section_id=section_id).all()
     
     # Add media counts to subsections
+    counts = media_counts(section_id)
     subsections_with_media = []
     for subsection in subsections:
-        media_by_type = {
-            'image': 0,
-            'video': 0,
-            'pdf': 0
-        }
-        for media in subsection.media_items:
-            if media.type in media_by_type:
-                media_by_type[media.type] += 1
-                
+        counts_by_type = counts.get(subsection.id, {})
         subsection_data = {
             'id': subsection.id,
             'name': subsection.name,
             'description': subsection.description,
-            'media_counts': media_by_type,
-            'total_media': len(subsection.media_items)
+            'media_counts': {media_type: counts_by_type.get(media_type, 0) for media_type in ('image', 'video', 'pdf')},
+            'total_media': sum(counts_by_type.values())
         }
         subsections_with_media.append(subsection_data)
     
@@ -338,6 +367,7 @@ def view_section_subsections(section_id):
                          subsections=subsections_with_media)
 
 @bp.route('/subsections/<int:id>/view')
+@query_budget(2)
 def view_subsection(id):
     # Get subsection details
     subsection = Subsection.query.get_or_404(id)
@@ -364,6 +394,7 @@ def view_subsection(id):
                          media_by_type=media_by_type)
 
 @bp.route('/sections/<int:section_id>/manage-subsections')
+@query_budget(2)
 def manage_subsections(section_id):
     # Get section info
     section = get_section_by_id(section_id)
@@ -374,23 +405,16 @@ def manage_subsections(section_id):
     subsections = Subsection.query.filter_by(section_id=section_id).all()
     
     # Add media counts to subsections
+    counts = media_counts(section_id)
     subsections_with_media = []
     for subsection in subsections:
-        media_by_type = {
-            'image': 0,
-            'video': 0,
-            'pdf': 0
-        }
-        for media in subsection.media_items:
-            if media.type in media_by_type:
-                media_by_type[media.type] += 1
-                
+        counts_by_type = counts.get(subsection.id, {})
         subsection_data = {
             'id': subsection.id,
             'name': subsection.name,
             'description': subsection.description,
-            'media_counts': media_by_type,
-            'total_media': len(subsection.media_items)
+            'media_counts': {media_type: counts_by_type.get(media_type, 0) for media_type in ('image', 'video', 'pdf')},
+            'total_media': sum(counts_by_type.values())
         }
         subsections_with_media.append(subsection_data)
     
@@ -423,6 +447,7 @@ def group_media_by_title(media_items):
     return grouped
 
 @bp.route('/subsections/<int:subsection_id>/manage-media')
+@query_budget(2)
 def manage_media(subsection_id):
     subsection = Subsection.query.get_or_404(subsection_id)
     media_items = Media.query.filter_by(subsection_id=subsection_id).all()
@@ -471,10 +496,8 @@ def map_toggle_media():
         if action not in ['map', 'unmap']:
             return jsonify({"error": "Action must be 'map' or 'unmap'"}), 400
         
-        # 1. Get media items by title
-        media_items = Media.query.filter_by(title=title).all()
-        
-        if not media_items:
+        # 1. Check there is media with the title
+        if not db.session.query(Media.query.filter_by(title=title).exists()).scalar():
             return jsonify({"error": f"No media found with title '{title}'"}), 404
             
         # 2. Get button id from button table by subsection name (case insensitive)
@@ -484,43 +507,22 @@ def map_toggle_media():
             return jsonify({"error": f"No button found with title matching '{subsection_name}'"}), 404
         
         if action == 'map':
-            # 3. Insert new ButtonMedia records with data from Media
-            inserted_count = 0
-            for media in media_items:
-                # Create new ButtonMedia record with data copied from Media
-                new_button_media = ButtonMedia(
-                    button_id=button.id,
-                    type=media.type,
-                    file_path=media.file_path,
-                    title=media.title,
-                    description=media.description
-                )
-                db.session.add(new_button_media)
-                inserted_count += 1
-            
+            # 3. Copy the media onto the button; media already mapped to it is skipped
+            inserted_ids = map_media([title], [button.id])
             db.session.commit()
             return jsonify({
-                "message": f"Successfully copied {inserted_count} media items to button",
-                "button_id": button.id
+                "message": f"Successfully copied {len(inserted_ids)} media items to button",
+                "button_id": button.id,
+                "button_media_ids": inserted_ids
             }), 200
             
         else:  # action == 'unmap'
-            # For unmapping, delete ButtonMedia entries with matching button_id and Media properties
-            deleted_count = 0
-            for media in media_items:
-                # Find and delete ButtonMedia entries that match this button and have same properties as media
-                button_media = ButtonMedia.query.filter_by(
-                    button_id=button.id,
-                    title=media.title
-                ).all()
-                
-                for item in button_media:
-                    db.session.delete(item)
-                    deleted_count += 1
-            
+            # Delete the button's media with this title
+            deleted_ids = unmap_media([title], [button.id])
             db.session.commit()
             return jsonify({
-                "message": f"Successfully removed {deleted_count} media items from button"
+                "message": f"Successfully removed {len(deleted_ids)} media items from button",
+                "button_media_ids": deleted_ids
             }), 200
             
     except Exception as e:
@@ -528,32 +530,52 @@ def map_toggle_media():
         current_app.logger.error(f"Error in map_toggle_media: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-MEDIA_DIR = './uploads'
-
-UPLOADS_DIR = os.path.join(os.getcwd(), 'uploads')
+@bp.route('/api/media/map-batch', methods=['POST'])
+def map_media_batch():
+    """
+    Map or unmap media with any of several titles to several kiosk buttons, in one transaction.
+    
+    Request body:
+    {
+        "titles": ["Media title", ...],
+        "button_ids": [1, 2, ...],
+        "action": "map" or "unmap"
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    titles = data.get('titles')
+    button_ids = data.get('button_ids')
+    action = data.get('action')
+
+    if not titles or not isinstance(titles, list) or not all(isinstance(t, str) for t in titles):
+        return jsonify({"error": "titles must be a non-empty list of strings"}), 400
+    if not button_ids or not isinstance(button_ids, list) or not all(isinstance(b, int) for b in button_ids):
+        return jsonify({"error": "button_ids must be a non-empty list of integers"}), 400
+    if action not in ['map', 'unmap']:
+        return jsonify({"error": "Action must be 'map' or 'unmap'"}), 400
+
+    found = {button_id for button_id, in db.session.query(Button.id).filter(Button.id.in_(button_ids))}
+    missing = sorted(set(button_ids) - found)
+    if missing:
+        return jsonify({"error": f"No buttons with ids {missing}"}), 404
 
+    try:
+        if action == 'map':
+            ids = map_media(titles, button_ids)
+        else:
+            ids = unmap_media(titles, button_ids)
+        db.session.commit()
+        return jsonify({
+            "action": action,
+            "count": len(ids),
+            "button_media_ids": ids
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in map_media_batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
 @bp.route("/media/<path:filename>")
 def serve_media(filename):
-
     S3_BASE_URL = current_app.config['S3_LOCATION'].rstrip('/')
-    local_path = os.path.join(UPLOADS_DIR, filename)
-
-    if os.path.exists(local_path):
-        return send_file(local_path)
-
-    # Download from S3
-    s3_url = f"{S3_BASE_URL}/{filename}"
-    response = requests.get(s3_url)
-
-    if response.status_code != 200:
-        abort(404, description="File not found on S3")
-
-    # Make sure the uploads directory exists
-    os.makedirs(UPLOADS_DIR, exist_ok=True)
-
-    # Save the file
-    with open(local_path, "wb") as f:
-        f.write(response.content)
-
-    return send_file(local_path)
\ No newline at end of file
+    return serve_cached_media(filename, f"{S3_BASE_URL}/{filename}")
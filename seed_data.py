@@ -0,0 +1,386 @@
+"""
+Deterministic synthetic catalog for scale testing.
+
+    python seed_data.py --scale 100000 [--seed 42] [--upload] [--append]
+
+Fills every model plus the legacy floor_plans_and_elevations table. --scale
+(10**3 to 10**6) is the row count of the big tables and the rest follow it:
+
+    floor_plans, floor_plans_and_elevations, media   scale
+    button_media                                     scale / 2
+    home_media                                       ~scale / 5 (3-15 per home)
+    homes                                            scale / 50
+    subsection                                       scale / 100, over the 7 sections
+    kiosk                                            scale / 5000, 3-12 videos each, 4-10 buttons per video
+
+Distributions follow the real catalog: plan facets are skewed towards a few
+dimensions and facings, media arrive in batches that share a title, a few
+subsections and buttons hold most of the media, and created_at spreads over
+SPAN_DAYS with newer ids newer. The same seed and scale always produce the
+same rows; the placeholder files only depend on the seed.
+
+Rows reference a small pool of placeholder files, written to
+UPLOAD_FOLDER/seed/ (the legacy table points there) and, with --upload, to
+S3_BUCKET under their content-addressed keys. Rows are inserted with
+executemany in a single transaction, bypassing the ORM, so this does
+what the session hooks would have: media_objects reference counts (with
+sizes and hashes, so manifests needn't stat S3), a floor plan index reload
+in every worker and a purge of cached responses for the seeded tables.
+Kiosk manifests are built on their first request.
+
+It refuses to add to a database that already has rows unless --append is
+given; point DATABASE_URL and SQLITE_DATABASE at scratch files to keep a
+seeded catalog apart from real data.
+"""
+import bisect
+import hashlib
+import io
+import itertools
+import os
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from constants import SECTIONS, FACING_OPTIONS, PLAN_TYPES, FLOOR_COUNT_OPTIONS, SITE_DIMENSIONS
+from content_store import content_key, adjust_references
+from helpers import send_batch_to_s3
+from models import db
+from floorplan_index import get_floorplan_index
+from response_cache import get_response_cache
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:  # Placeholder "images" are then random bytes
+    Image = None
+
+CHUNK_ROWS = 50000  # Rows per executemany
+SPAN_DAYS = 3 * 365
+SPAN_END = datetime(2025, 1, 1)  # Fixed, so timestamps don't depend on when it runs
+
+PLACEHOLDER_IMAGES = 64
+PLACEHOLDER_VIDEOS = 8
+PLACEHOLDER_PDFS = 4
+
+# Facet weights, in the order of the constants lists
+DIMENSION_WEIGHTS = [4, 8, 10, 6, 5, 3, 3, 2, 1, 1]
+FACING_WEIGHTS = [10, 6, 9, 7, 3, 2, 2, 2]
+TYPE_WEIGHTS = [12, 3, 2, 4, 5, 2]
+FLOOR_WEIGHTS = [3, 10, 4, 8, 3, 4, 1, 2, 1, 1]
+
+MEDIA_TYPES = (['image', 'video', 'pdf'], [80, 15, 5])
+HOME_MEDIA_TYPES = (['photo', 'floor_plan', 'isometric', 'video'], [60, 20, 15, 5])
+
+SEEDED_TABLES = ['floor_plans', 'subsection', 'media', 'kiosk', 'video', 'button', 'button_media',
+                 'homes', 'home_media']
+
+
+class SeedError(Exception):
+    pass
+
+
+def _placeholder_image(rng, index, width=1600, height=1200):
+    if Image is None:
+        return rng.randbytes(200 * 1024)
+    image = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle((x, y, x + rng.randrange(50, 400), y + rng.randrange(50, 300)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    draw.text((40, 40), f"placeholder {index}", fill=(255, 255, 255))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def write_placeholders(app, seed, video_kb=4096):
+    """
+    Write the placeholder files under UPLOAD_FOLDER/seed/ and return
+    {kind: [{'name', 'path', 'key', 'url', 'size', 'sha256', 'content_type'}]}
+    """
+    rng = random.Random(f"{seed}:files")
+    contents = {
+        'image': [(f"image_{i}.jpg", _placeholder_image(rng, i), 'image/jpeg') for i in range(PLACEHOLDER_IMAGES)],
+        # Only ever range-requested in tests, so they needn't decode
+        'video': [(f"video_{i}.mp4", rng.randbytes(video_kb * 1024), 'video/mp4') for i in range(PLACEHOLDER_VIDEOS)],
+        'pdf': [(f"document_{i}.pdf", b'%PDF-1.4\n' + rng.randbytes(64 * 1024), 'application/pdf')
+                for i in range(PLACEHOLDER_PDFS)],
+    }
+    directory = os.path.join(app.config['UPLOAD_FOLDER'], 'seed')
+    os.makedirs(directory, exist_ok=True)
+    s3_location = (app.config['S3_LOCATION'] or '').rstrip('/')
+
+    placeholders = {}
+    for kind, files in contents.items():
+        for name, data, content_type in files:
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            key = content_key(io.BytesIO(data), name)
+            placeholders.setdefault(kind, []).append({
+                'name': f"seed/{name}", 'path': path, 'key': key, 'url': f"{s3_location}/{key}",
+                'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(), 'content_type': content_type
+            })
+    return placeholders
+
+
+def upload_placeholders(app, placeholders):
+    items = [item for files in placeholders.values() for item in files]
+    uploads = []
+    for item in items:
+        with open(item['path'], 'rb') as f:
+            uploads.append((io.BytesIO(f.read()), item['key'], item['content_type']))
+    results = send_batch_to_s3(uploads, app.config['S3_BUCKET'])
+    failed = [item['key'] for item, result in zip(items, results) if result != 'success']
+    if failed:
+        raise SeedError(f"Could not upload {len(failed)} placeholders to S3, e.g. {failed[0]}: is it reachable?")
+
+
+def _timestamps(rng, count):
+    """`count` ascending timestamps spread over SPAN_DAYS, ending at SPAN_END"""
+    start = SPAN_END - timedelta(days=SPAN_DAYS)
+    step = SPAN_DAYS * 86400 / max(count, 1)
+    for n in range(count):
+        yield start + timedelta(seconds=(n + rng.random()) * step)
+
+
+def _ts(value):
+    # How SQLAlchemy stores DateTime in SQLite
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _skewed_weights(rng, count, alpha=1.2):
+    """Pareto weights: a few items get most of the rows"""
+    return [rng.paretovariate(alpha) for _ in range(count)]
+
+
+def _weighted(rng, values, weights):
+    """A function drawing from `values` by `weights`; rng.choices redoes the sums on every call"""
+    cumulative = list(itertools.accumulate(weights))
+    total = cumulative[-1]
+    return lambda: values[bisect.bisect(cumulative, rng.random() * total)]
+
+
+def _plan_facets(rng):
+    """Draw functions for site dimension, facing, type and floors"""
+    return [
+        _weighted(rng, SITE_DIMENSIONS, DIMENSION_WEIGHTS),
+        _weighted(rng, FACING_OPTIONS, FACING_WEIGHTS),
+        _weighted(rng, PLAN_TYPES, TYPE_WEIGHTS),
+        _weighted(rng, FLOOR_COUNT_OPTIONS, FLOOR_WEIGHTS),
+    ]
+
+
+def _next_id(conn, table):
+    return conn.execute(text(f'SELECT COALESCE(MAX(id), 0) + 1 FROM "{table}"')).scalar()
+
+
+def _insert(conn, table, columns, rows):
+    """executemany `rows` (an iterable of tuples) into `table` in CHUNK_ROWS batches; returns the count"""
+    names = ', '.join(f'"{column}"' for column in columns)
+    sql = f'INSERT INTO "{table}" ({names}) VALUES ({", ".join("?" * len(columns))})'
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_ROWS:
+            conn.exec_driver_sql(sql, chunk)
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        conn.exec_driver_sql(sql, chunk)
+        total += len(chunk)
+    return total
+
+
+class _Seeder:
+    def __init__(self, conn, rng, placeholders):
+        self.conn = conn
+        self.rng = rng
+        self.placeholders = placeholders
+        self.references = {}  # file_path URL -> rows pointing at it
+        self.ranges = {}  # table -> (first id, count)
+
+    def _file(self, kind):
+        url = self.rng.choice(self.placeholders[kind])['url']
+        self.references[url] = self.references.get(url, 0) + 1
+        return url
+
+    def _table(self, table, columns, rows):
+        first = _next_id(self.conn, table)
+        count = _insert(self.conn, table, ('id',) + columns, ((first + n,) + row for n, row in enumerate(rows)))
+        self.ranges[table] = (first, count)
+        return first, count
+
+    def floor_plans(self, count):
+        rng = self.rng
+        facets = _plan_facets(rng)
+        self._table('floor_plans', (
+            'site_dimension', 'facing', 'type', 'floors', 'floor_plan_path', 'elevation_path', 'created_at', 'updated_at'
+        ), ((
+            *(draw() for draw in facets), self._file('image'), self._file('image'), _ts(created), _ts(created)
+        ) for created in _timestamps(rng, count)))
+
+    def sections(self, subsection_count, media_count):
+        rng = self.rng
+        per_section = max(1, subsection_count // len(SECTIONS))
+        subsections = [(section['id'], n) for section in SECTIONS for n in range(per_section)]
+        self.subsection_names = [f"{SECTIONS[section_id - 1]['name']} {n + 1}" for section_id, n in subsections]
+        first, _ = self._table('subsection', ('section_id', 'name', 'description', 'order', 'created_at', 'updated_at'), (
+            (section_id, name, f"Seeded subsection {n + 1}", n, _ts(created), _ts(created))
+            for (section_id, n), name, created in zip(subsections, self.subsection_names,
+                                                      _timestamps(rng, len(subsections)))
+        ))
+        subsection_ids = list(range(first, first + len(subsections)))
+        pick_subsection = _weighted(rng, subsection_ids, _skewed_weights(rng, len(subsection_ids)))
+        pick_type = _weighted(rng, *MEDIA_TYPES)
+
+        def media_rows():
+            # Batch uploads: 1-12 files sharing a title, subsection, type and upload time
+            remaining = 0
+            for created in _timestamps(rng, media_count):
+                if remaining == 0:
+                    remaining = rng.randint(1, 12)
+                    subsection_id = pick_subsection()
+                    title = f"Seeded media {rng.randrange(max(1, media_count // 6))}"
+                    media_type = pick_type()
+                    batch_time = _ts(created)
+                remaining -= 1
+                yield (subsection_id, media_type, self._file(media_type), title, 'Seeded for scale testing',
+                       None, remaining, batch_time, batch_time)
+
+        self._table('media', ('subsection_id', 'type', 'file_path', 'title', 'description', 'derivatives', 'order',
+                              'created_at', 'updated_at'), media_rows())
+
+    def kiosks(self, kiosk_count, button_media_count):
+        rng = self.rng
+        first_kiosk, _ = self._table('kiosk', ('title', 'description', 'created_at', 'updated_at'), (
+            (f"Seeded kiosk {n + 1}", f"Showroom screen {n + 1}", _ts(created), _ts(created))
+            for n, created in enumerate(_timestamps(rng, kiosk_count))
+        ))
+
+        videos = [(first_kiosk + k, v) for k in range(kiosk_count) for v in range(rng.randint(3, 12))]
+        first_video, _ = self._table('video', ('kiosk_id', 'title', 'description', 'file_path', 'hls_manifest',
+                                               'created_at', 'updated_at'), (
+            (kiosk_id, f"Video {v + 1}", None, self._file('video'), None, _ts(created), _ts(created))
+            for (kiosk_id, v), created in zip(videos, _timestamps(rng, len(videos)))
+        ))
+
+        # Buttons are named after subsections, which is what /api/media/map-toggle matches on
+        buttons = [first_video + v for v in range(len(videos)) for _ in range(rng.randint(4, 10))]
+        first_button, _ = self._table('button', ('video_id', 'title'), (
+            (video_id, rng.choice(self.subsection_names)) for video_id in buttons
+        ))
+        button_ids = list(range(first_button, first_button + len(buttons)))
+        pick_button = _weighted(rng, button_ids, _skewed_weights(rng, len(button_ids)))
+        pick_type = _weighted(rng, ['image', 'video'], [90, 10])
+
+        def button_media_rows():
+            for created in _timestamps(rng, button_media_count):
+                media_type = pick_type()
+                yield (pick_button(), media_type, self._file(media_type),
+                       f"Seeded button media {rng.randrange(max(1, button_media_count // 4))}", None, None,
+                       _ts(created), _ts(created))
+
+        self._table('button_media', ('button_id', 'type', 'file_path', 'title', 'description', 'derivatives',
+                                     'created_at', 'updated_at'), button_media_rows())
+
+    def homes(self, home_count):
+        rng = self.rng
+        first, _ = self._table('homes', ('title', 'description', 'created_at', 'updated_at'), (
+            (f"Seeded home {n + 1}", 'Seeded for scale testing', _ts(created), _ts(created))
+            for n, created in enumerate(_timestamps(rng, home_count))
+        ))
+        homes = [first + h for h in range(home_count) for _ in range(rng.randint(3, 15))]
+
+        pick_type = _weighted(rng, *HOME_MEDIA_TYPES)
+
+        def home_media_rows():
+            for home_id, created in zip(homes, _timestamps(rng, len(homes))):
+                media_type = pick_type()
+                yield (home_id, media_type, self._file('video' if media_type == 'video' else 'image'), None,
+                       _ts(created))
+
+        self._table('home_media', ('home_id', 'media_type', 'file_path', 'derivatives', 'created_at'),
+                    home_media_rows())
+
+    def object_bookkeeping(self):
+        adjust_references(self.conn, self.references)
+        self.conn.execute(text(
+            'UPDATE media_objects SET size = :size, content_hash = :sha256 WHERE file_path = :url'
+        ), [{'size': item['size'], 'sha256': item['sha256'], 'url': item['url']}
+            for files in self.placeholders.values() for item in files if item['url'] in self.references])
+
+
+def seed_legacy_plans(pool, rng, count, placeholders):
+    """floor_plans_and_elevations, the raw sqlite3 table behind the legacy routes; files are under /uploads"""
+    images = [item['name'] for item in placeholders['image']]
+    dimension, facing, type_of_use, _ = _plan_facets(rng)
+    with pool.connection() as conn:
+        conn.executemany(
+            'INSERT INTO floor_plans_and_elevations '
+            '(dimension, facing, type_of_use, floors, floor_plan, elevation, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            ((
+                dimension(), facing(), type_of_use(), rng.randint(1, 5),
+                rng.choice(images), rng.choice(images), created.strftime('%Y-%m-%d %H:%M:%S')
+            ) for created in _timestamps(rng, count))
+        )
+        conn.commit()
+
+
+def seed(app, pool, scale, seed=42, upload=False, append=False, placeholders=None):
+    """
+    Generate the catalog; returns {table: (first id, row count)}.
+    `placeholders` are write_placeholders' result, if the caller already has it.
+    """
+    if not app.config['S3_LOCATION']:
+        raise SeedError('S3_LOCATION must be set: rows store the URLs of their files')
+
+    with db.engine.connect() as conn:
+        populated = [table for table in SEEDED_TABLES
+                     if conn.execute(text(f'SELECT EXISTS (SELECT 1 FROM "{table}")')).scalar()]
+    if populated and not append:
+        raise SeedError(f"The database already has rows in {', '.join(populated)}; use --append to add to it")
+
+    if placeholders is None:
+        placeholders = write_placeholders(app, seed)
+    if upload:
+        upload_placeholders(app, placeholders)
+
+    rng = random.Random(seed)
+    with db.engine.begin() as conn:
+        seeder = _Seeder(conn, rng, placeholders)
+        seeder.floor_plans(scale)
+        seeder.sections(max(len(SECTIONS), scale // 100), scale)
+        seeder.kiosks(max(1, scale // 5000), scale // 2)
+        seeder.homes(max(1, scale // 50))
+        seeder.object_bookkeeping()
+    seed_legacy_plans(pool, random.Random(f"{seed}:legacy"), scale, placeholders)
+
+    # What the session hooks would have done for ORM writes
+    get_floorplan_index().invalidate()
+    get_response_cache().invalidate(SEEDED_TABLES)
+    return dict(seeder.ranges, floor_plans_and_elevations=(None, scale))
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    import time
+    from app import app, sqlite_pool
+
+    parser = argparse.ArgumentParser(description='Fill the database with a deterministic synthetic catalog')
+    parser.add_argument('--scale', type=int, default=1000, help='rows in the largest tables (10**3 to 10**6)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--upload', action='store_true', help='also put the placeholder files on S3')
+    parser.add_argument('--append', action='store_true', help='add to a database that already has rows')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            ranges = seed(app, sqlite_pool, args.scale, args.seed, args.upload, args.append)
+        except SeedError as e:
+            sys.exit(str(e))
+    for table, (_, count) in ranges.items():
+        print(f"{table:<28} {count:>10,}")
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,33 @@
+from sqlalchemy import event
+
+# Pragmas applied to every SQLite connection (SQLAlchemy engine, raw sqlite3 and the
+# upload job table). WAL lets readers run while a writer is committing, and the busy
+# timeout makes concurrent writers wait instead of failing with "database is locked".
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # Safe with WAL; only the last commits can be lost on power failure
+    'busy_timeout': 5000,  # Milliseconds
+    'cache_size': -20000,  # Negative means KiB, so ~20MB of page cache per connection
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY'
+}
+
+
+def apply_pragmas(conn, pragmas):
+    """Apply `pragmas` to an open DB-API sqlite3 connection"""
+    cursor = conn.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine, pragmas):
+    """Apply `pragmas` to every connection the engine opens"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
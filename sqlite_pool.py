@@ -0,0 +1,112 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from flask import g
+from sqlite_config import apply_pragmas
+
+HEALTH_CHECK_AFTER = 30  # Seconds a connection may sit idle before it is pinged on checkout
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class SQLitePool:
+    """
+    Bounded, thread-safe pool of raw sqlite3 connections.
+
+    Connections are opened lazily up to `size`, keep sqlite3's per-connection
+    prepared-statement cache warm across requests, and are pinged before reuse
+    if they have been idle for a while. Each process (e.g. each gunicorn worker)
+    gets its own set of connections.
+    """
+
+    def __init__(self, path, size=8, timeout=10, pragmas=None, statement_cache_size=128):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.statement_cache_size = statement_cache_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+
+    def _create(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False,
+                               cached_statements=self.statement_cache_size)
+        conn.row_factory = sqlite3.Row
+        apply_pragmas(conn, self.pragmas)
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if time.monotonic() - idle_since < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        """Check out a connection, waiting up to `timeout` seconds for a free slot"""
+        if self._pid != os.getpid():
+            # Never reuse connections inherited from the parent across a fork
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"No SQLite connection available after {self.timeout}s")
+        try:
+            while True:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._create()
+                if self._healthy(conn, idle_since):
+                    return conn
+                conn.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any uncommitted work"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        except sqlite3.Error:
+            conn.close()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def init_app(self, app):
+        """Give each request its own pooled connection, returned on teardown"""
+        app.teardown_appcontext(self._teardown)
+
+    def _teardown(self, exception=None):
+        conn = g.pop('sqlite_conn', None)
+        if conn is not None:
+            self.release(conn)
+
+    def get_connection(self):
+        """The current request's connection, checked out on first use"""
+        if 'sqlite_conn' not in g:
+            g.sqlite_conn = self.acquire()
+        return g.sqlite_conn
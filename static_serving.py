@@ -0,0 +1,128 @@
+"""
+Serving files from UPLOAD_FOLDER.
+
+UPLOADS_SERVE_MODE picks who copies the bytes:
+- 'sendfile': Flask's send_file, which hands the open file to the WSGI
+  server's wsgi.file_wrapper, so gunicorn and friends use os.sendfile and the
+  body never passes through Python
+- 'x-accel': nginx; we answer with X-Accel-Redirect pointing at an internal
+  location (UPLOADS_ACCEL_PREFIX) that aliases the upload folder:
+
+      location /_uploads/ { internal; alias /path/to/app/uploads/; }
+
+- 'x-sendfile': Apache mod_xsendfile / lighttpd; X-Sendfile with the absolute path
+
+Names that contain a content hash never change, so they are served as
+immutable for a year; anything else (the timestamped names uploads get
+here) has a short max-age and is revalidated with its ETag. Content-addressed
+S3 objects (objects/<sha256>.jpg and their derivatives) aren't in this folder:
+media_cache.serve_cached_media sends them from /media with the same header. Text-like files
+with a precompressed .br/.gz sibling are sent in that encoding when the client
+accepts it (`python static_serving.py precompress` creates the siblings).
+"""
+import gzip
+import mimetypes
+import os
+import re
+from flask import abort, current_app, send_file, Response
+from werkzeug.security import safe_join
+from compression import ENCODINGS, brotli, negotiate
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# A hex digest (MD5 and longer) as its own path component or name segment
+CONTENT_HASH_RE = re.compile(r'(?:^|[/_.-])[0-9a-f]{32,}(?=[/_.-]|$)')
+
+PRECOMPRESSED_MIMETYPES = {
+    'application/javascript', 'application/json', 'application/xml', 'image/svg+xml',
+    'text/css', 'text/csv', 'text/html', 'text/javascript', 'text/plain', 'text/xml'
+}
+PRECOMPRESSED_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+
+def is_content_hashed(filename):
+    return CONTENT_HASH_RE.search(filename) is not None
+
+
+def _cache_control(response, filename):
+    if is_content_hashed(filename):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response.headers['Cache-Control'] = f"public, max-age={current_app.config['UPLOADS_MAX_AGE']}"
+    return response
+
+
+def _precompressed(path, mimetype):
+    """(encoding, path) of the best precompressed sibling the client accepts, or (None, path)"""
+    if mimetype not in PRECOMPRESSED_MIMETYPES:
+        return None, path
+    available = {
+        encoding: f"{path}{extension}" for encoding, extension in PRECOMPRESSED_EXTENSIONS.items()
+        if encoding in ENCODINGS and os.path.isfile(f"{path}{extension}")
+    }
+    encoding = negotiate(available)
+    return encoding, available.get(encoding, path)
+
+
+def serve_upload(directory, filename):
+    """Serve `filename` from `directory` according to UPLOADS_SERVE_MODE"""
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding, send_path = _precompressed(path, mimetype)
+    mode = current_app.config['UPLOADS_SERVE_MODE']
+
+    if mode == 'x-accel':
+        # nginx does ranges and conditional requests itself and keeps our Cache-Control
+        internal = current_app.config['UPLOADS_ACCEL_PREFIX'].rstrip('/')
+        relative = os.path.relpath(send_path, directory).replace(os.sep, '/')
+        response = Response(mimetype=mimetype, headers={'X-Accel-Redirect': f"{internal}/{relative}"})
+    elif mode == 'x-sendfile':
+        response = Response(mimetype=mimetype, headers={'X-Sendfile': os.path.abspath(send_path)})
+    elif mode == 'sendfile':
+        # conditional=True answers If-None-Match/If-Modified-Since with 304 and handles Range
+        response = send_file(send_path, mimetype=mimetype, conditional=True, etag=True)
+    else:
+        raise ValueError(f"Unknown UPLOADS_SERVE_MODE: {mode}")
+
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if mimetype in PRECOMPRESSED_MIMETYPES:
+        response.vary.add('Accept-Encoding')
+    return _cache_control(response, filename)
+
+
+def precompress(directory):
+    """Write .gz (and .br, when available) siblings for every text-like file under `directory`"""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if name.endswith(tuple(PRECOMPRESSED_EXTENSIONS.values())):
+                continue
+            if mimetypes.guess_type(name)[0] not in PRECOMPRESSED_MIMETYPES:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                variants['.br'] = brotli.compress(data, quality=11)
+            for extension, body in variants.items():
+                # Only worth keeping if it is actually smaller
+                if len(body) < len(data):
+                    with open(f"{path}{extension}", 'wb') as f:
+                        f.write(body)
+                    written += 1
+    return written
+
+
+if __name__ == '__main__':
+    import sys
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'precompress'
+    if command != 'precompress':
+        sys.exit(f"Unknown command: {command}")
+    print(f"Wrote {precompress(app.config['UPLOAD_FOLDER'])} precompressed files")
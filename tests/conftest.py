@@ -0,0 +1,66 @@
+"""
+Shared fixtures. The app is configured from the environment when app.py is
+imported, so this points it at scratch files and an in-process S3 (moto)
+first; tests share that one app and its database.
+
+    pip install pytest "moto[s3]"
+    python -m pytest -q
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+moto = pytest.importorskip('moto')
+
+SCRATCH_DIR = tempfile.mkdtemp(prefix='app-tests-')
+BUCKET = 'test-bucket'
+
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(SCRATCH_DIR, 'database.db')}",
+    'SQLITE_DATABASE': os.path.join(SCRATCH_DIR, 'database.db'),
+    'UPLOAD_FOLDER': os.path.join(SCRATCH_DIR, 'uploads'),
+    'UPLOAD_JOBS_DB': os.path.join(SCRATCH_DIR, 'upload_jobs.db'),
+    'UPLOAD_SPOOL_DIR': os.path.join(SCRATCH_DIR, 'upload_spool'),
+    'TRANSCODE_WORK_DIR': os.path.join(SCRATCH_DIR, 'transcode'),
+    'MEDIA_CACHE_DIR': os.path.join(SCRATCH_DIR, 'media_cache'),
+    'METRICS_DIR': os.path.join(SCRATCH_DIR, 'metrics'),
+    'PROFILE_DIR': os.path.join(SCRATCH_DIR, 'profiles'),
+    'FLOORPLAN_INDEX_STAMP': os.path.join(SCRATCH_DIR, 'floorplan_index.stamp'),
+    'RESPONSE_CACHE_DB': os.path.join(SCRATCH_DIR, 'response_cache.db'),
+    'UPLOAD_JOB_WORKERS': '0',
+    'TRANSCODE_WORKERS': '0',
+    'MANIFEST_WORKERS': '0',
+    'QUERY_BUDGET_MODE': 'strict',
+    'S3_BUCKET': BUCKET,
+    'S3_KEY': 'test',
+    'S3_SECRET': 'test',
+    'S3_LOCATION': f"https://{BUCKET}.s3.amazonaws.com/",
+    'AWS_DEFAULT_REGION': 'us-east-1',
+})
+
+_s3_mock = moto.mock_aws()
+_s3_mock.start()
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app as flask_app  # noqa: E402
+
+flask_app.testing = True
+flask_app.s3.create_bucket(Bucket=BUCKET)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    _s3_mock.stop()
+    shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,89 @@
+"""Shared S3 objects: deletes decided by the reference count, retried when S3 fails, and undone for racing uploads."""
+import io
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from helpers import send_to_s3, delete_from_s3, purge_unreferenced
+from models import db, Subsection, Media, MediaObject
+
+
+@pytest.fixture
+def stored(app):
+    """(key, url, data) of a fresh content-addressed object in the bucket"""
+    data = uuid.uuid4().bytes
+    key = f"objects/{uuid.uuid4().hex}.jpg"
+    app.s3.put_object(Bucket=app.config['S3_BUCKET'], Key=key, Body=data)
+    return key, f"{app.config['S3_LOCATION'].rstrip('/')}/{key}", data
+
+
+def _add_media(file_path):
+    subsection = Subsection(section_id=1, name=f"Objects {uuid.uuid4().hex}")
+    media = Media(subsection=subsection, type='image', title='Shared', file_path=file_path)
+    db.session.add(media)
+    db.session.commit()
+    return media.id
+
+
+def _on_s3(app, key):
+    listing = app.s3.list_objects_v2(Bucket=app.config['S3_BUCKET'], Prefix=key)
+    return listing.get('KeyCount', 0) == 1
+
+
+def _ref_count(app, url):
+    with app.app_context():
+        return db.session.query(MediaObject.ref_count).filter_by(file_path=url).scalar()
+
+
+def test_failed_delete_stays_pending_until_purged(app, client, stored, monkeypatch):
+    key, url, _ = stored
+    with app.app_context():
+        media_id = _add_media(url)
+
+    def fail(**kwargs):
+        raise RuntimeError('S3 is down')
+
+    monkeypatch.setattr(app.s3, 'delete_object', fail)
+    assert client.delete(f"/api/media/{media_id}").status_code == 200
+    assert _on_s3(app, key)
+    assert _ref_count(app, url) == 0  # Pending
+
+    monkeypatch.undo()
+    with app.app_context():
+        assert purge_unreferenced() == 0
+        assert _on_s3(app, key)  # Tried too recently
+        db.session.query(MediaObject).filter_by(file_path=url).update(
+            {'checked_at': datetime.utcnow() - timedelta(hours=1)})
+        db.session.commit()
+        assert purge_unreferenced() == 0
+    assert not _on_s3(app, key)
+    assert _ref_count(app, url) is None
+
+
+def test_skipped_upload_restores_object_deleted_meanwhile(app, client, stored):
+    key, url, data = stored
+    with app.app_context():
+        first = _add_media(url)
+
+    with app.app_context():
+        upload = FileStorage(io.BytesIO(data), 'photo.jpg', content_type='image/jpeg')
+        assert send_to_s3(upload, app.config['S3_BUCKET'], key) == 'success'  # Already stored: skipped
+
+        # Before this upload commits, another request deletes the only other row, and the object with it
+        responses = []
+        other = threading.Thread(target=lambda: responses.append(client.delete(f"/api/media/{first}")))
+        other.start()
+        other.join()
+        assert responses[0].status_code == 200
+        assert not _on_s3(app, key)
+
+        _add_media(url)
+    assert _on_s3(app, key)
+    assert app.s3.get_object(Bucket=app.config['S3_BUCKET'], Key=key)['Body'].read() == data
+    assert _ref_count(app, url) == 1
+    with app.app_context():
+        assert delete_from_s3(url) == 'success'  # Still referenced: kept
+    assert _on_s3(app, key)
@@ -0,0 +1,59 @@
+"""Uploads return before their WebP/AVIF derivatives are rendered; the rows get them afterwards."""
+import io
+import json
+import threading
+import time
+import uuid
+
+import pytest
+
+import image_derivatives
+from models import db, Media
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (800, 600), uuid.uuid4().bytes * 90000).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _wait_for_derivatives(app, media_id, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with app.app_context():
+            value = db.session.get(Media, media_id).derivatives
+        if value:
+            return json.loads(value)
+        time.sleep(0.05)
+    return None
+
+
+def test_batch_upload_renders_off_the_request(app, client, monkeypatch):
+    rendered_on = []
+    real_render = image_derivatives._render
+
+    def render(data, s3_key):
+        rendered_on.append(threading.current_thread().name)
+        return real_render(data, s3_key)
+
+    monkeypatch.setattr(image_derivatives, '_render', render)
+    response = client.post('/api/subsections', data={'section_id': 1, 'name': f"Derivatives {uuid.uuid4().hex}"})
+    subsection_id = response.get_json()['id']
+
+    response = client.post('/api/media/batch', data={
+        'files[]': [(io.BytesIO(_png()), 'a.png'), (io.BytesIO(_png()), 'b.png')],
+        'subsection_id': str(subsection_id),
+        'title': 'Derivatives',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    media = response.get_json()['media']
+    assert all(item['id'] for item in media)
+
+    for item in media:
+        info = _wait_for_derivatives(app, item['id'])
+        assert info is not None and info['width'] == 800
+        assert info['sources']
+    assert len(rendered_on) == 2
+    assert all(name.startswith('s3-upload') for name in rendered_on)
@@ -0,0 +1,64 @@
+"""FloorPlanIndex pages in sort_key order straight from its bitmaps, through inserts, updates and deletes."""
+import random
+from datetime import datetime, timedelta
+
+from floorplan_index import FloorPlanIndex
+from pagination import sort_key
+
+
+def _row(rng, id):
+    created_at = None if rng.random() < 0.2 else datetime(2024, 1, 1) + timedelta(hours=rng.randrange(500))
+    return {'id': id, 'site_dimension': rng.choice(['30x40', '40x60']), 'facing': rng.choice(['North', 'East']),
+            'type': 'Residential', 'floors': rng.choice(['1', '2']), 'created_at': created_at}
+
+
+def _pages(index, filters, limit):
+    """Every row the index returns, a page at a time"""
+    rows, cursor = [], None
+    while True:
+        page, _ = index.search(filters, cursor=cursor, limit=limit + 1)
+        rows += page[:limit]
+        if len(page) <= limit:
+            return rows
+        cursor = (page[limit - 1]['created_at'], page[limit - 1]['id'])
+
+
+def _expected(rows, filters):
+    matches = [row for row in rows.values() if all(row[facet] == value for facet, value in filters.items())]
+    return sorted(matches, key=lambda row: sort_key(row['created_at'], row['id']), reverse=True)
+
+
+def test_pages_match_a_full_sort():
+    rng = random.Random(7)
+    index = FloorPlanIndex()
+    index.ensure_fresh = lambda: None
+    index._version = 'loaded'
+    index._touch_stamp = lambda: None
+    index._stamp_version = lambda: 'loaded'
+
+    rows = {id: _row(rng, id) for id in range(1, 200)}
+    index._load(list(rows.values()))
+    next_id = 200
+    for step in range(300):
+        action = rng.random()
+        if action < 0.5:
+            changes = {next_id: _row(rng, next_id)}
+            next_id += 1
+        elif action < 0.75 and rows:
+            id = rng.choice(list(rows))
+            changes = {id: dict(rows[id], facing=rng.choice(['North', 'East']))}  # Same key, new facets
+        elif action < 0.85 and rows:
+            id = rng.choice(list(rows))
+            changes = {id: dict(rows[id], created_at=None)}  # Moves to the back
+        elif rows:
+            changes = {rng.choice(list(rows)): None}
+        index.apply_changes(changes)
+        for id, row in changes.items():
+            if row is None:
+                rows.pop(id, None)
+            else:
+                rows[id] = row
+
+        if step % 25 == 0:
+            for filters in ({}, {'facing': 'North'}, {'site_dimension': '40x60', 'floors': '2'}):
+                assert _pages(index, filters, rng.choice([1, 7, 50])) == _expected(rows, filters)
@@ -0,0 +1,70 @@
+"""Kiosk manifests are rebuilt by the manifest queue after commit, with SHA-256 hashes."""
+import hashlib
+import json
+import uuid
+
+import pytest
+
+from models import db, Kiosk, Video, Button, ButtonMedia, MediaObject
+
+
+@pytest.fixture
+def queue(app):
+    return app.extensions['manifests']
+
+
+def _store(app, key, data):
+    app.s3.put_object(Bucket=app.config['S3_BUCKET'], Key=key, Body=data)
+    return f"{app.config['S3_LOCATION'].rstrip('/')}/{key}"
+
+
+def _drain(queue):
+    """Rebuild everything queued, as the workers would"""
+    while (job := queue._claim()) is not None:
+        queue._run(job)
+
+
+def test_rebuilt_by_the_queue_with_sha256_hashes(app, client, queue):
+    video_data, photo_data = uuid.uuid4().bytes * 3, uuid.uuid4().bytes
+    video_url = _store(app, f"videos/{uuid.uuid4().hex}.mp4", video_data)  # Uploaded before content addressing
+    photo_digest = hashlib.sha256(photo_data).hexdigest()
+    photo_url = _store(app, f"objects/{photo_digest}.jpg", photo_data)
+
+    with app.app_context():
+        kiosk = Kiosk(title='Manifest')
+        button = Button(video=Video(kiosk=kiosk, title='Intro', file_path=video_url), title='Gallery')
+        db.session.add(ButtonMedia(button=button, type='image', title='Photo', file_path=photo_url))
+        db.session.commit()
+        kiosk_id = kiosk.id
+    assert kiosk_id in queue.pending()
+
+    _drain(queue)
+    assert kiosk_id not in queue.pending()
+    response = client.get(f"/api/kiosks/{kiosk_id}/manifest")
+    assert response.status_code == 200
+    video, = json.loads(response.get_data())['videos']
+    assert (video['size'], video['hash']) == (len(video_data), hashlib.sha256(video_data).hexdigest())
+    photo, = video['buttons'][0]['media']
+    assert (photo['size'], photo['hash']) == (len(photo_data), photo_digest)
+
+    with app.app_context():
+        stats = dict(db.session.query(MediaObject.file_path, MediaObject.content_hash)
+                     .filter(MediaObject.file_path.in_([video_url, photo_url])))
+        assert stats == {video_url: hashlib.sha256(video_data).hexdigest(), photo_url: photo_digest}
+
+
+def test_change_during_rebuild_queues_it_again(app, queue):
+    _drain(queue)
+    with app.app_context():
+        kiosk = Kiosk(title='Busy')
+        db.session.add(kiosk)
+        db.session.commit()
+        kiosk_id = kiosk.id
+
+    job = queue._claim()
+    assert job['kiosk_id'] == kiosk_id
+    queue.enqueue({kiosk_id})  # A commit lands while the worker is rebuilding
+    queue._finish(kiosk_id, 'done')
+    assert kiosk_id in queue.pending()
+    _drain(queue)
+    assert kiosk_id not in queue.pending()
@@ -0,0 +1,87 @@
+"""The /media read-through cache: lock files, eviction bookkeeping and stalled fills."""
+import os
+import time
+import uuid
+
+import pytest
+
+import media_cache
+from media_cache import MediaCache, _Fill, _stream
+
+
+@pytest.fixture
+def stored(app):
+    """(key, data) of a fresh object in the bucket"""
+    key = f"objects/test/{uuid.uuid4().hex}.bin"
+    data = os.urandom(3 * media_cache.CHUNK_SIZE + 123)
+    app.s3.put_object(Bucket=app.config['S3_BUCKET'], Key=key, Body=data, ACL='public-read')
+    return key, data
+
+
+def _files(root, suffix):
+    return [name for _, _, names in os.walk(root) for name in names if name.endswith(suffix)]
+
+
+def test_miss_leaves_no_lock_file(app, client, stored):
+    key, data = stored
+    response = client.get(f"/media/{key}")
+    assert response.get_data() == data
+
+    cache_dir = app.config['MEDIA_CACHE_DIR']
+    deadline = time.time() + 5
+    while _files(cache_dir, media_cache.LOCK_SUFFIX) and time.time() < deadline:
+        time.sleep(0.05)  # The download thread lets go just after the last byte
+    assert _files(cache_dir, media_cache.LOCK_SUFFIX) == []
+    assert client.get(f"/media/{key}").get_data() == data
+
+
+def test_evicts_by_running_total(tmp_path, monkeypatch):
+    cache = MediaCache(str(tmp_path), max_bytes=1000, upstream=None)
+    walks = []
+    real_walk = os.walk
+    monkeypatch.setattr(media_cache.os, 'walk', lambda root: walks.append(root) or real_walk(root))
+
+    def add(name, size):
+        (tmp_path / name).write_bytes(b'x' * size)
+        cache._added(size)
+
+    add('a', 300)
+    assert len(walks) == 1  # The first download scans for what's already there
+    add('b', 300)
+    add('c', 300)
+    assert len(walks) == 1
+    add('d', 300)  # 1200 > 1000: scan and evict the oldest down to 900
+    assert len(walks) == 2
+    assert sorted(os.listdir(tmp_path)) == ['b', 'c', 'd']
+    assert cache._size == 900
+
+
+def test_stalled_fill_finishes_from_s3(app, stored, tmp_path, monkeypatch):
+    key, data = stored
+    monkeypatch.setattr(media_cache, 'WAIT_TIMEOUT', 0.05)
+    have = media_cache.CHUNK_SIZE + 10
+    part = tmp_path / 'object.part'
+    part.write_bytes(data[:have])
+
+    fill = _Fill(key, str(part))
+    fill.size = len(data)
+    fill.progress(have)  # ... and then nothing more arrives
+    upstream = app.extensions['upstream_client']
+    url = f"{app.config['S3_LOCATION'].rstrip('/')}/{key}"
+
+    assert b''.join(_stream(fill, open(part, 'rb'), 0, len(data), upstream, url)) == data
+    assert b''.join(_stream(fill, open(part, 'rb'), 5, have + 7, upstream, url)) == data[5:have + 7]
+
+
+def test_content_addressed_objects_are_immutable(app, client, stored):
+    _, data = stored
+    digest = uuid.uuid4().hex * 2
+    app.s3.put_object(Bucket=app.config['S3_BUCKET'], Key=f"objects/{digest}.bin", Body=data, ACL='public-read')
+    for _ in range(2):  # Filled from S3, then from the cache
+        response = client.get(f"/media/objects/{digest}.bin")
+        assert response.get_data() == data
+        assert response.headers['Cache-Control'] == media_cache.IMMUTABLE_CACHE_CONTROL
+
+    legacy = f"videos/{int(time.time())}_clip.bin"  # Timestamped upload names can be overwritten
+    app.s3.put_object(Bucket=app.config['S3_BUCKET'], Key=legacy, Body=data, ACL='public-read')
+    assert 'immutable' not in client.get(f"/media/{legacy}").headers.get('Cache-Control', '')
@@ -0,0 +1,82 @@
+"""Mapped copies outlive their source Media row without blocking later mappings."""
+import uuid
+
+from sqlalchemy import create_engine, text
+
+import migrations
+from models import db, Subsection, Media, Kiosk, Video, Button, ButtonMedia
+
+LEGACY_MEDIA = '''CREATE TABLE media (
+\tid INTEGER NOT NULL, \n\tsubsection_id INTEGER NOT NULL, \n\ttype VARCHAR(20) NOT NULL, \n\tfile_path VARCHAR(255) NOT NULL, \n\ttitle VARCHAR(100), \n\tdescription TEXT, \n\t"order" INTEGER, \n\tcreated_at DATETIME, \n\tupdated_at DATETIME, \n\tPRIMARY KEY (id), \n\tFOREIGN KEY(subsection_id) REFERENCES subsection (id)
+)'''
+
+
+def _media(app, title):
+    with app.app_context():
+        subsection = Subsection(section_id=1, name=f"Mapping {uuid.uuid4().hex}")
+        media = Media(subsection=subsection, type='image', title=title, file_path=f"mapping/{uuid.uuid4().hex}.jpg")
+        db.session.add(media)
+        db.session.commit()
+        return media.id
+
+
+def _button(app):
+    with app.app_context():
+        button = Button(video=Video(kiosk=Kiosk(title='Mapping'), title='Intro', file_path='intro.mp4'), title='Gallery')
+        db.session.add(button)
+        db.session.commit()
+        return button.id
+
+
+def _map(client, title, button_id):
+    response = client.post('/api/media/map-batch', json={'titles': [title], 'button_ids': [button_id], 'action': 'map'})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['count']
+
+
+def _sources(app, button_id):
+    with app.app_context():
+        return sorted((media.source_media_id or 0) for media in ButtonMedia.query.filter_by(button_id=button_id))
+
+
+def test_remap_after_source_deleted(app, client):
+    title = f"Mapped {uuid.uuid4().hex}"
+    button_id = _button(app)
+    first = _media(app, title)
+    assert _map(client, title, button_id) == 1
+
+    assert client.delete(f"/api/media/{first}").status_code == 200
+    assert _sources(app, button_id) == [0]  # The copy stays, unlinked
+
+    second = _media(app, title)
+    assert second > first  # Not the deleted row's id
+    assert _map(client, title, button_id) == 1
+    assert _sources(app, button_id) == [0, second]
+
+
+def test_migration_rebuilds_media_with_autoincrement(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(LEGACY_MEDIA))
+        conn.execute(text('ALTER TABLE media ADD COLUMN derivatives TEXT'))
+        conn.execute(text('CREATE INDEX ix_media_title ON media (title)'))
+        conn.execute(text('CREATE TABLE button_media (id INTEGER PRIMARY KEY, button_id INTEGER, source_media_id INTEGER)'))
+        conn.execute(text("INSERT INTO media (id, subsection_id, type, file_path, title, \"order\") "
+                          "VALUES (1, 1, 'image', 'a.jpg', 'A', 2), (2, 1, 'image', 'b.jpg', 'B', 1)"))
+        conn.execute(text('INSERT INTO button_media (button_id, source_media_id) VALUES (1, 1), (1, 9)'))
+
+    with engine.begin() as conn:
+        migrations._0007_media_autoincrement(conn)
+    with engine.begin() as conn:
+        migrations._0007_media_autoincrement(conn)  # Already done: a no-op
+        ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'media'")).scalar()
+        assert 'AUTOINCREMENT' in ddl
+        assert conn.execute(text('SELECT id, title, "order", derivatives FROM media ORDER BY id')).all() == \
+            [(1, 'A', 2, None), (2, 'B', 1, None)]
+        assert conn.execute(text("SELECT name FROM sqlite_master WHERE tbl_name = 'media' AND type = 'index'")).all() \
+            == [('ix_media_title',)]
+        assert conn.execute(text('SELECT source_media_id FROM button_media ORDER BY id')).scalars().all() == [1, None]
+
+        conn.execute(text('DELETE FROM media WHERE id = 2'))
+        conn.execute(text("INSERT INTO media (subsection_id, type, file_path) VALUES (1, 'image', 'c.jpg')"))
+        assert conn.execute(text("SELECT id FROM media WHERE file_path = 'c.jpg'")).scalar() == 3
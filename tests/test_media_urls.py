@@ -0,0 +1,64 @@
+"""Pages link uploaded images at /media/<object key>, and those links serve the upload."""
+import io
+import re
+import uuid
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _png(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _rendered_media_urls(html):
+    return set(re.findall(r'/media/[^"\'\s]+', html))
+
+
+def _assert_serves(client, html, file_path, data):
+    key = file_path.split('.amazonaws.com/', 1)[1]
+    assert key.startswith('objects/')
+    url = f"/media/{key}"
+    assert url in _rendered_media_urls(html)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_data() == data
+
+
+def test_subsection_image_url(client):
+    response = client.post('/api/subsections', data={'section_id': 1, 'name': f"Media URLs {uuid.uuid4().hex}"})
+    subsection_id = response.get_json()['id']
+    data = _png((200, 30, 30))
+
+    response = client.post('/api/media/batch', data={
+        'files[]': [(io.BytesIO(data), 'front.png')],
+        'subsection_id': str(subsection_id),
+        'title': 'Front view',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    file_path = response.get_json()['media'][0]['file_path']
+
+    html = client.get(f"/subsections/{subsection_id}/view").get_data(as_text=True)
+    _assert_serves(client, html, file_path, data)
+
+
+def test_floor_plan_and_elevation_urls(client):
+    site_dimension = f"test-{uuid.uuid4().hex[:8]}"
+    floor_plan, elevation = _png((30, 200, 30)), _png((30, 30, 200))
+
+    response = client.post('/api/plans', data={
+        'floor_plan': (io.BytesIO(floor_plan), 'plan.png'),
+        'elevation': (io.BytesIO(elevation), 'elevation.png'),
+        'site_dimension': site_dimension, 'facing': 'North', 'type': 'Residential', 'floors': '2',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 201
+    plan = response.get_json()
+
+    html = client.get('/check_floor_plan_and_elevation', query_string={'site_dimension': site_dimension})
+    html = html.get_data(as_text=True)
+    _assert_serves(client, html, plan['floor_plan_path'], floor_plan)
+    _assert_serves(client, html, plan['elevation_path'], elevation)
@@ -0,0 +1,67 @@
+"""Keyset pagination over plans with and without a created_at."""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, FloorPlan
+from pagination import decode_cursor, paginate_query
+
+CREATED = [datetime(2024, 1, 1) + timedelta(days=day) for day in (3, 2, 1)] + [None, None, None]
+
+
+@pytest.fixture
+def plans(app):
+    """Ids of plans under a fresh site_dimension, in the order the feeds list them"""
+    site_dimension = f"test-{uuid.uuid4().hex[:8]}"
+    with app.app_context():
+        rows = [FloorPlan(site_dimension=site_dimension, facing='North', type='Residential', floors='2',
+                          floor_plan_path='plan.png', elevation_path='elevation.png')
+                for _ in CREATED]
+        db.session.add_all(rows)
+        db.session.flush()
+        for row, created_at in zip(rows, CREATED):  # An insert would fill in the default for None
+            row.created_at = created_at
+        db.session.commit()
+        assert [row.created_at for row in rows] == CREATED
+        ids = [row.id for row in rows]
+    # Dated plans newest first, then the undated ones by id
+    return site_dimension, ids[:3] + sorted(ids[3:], reverse=True)
+
+
+def _search_pages(client, site_dimension, limit):
+    ids, cursor, pages = [], None, 0
+    while True:
+        response = client.get('/api/floor-plans/search', query_string={
+            'site_dimension': site_dimension, 'limit': limit, 'cursor': cursor or ''
+        })
+        assert response.status_code == 200, response.get_json()
+        body = response.get_json()
+        ids += [plan['id'] for plan in body['data']]
+        pages += 1
+        cursor = body['next_cursor']
+        if not cursor:
+            return ids, pages
+
+
+@pytest.mark.parametrize('limit', [1, 2, 4])
+def test_search_pages_across_null_created_at(client, plans, limit):
+    site_dimension, expected = plans
+    ids, pages = _search_pages(client, site_dimension, limit)
+    assert ids == expected
+    assert pages == -(-len(expected) // limit)
+
+
+@pytest.mark.parametrize('limit', [1, 2, 4])
+def test_query_pages_across_null_created_at(app, plans, limit):
+    site_dimension, expected = plans
+    ids, cursor = [], None
+    with app.app_context():
+        query = db.session.query(FloorPlan.id, FloorPlan.created_at).filter(FloorPlan.site_dimension == site_dimension)
+        while True:
+            page, next_cursor = paginate_query(query, FloorPlan.created_at, FloorPlan.id, cursor, limit)
+            ids += [row.id for row in page]
+            if not next_cursor:
+                break
+            cursor = decode_cursor(next_cursor)
+    assert ids == expected
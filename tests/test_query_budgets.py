@@ -0,0 +1,133 @@
+"""
+Every page against a seeded catalog, in QUERY_BUDGET_MODE=strict.
+
+The catalog is seeded (seed_data.py) at QUERY_BUDGET_SCALE, every GET route
+whose URL arguments can be filled in is requested, then QUERY_BUDGET_GROWTH
+times as much catalog is appended and they're all requested again. URL
+arguments are the rows with the most children (the subsection with the most
+media, the button with the most button media, ...), so a per-row statement
+shows up in the counts. A route fails when a request runs more statements
+than its budget (see query_budget.py), or when its count went up with the
+catalog: an O(1) route that became O(N). Failures list the statement shapes
+that repeated.
+
+Counts are of the second request to each URL with the response cache off,
+so one-off work such as the floor plan index load isn't counted.
+"""
+import os
+import re
+
+import pytest
+
+from app import app as flask_app, response_cache, sqlite_pool
+from models import db
+from profiling import current_stats
+from query_budget import QueryBudgetExceeded, budget_for, repeated_shapes
+from seed_data import seed
+
+SCALE = int(os.environ.get('QUERY_BUDGET_SCALE', 1000))
+GROWTH = int(os.environ.get('QUERY_BUDGET_GROWTH', 4))
+SEED = 42
+
+# Rules that serve files or take arguments no catalog row provides
+SKIP_RULES = ('/static/', '/uploads/', '/media/', '/api/jobs/')
+
+# URL argument -> query for the id with the most rows under it
+BUSIEST = {
+    'section_id': 'SELECT section_id FROM subsection GROUP BY section_id ORDER BY COUNT(*) DESC, section_id LIMIT 1',
+    'subsection_id': 'SELECT subsection_id FROM media GROUP BY subsection_id ORDER BY COUNT(*) DESC, subsection_id LIMIT 1',
+    'kiosk_id': 'SELECT kiosk_id FROM video GROUP BY kiosk_id ORDER BY COUNT(*) DESC, kiosk_id LIMIT 1',
+    'video_id': 'SELECT video_id FROM button GROUP BY video_id ORDER BY COUNT(*) DESC, video_id LIMIT 1',
+    'button_id': 'SELECT button_id FROM button_media GROUP BY button_id ORDER BY COUNT(*) DESC, button_id LIMIT 1',
+    'home_id': 'SELECT home_id FROM home_media GROUP BY home_id ORDER BY COUNT(*) DESC, home_id LIMIT 1',
+    'plan_id': 'SELECT MAX(id) FROM floor_plans',
+}
+
+# Plain <id> arguments, by the collection the rule is under
+ID_ARGUMENTS = (('/subsections/', 'subsection_id'), ('/homes/', 'home_id'), ('/plans/', 'plan_id'))
+
+
+def _argument_source(rule, argument):
+    if argument != 'id':
+        return argument
+    for prefix, source in ID_ARGUMENTS:
+        if prefix in rule:
+            return source
+    return None
+
+
+def pages(app):
+    """[(endpoint, rule, argument sources)] for every GET route that can be filled in"""
+    found = []
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.rule.startswith(SKIP_RULES):
+            continue
+        sources = {argument: _argument_source(rule.rule, argument) for argument in rule.arguments}
+        if all(source in BUSIEST for source in sources.values()):
+            found.append((rule.endpoint, rule.rule, sources))
+    return sorted(found, key=lambda page: page[1])
+
+
+PAGES = pages(flask_app)
+
+
+def _render(client, url):
+    """(statements run, repeated statement shapes, error) for one request"""
+    with client:  # Keeps the request context, and with it the stats, until the block ends
+        try:
+            response = client.get(url)
+        except QueryBudgetExceeded as e:  # The context is gone, but the exception has the counts
+            return e.queries, e.shapes, None
+        stats = current_stats()
+        error = f"HTTP {response.status_code}" if response.status_code >= 500 else None
+        return stats.queries, repeated_shapes(stats.statements), error
+
+
+def _measure(client):
+    with flask_app.app_context():
+        with db.engine.connect() as conn:
+            ids = {source: conn.exec_driver_sql(sql).scalar() for source, sql in BUSIEST.items()}
+    results = {}
+    for endpoint, rule, sources in PAGES:
+        url = re.sub(r'<(?:\w+:)?(\w+)>', lambda m: str(ids[sources[m.group(1)]]), rule)
+        _render(client, url)
+        results[rule] = (url, *_render(client, url))
+    return results
+
+
+@pytest.fixture(scope='module')
+def counts():
+    """{rule: (small catalog result, large catalog result)}, each (url, statements, repeated shapes, error)"""
+    backend, response_cache.backend = response_cache.backend, None
+    client = flask_app.test_client()
+    try:
+        passes = []
+        for scale, seed_value in ((SCALE, SEED), (SCALE * GROWTH, SEED + 1)):
+            with flask_app.app_context():
+                seed(flask_app, sqlite_pool, scale, seed_value, append=True)
+            passes.append(_measure(client))
+    finally:
+        response_cache.backend = backend
+    small, large = passes
+    return {rule: (small[rule], large[rule]) for rule in small}
+
+
+def _report(result):
+    url, queries, shapes, _ = result
+    lines = [f"GET {url}: {queries} statements"]
+    lines += [f"  {count} x {shape[:200]}" for count, shape in shapes[:5]]
+    return '\n'.join(lines)
+
+
+@pytest.mark.parametrize('endpoint,rule', [(endpoint, rule) for endpoint, rule, _ in PAGES],
+                         ids=[rule for _, rule, _ in PAGES])
+def test_route_within_query_budget(counts, endpoint, rule):
+    small, large = counts[rule]
+    assert small[3] is None and large[3] is None, f"{rule} failed: {small[3] or large[3]}"
+
+    budget = budget_for(endpoint, flask_app)
+    worst = max(small, large, key=lambda result: result[1])
+    assert budget is None or worst[1] <= budget, f"over its budget of {budget}\n{_report(worst)}"
+    assert large[1] <= small[1], (
+        f"statements grew with the catalog ({small[1]} -> {large[1]})\n{_report(large)}"
+    )
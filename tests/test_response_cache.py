@@ -0,0 +1,38 @@
+"""Memory caches in different worker processes purge each other through the invalidation log."""
+import sqlite3
+
+from response_cache import InvalidationLog, MemoryBackend
+
+ENTRY = {'status': 200, 'content_type': 'application/json', 'body': b'{}', 'variants': {}}
+
+
+def _workers(tmp_path, count=2):
+    """Backends as separate processes would have them: their own connection to one file"""
+    path = str(tmp_path / 'response_cache.db')
+    return [MemoryBackend(log=InvalidationLog(path)) for _ in range(count)]
+
+
+def test_purge_reaches_other_workers(tmp_path):
+    first, second = _workers(tmp_path)
+    for backend in (first, second):
+        backend.set('subsection', ENTRY, 60, {'subsection:5'})
+        backend.set('homes', ENTRY, 60, {'homes'})
+
+    first.invalidate({'subsection:5'})
+    assert first.get('subsection') is None
+    assert second.get('subsection') is None
+    assert second.get('homes') == ENTRY
+
+    second.set('subsection', ENTRY, 60, {'subsection:5'})
+    assert second.get('subsection') == ENTRY  # Already replayed: not purged again
+
+
+def test_pruned_log_clears_everything(tmp_path):
+    first, second = _workers(tmp_path)
+    second.set('homes', ENTRY, 60, {'homes'})
+    first.invalidate({'subsection:1'})
+    first.invalidate({'subsection:2'})
+    with sqlite3.connect(str(tmp_path / 'response_cache.db')) as conn:
+        conn.execute('DELETE FROM cache_invalidations WHERE id = (SELECT MIN(id) FROM cache_invalidations)')
+
+    assert second.get('homes') is None
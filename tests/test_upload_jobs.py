@@ -0,0 +1,88 @@
+"""Queued uploads create their row exactly once, however often the job runs."""
+import io
+import os
+import uuid
+
+import pytest
+
+import upload_jobs
+from models import db, Kiosk, Video, Button, ButtonMedia
+
+
+@pytest.fixture
+def button_id(app):
+    with app.app_context():
+        kiosk = Kiosk(title='Upload jobs')
+        video = Video(kiosk=kiosk, title='Intro', file_path='intro.mp4')
+        button = Button(video=video, title='Gallery')
+        db.session.add_all([kiosk, video, button])
+        db.session.commit()
+        return button.id
+
+
+@pytest.fixture
+def queue(app):
+    return app.extensions['upload_jobs']
+
+
+def _queue_upload(client, button_id):
+    data = uuid.uuid4().bytes  # Fresh bytes, so the object isn't already stored
+    response = client.post('/api/button-media', data={
+        'media': (io.BytesIO(data), 'photo.jpg'),
+        'button_id': str(button_id), 'type': 'image', 'title': 'Photo',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 202
+    return response.get_json()['job_id']
+
+
+def _run_next(queue):
+    job = queue._claim()
+    assert job is not None
+    queue._run(job)
+    return job
+
+
+def _rows(app, job_id):
+    with app.app_context():
+        return [media.id for media in ButtonMedia.query.filter_by(upload_job_id=job_id)]
+
+
+def test_rerun_job_reuses_its_row(app, client, queue, button_id):
+    job_id = _queue_upload(client, button_id)
+    _run_next(queue)
+    first = queue.get(job_id)
+    assert first['status'] == 'done'
+
+    # As if the worker died after the handler committed but before the job was recorded done
+    queue._update(job_id, status='queued')
+    _run_next(queue)
+
+    assert queue.get(job_id)['result'] == first['result']
+    assert _rows(app, job_id) == [first['result']['id']]
+
+
+def test_cleanup_failure_leaves_job_done(app, client, queue, button_id, monkeypatch):
+    def fail(path):
+        raise OSError('disk on fire')
+
+    job_id = _queue_upload(client, button_id)
+    monkeypatch.setattr(upload_jobs.os, 'remove', fail)
+    job = _run_next(queue)
+
+    assert queue.get(job_id)['status'] == 'done'
+    assert len(_rows(app, job_id)) == 1
+    assert os.path.exists(job['spool_path'])
+
+
+def test_upload_endpoints_take_large_bodies(app, client, queue, button_id, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 64 * 1024)
+    data = os.urandom(256 * 1024)
+    response = client.post('/api/button-media', data={
+        'media': (io.BytesIO(data), 'clip.mp4'),
+        'button_id': str(button_id), 'type': 'video', 'title': 'Clip',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 202
+    _run_next(queue)
+
+    response = client.post('/api/kiosks', json={'title': 'x' * 256 * 1024})
+    assert response.status_code == 413
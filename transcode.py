@@ -0,0 +1,455 @@
+"""
+HLS transcoding for kiosk videos.
+
+Every uploaded kiosk video is queued here once its original reaches S3. Worker
+threads run ffmpeg to cut an HLS ladder (HLS_LADDER: one segmented rendition
+per bitrate, never taller than the source) and a poster frame, upload them
+next to each other under hls/<original key>/ and record the result on the
+Video row as JSON:
+
+    {"master": url, "poster": url,
+     "renditions": [{"name": "720p", "width": 1280, "height": 720,
+                     "bandwidth": 3338000, "url": url}, ...]}
+
+The work is resumable and idempotent: S3 keys are derived from the original's
+key, a rendition whose playlist is already on S3 is skipped (the playlist is
+uploaded after its segments, so it marks the rendition complete), and
+renditions encoded before a crash are reused from TRANSCODE_WORK_DIR. Re-queuing
+a video therefore only does the work that is missing, e.g. a rung added to the
+ladder. Without ffmpeg on the PATH jobs stay queued and kiosks play the original.
+
+    python transcode.py backfill         # queue videos that have no renditions yet
+    python transcode.py backfill --all   # re-check every video against the ladder
+    python transcode.py work             # run the workers in the foreground
+"""
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app
+from botocore.exceptions import ClientError
+from helpers import send_batch_to_s3
+from models import db, Video
+from content_store import is_referenced, object_key
+from sqlite_config import apply_pragmas
+
+STALE_JOB_SECONDS = 900  # A running job with no heartbeat for this long is assumed dead
+HEARTBEAT_SECONDS = 30  # How often a worker waiting on ffmpeg reports that it is alive
+POLL_INTERVAL = 5
+MAX_ATTEMPTS = 3
+POSTER_HEIGHT = 720
+POSTER_OFFSET = 1.0  # Seconds into the video, so the poster isn't a fade-in black frame
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.jpg': 'image/jpeg'
+}
+
+
+def hls_prefix(file_path):
+    """S3 key prefix for everything generated from the video at `file_path`"""
+    return f"hls/{os.path.splitext(object_key(file_path))[0]}/"
+
+
+class TranscodeQueue:
+    """
+    Durable queue of videos waiting for HLS renditions, one row per video.
+
+    Lives next to the upload jobs in UPLOAD_JOBS_DB. Each process runs
+    TRANSCODE_WORKERS threads (ffmpeg is CPU bound, so keep this small); a job
+    whose worker died is picked up again once its heartbeat goes stale.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.db_path = app.config['UPLOAD_JOBS_DB']
+        self.work_dir = app.config['TRANSCODE_WORK_DIR']
+        self.worker_count = app.config['TRANSCODE_WORKERS']
+        self.pragmas = app.config['SQLITE_PRAGMAS']
+        self.ffmpeg = shutil.which(app.config['FFMPEG_BINARY'])
+        self.ffprobe = shutil.which(app.config['FFPROBE_BINARY'])
+        if self.ffmpeg is None or self.ffprobe is None:
+            app.logger.warning('ffmpeg/ffprobe not found; kiosk videos will not be transcoded to HLS')
+        os.makedirs(self.work_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS transcode_jobs (
+                video_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_transcode_jobs_status ON transcode_jobs (status, created_at)')
+        app.extensions['transcode'] = self
+        app.add_template_filter(parse_hls, 'hls')
+        app.before_request(self.ensure_workers)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        apply_pragmas(conn, self.pragmas)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @property
+    def available(self):
+        return self.ffmpeg is not None and self.ffprobe is not None
+
+    def ensure_workers(self):
+        """Start this process's worker threads (once per process, so forked workers get their own)"""
+        if self._pid == os.getpid() or not self.available:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.worker_count):
+                threading.Thread(target=self._work, name=f'transcode-{i}', daemon=True).start()
+
+    def enqueue(self, video_id):
+        """Queue `video_id` for transcoding; a video already queued or running is left alone"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO transcode_jobs (video_id, status, created_at, updated_at) VALUES (?, 'queued', ?, ?) "
+                "ON CONFLICT (video_id) DO UPDATE SET status = 'queued', attempts = 0, error = NULL, "
+                "updated_at = excluded.updated_at WHERE status NOT IN ('queued', 'running')",
+                (video_id, now, now)
+            )
+        self.ensure_workers()
+        self._wakeup.set()
+
+    def get(self, video_id):
+        """Return the public view of a video's transcode job, or None if it was never queued"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM transcode_jobs WHERE video_id = ?', (video_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'video_id': row['video_id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'error': row['error']
+        }
+
+    def _claim(self):
+        """Atomically take the oldest queued job (or a stale running one) for this worker"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT * FROM transcode_jobs WHERE status = 'queued' "
+                    "OR (status = 'running' AND updated_at < ?) ORDER BY created_at LIMIT 1",
+                    (now - STALE_JOB_SECONDS,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE transcode_jobs SET status = 'running', attempts = attempts + 1, "
+                        "updated_at = ? WHERE video_id = ?",
+                        (now, row['video_id'])
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return row
+
+    def _update(self, video_id, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE transcode_jobs SET {columns} WHERE video_id = ?', (*fields.values(), video_id))
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                self.app.logger.error(f"Error claiming transcode job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        video_id = job['video_id']
+        try:
+            with self.app.app_context():
+                _Transcode(self, video_id).run()
+            self._update(video_id, status='done', error=None)
+            shutil.rmtree(os.path.join(self.work_dir, str(video_id)), ignore_errors=True)
+        except Exception as e:
+            self.app.logger.exception(f"Error transcoding video {video_id}: {e}")
+            # The work directory is kept either way, so a retry resumes where this one stopped
+            if job['attempts'] + 1 >= MAX_ATTEMPTS:
+                self._update(video_id, status='failed', error=str(e))
+            else:
+                self._update(video_id, status='queued', error=str(e))
+
+
+class _Transcode:
+    """One video's trip through ffmpeg; every step skips work that is already done"""
+
+    def __init__(self, queue, video_id):
+        self.queue = queue
+        self.video_id = video_id
+        self.work_dir = os.path.join(queue.work_dir, str(video_id))
+        self.bucket = current_app.config['S3_BUCKET']
+        self.s3_location = current_app.config['S3_LOCATION'].rstrip('/')
+
+    def run(self):
+        video = db.session.get(Video, self.video_id)
+        if video is None:
+            return  # Deleted while queued
+        file_path = video.file_path
+        # Don't hold a read transaction open while ffmpeg runs
+        db.session.close()
+
+        self.prefix = hls_prefix(file_path)
+        os.makedirs(self.work_dir, exist_ok=True)
+        source = self._fetch_source(file_path)
+        width, height, duration, has_audio = self._probe(source)
+
+        ladder = [rung for rung in current_app.config['HLS_LADDER'] if rung[1] <= height]
+        ladder = ladder or [min(current_app.config['HLS_LADDER'], key=lambda rung: rung[1])]
+        renditions = []
+        for name, rung_height, video_kbps, audio_kbps in ladder:
+            rung_height = min(rung_height, height)
+            self._rendition(source, name, rung_height, video_kbps, audio_kbps, has_audio)
+            renditions.append({
+                'name': name,
+                # What ffmpeg's scale=-2 picks: the source aspect ratio, rounded to an even width
+                'width': round(width * rung_height / height / 2) * 2,
+                'height': rung_height,
+                'bandwidth': (round(video_kbps * 1.1) + (audio_kbps if has_audio else 0)) * 1000,
+                'url': self._url(f"{name}/index.m3u8")
+            })
+        poster = self._poster(source, height, duration)
+        master = self._master(renditions)
+
+        video = db.session.get(Video, self.video_id)
+        if video is None:
+            # Deleted while we were encoding; don't leave the renditions behind
+            delete_renditions(file_path)
+            return
+        video.hls_manifest = json.dumps({'master': master, 'poster': poster, 'renditions': renditions})
+        db.session.commit()
+
+    def _url(self, name):
+        return f"{self.s3_location}/{self.prefix}{name}"
+
+    def _exists(self, name):
+        try:
+            current_app.s3.head_object(Bucket=self.bucket, Key=f"{self.prefix}{name}")
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def _upload(self, files):
+        """Upload local `files` as {name under the prefix: path}, in parallel"""
+        handles = [open(path, 'rb') for path in files.values()]
+        try:
+            results = send_batch_to_s3([
+                (handle, f"{self.prefix}{name}", CONTENT_TYPES[os.path.splitext(name)[1]])
+                for handle, name in zip(handles, files)
+            ], self.bucket)
+        finally:
+            for handle in handles:
+                handle.close()
+        failures = [result for result in results if result != 'success']
+        if failures:
+            raise RuntimeError(f"{len(failures)} of {len(files)} uploads failed: {failures[0]}")
+
+    def _fetch_source(self, file_path):
+        source = os.path.join(self.work_dir, 'source')
+        if not os.path.exists(source):
+            partial = f"{source}.part"
+            current_app.s3.download_file(self.bucket, object_key(file_path), partial)
+            os.replace(partial, source)
+        return source
+
+    def _ffmpeg(self, args):
+        """Run ffmpeg, heartbeating the job while it works; raises with ffmpeg's log on failure"""
+        log_path = os.path.join(self.work_dir, 'ffmpeg.log')
+        with open(log_path, 'w') as log:
+            process = subprocess.Popen(
+                [self.queue.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', *args],
+                stdout=subprocess.DEVNULL, stderr=log
+            )
+            while True:
+                try:
+                    returncode = process.wait(timeout=HEARTBEAT_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    self.queue._update(self.video_id)
+        if returncode != 0:
+            with open(log_path) as log:
+                raise RuntimeError(f"ffmpeg exited with {returncode}: {log.read()[-500:].strip()}")
+
+    def _probe(self, source):
+        """Return (width, height, duration in seconds, has audio) of the source"""
+        output = subprocess.run(
+            [self.queue.ffprobe, '-v', 'error', '-show_entries',
+             'stream=codec_type,width,height:format=duration', '-of', 'json', source],
+            capture_output=True, text=True, check=True
+        ).stdout
+        info = json.loads(output)
+        streams = info.get('streams', [])
+        video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+        if video is None:
+            raise ValueError('Source has no video stream')
+        duration = float(info.get('format', {}).get('duration') or 0)
+        has_audio = any(s.get('codec_type') == 'audio' for s in streams)
+        return video['width'], video['height'], duration, has_audio
+
+    def _rendition(self, source, name, height, video_kbps, audio_kbps, has_audio):
+        if self._exists(f"{name}/index.m3u8"):
+            return
+
+        output_dir = os.path.join(self.work_dir, name)
+        if not os.path.exists(output_dir):
+            # Encode into a scratch directory so a half-written rendition is never mistaken for a finished one
+            scratch = f"{output_dir}.tmp"
+            shutil.rmtree(scratch, ignore_errors=True)
+            os.makedirs(scratch)
+            segment_seconds = current_app.config['HLS_SEGMENT_SECONDS']
+            args = [
+                '-i', source, '-map', '0:v:0',
+                '-vf', f'scale=-2:{height}',
+                '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+                '-b:v', f'{video_kbps}k', '-maxrate', f'{round(video_kbps * 1.1)}k', '-bufsize', f'{video_kbps * 2}k',
+                # Keyframes on segment boundaries at every rung, so players can switch between them cleanly
+                '-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})', '-sc_threshold', '0',
+            ]
+            if has_audio:
+                args += ['-map', '0:a:0', '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ac', '2']
+            args += [
+                '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod',
+                '-hls_segment_filename', os.path.join(scratch, 'segment_%05d.ts'),
+                os.path.join(scratch, 'index.m3u8')
+            ]
+            self._ffmpeg(args)
+            os.replace(scratch, output_dir)
+
+        segments = sorted(f for f in os.listdir(output_dir) if f.endswith('.ts'))
+        self._upload({f"{name}/{segment}": os.path.join(output_dir, segment) for segment in segments})
+        # Last, so its presence on S3 means the whole rendition is there
+        self._upload({f"{name}/index.m3u8": os.path.join(output_dir, 'index.m3u8')})
+        self.queue._update(self.video_id)
+
+    def _poster(self, source, height, duration):
+        if not self._exists('poster.jpg'):
+            poster = os.path.join(self.work_dir, 'poster.jpg')
+            self._ffmpeg([
+                '-ss', str(min(POSTER_OFFSET, duration / 2)), '-i', source, '-frames:v', '1',
+                '-vf', f'scale=-2:{min(height, POSTER_HEIGHT)}', '-q:v', '3', poster
+            ])
+            self._upload({'poster.jpg': poster})
+        return self._url('poster.jpg')
+
+    def _master(self, renditions):
+        """Write and upload the master playlist; it only references what is already on S3"""
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+        for rendition in sorted(renditions, key=lambda r: r['bandwidth']):
+            lines.append(
+                f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['bandwidth']},"
+                f"RESOLUTION={rendition['width']}x{rendition['height']}"
+            )
+            lines.append(f"{rendition['name']}/index.m3u8")
+        master = os.path.join(self.work_dir, 'master.m3u8')
+        with open(master, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self._upload({'master.m3u8': master})
+        return self._url('master.m3u8')
+
+
+def get_transcode_queue():
+    return current_app.extensions['transcode']
+
+
+def parse_hls(value, proxy=False):
+    """
+    Decode a stored hls_manifest column for templates and APIs.
+    With `proxy`, URLs point at the local /media cache instead of S3, which
+    also keeps hls.js requests same-origin.
+    """
+    if not value:
+        return None
+    try:
+        info = json.loads(value)
+    except ValueError:
+        return None
+    if proxy:
+        def local(url):
+            return f"/media/{object_key(url)}"
+        info['master'] = local(info['master'])
+        info['poster'] = local(info['poster'])
+        for rendition in info['renditions']:
+            rendition['url'] = local(rendition['url'])
+    return info
+
+
+def delete_renditions(file_path):
+    """Remove everything generated from the video at `file_path` from S3, once nothing references it"""
+    if is_referenced(file_path):
+        return
+    paginator = current_app.s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=current_app.config['S3_BUCKET'], Prefix=hls_prefix(file_path)):
+        keys = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+        if keys:
+            current_app.s3.delete_objects(Bucket=current_app.config['S3_BUCKET'], Delete={'Objects': keys})
+
+
+def backfill(all_videos=False):
+    """Queue videos without renditions (or every video) for transcoding"""
+    query = db.session.query(Video.id)
+    if not all_videos:
+        query = query.filter(Video.hls_manifest.is_(None))
+    video_ids = [video_id for video_id, in query]
+    queue = get_transcode_queue()
+    for video_id in video_ids:
+        queue.enqueue(video_id)
+    print(f"Queued {len(video_ids)} videos for transcoding")
+
+
+if __name__ == '__main__':
+    import sys
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'backfill'
+    with app.app_context():
+        if command == 'backfill':
+            backfill(all_videos='--all' in sys.argv[2:])
+        elif command == 'work':
+            queue = get_transcode_queue()
+            if not queue.available:
+                sys.exit('ffmpeg and ffprobe are required')
+            queue.ensure_workers()
+            while True:
+                time.sleep(60)
+        else:
+            sys.exit(f"Unknown command: {command}")
@@ -0,0 +1,291 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from flask import current_app
+from helpers import get_transfer_config, purge_unreferenced
+from content_store import existing_keys, keep_for_commit
+from sqlite_config import apply_pragmas
+
+STALE_JOB_SECONDS = 300  # A running job with no progress for this long is assumed dead
+POLL_INTERVAL = 2  # Seconds an idle worker sleeps before checking the table again
+MAX_ATTEMPTS = 3
+PURGE_INTERVAL = 60  # Seconds between an idle worker's retries of failed S3 deletes
+
+_handlers = {}
+
+
+def register_handler(kind):
+    """
+    Register the function that finishes a job of `kind` once its file is on S3.
+
+    The handler is called inside an app context as handler(job_id, payload,
+    file_path) with the job's payload dict and the object's public URL, and
+    returns a JSON-serialisable result (usually the created row). It must be
+    idempotent per job_id: commit the row together with the job_id (and look
+    for that row first), because a job whose handler committed can still run
+    again if the worker dies before recording it done.
+    """
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+class UploadJobQueue:
+    """
+    Durable queue of uploads waiting to be pushed to S3.
+
+    Requests spool the uploaded file to UPLOAD_SPOOL_DIR and insert a row into a
+    local SQLite table, so queued work survives restarts. Each process runs a
+    few worker threads that claim jobs, upload the file (multipart, reporting
+    progress) and hand the result to the registered handler to create the DB row.
+    Idle workers also retry S3 deletes that failed (see content_store.py).
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._pid = None
+        self._purged_at = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.db_path = app.config['UPLOAD_JOBS_DB']
+        self.spool_dir = app.config['UPLOAD_SPOOL_DIR']
+        self.worker_count = app.config['UPLOAD_JOB_WORKERS']
+        self.pragmas = app.config['SQLITE_PRAGMAS']
+        os.makedirs(self.spool_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                spool_path TEXT NOT NULL,
+                s3_key TEXT NOT NULL,
+                content_type TEXT,
+                payload TEXT NOT NULL,
+                bytes_total INTEGER NOT NULL DEFAULT 0,
+                bytes_done INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_upload_jobs_status ON upload_jobs (status, created_at)')
+        app.extensions['upload_jobs'] = self
+        app.before_request(self.ensure_workers)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        apply_pragmas(conn, self.pragmas)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def ensure_workers(self):
+        """Start this process's worker threads (once per process, so forked workers get their own)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.worker_count):
+                threading.Thread(target=self._work, name=f'upload-job-{i}', daemon=True).start()
+
+    def enqueue(self, kind, file, s3_key, payload):
+        """Spool `file` to disk and queue it for upload; returns the job ID"""
+        job_id = uuid.uuid4().hex
+        spool_path = os.path.join(self.spool_dir, job_id)
+        file.save(spool_path)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO upload_jobs (id, kind, status, spool_path, s3_key, content_type, payload, '
+                'bytes_total, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, 'queued', spool_path, s3_key, file.content_type, json.dumps(payload),
+                 os.path.getsize(spool_path), now, now)
+            )
+        self.ensure_workers()
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Return the public view of a job, or None if it doesn't exist"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM upload_jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'bytes_total': row['bytes_total'],
+            'bytes_done': row['bytes_done'],
+            'progress': round(row['bytes_done'] / row['bytes_total'], 3) if row['bytes_total'] else 0,
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error']
+        }
+
+    def _claim(self):
+        """Atomically take the oldest queued job (or a stale running one) for this worker"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    "SELECT * FROM upload_jobs WHERE status = 'queued' "
+                    "OR (status = 'running' AND updated_at < ?) ORDER BY created_at LIMIT 1",
+                    (now - STALE_JOB_SECONDS,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE upload_jobs SET status = 'running', attempts = attempts + 1, "
+                        "bytes_done = 0, updated_at = ? WHERE id = ?",
+                        (now, row['id'])
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return row
+
+    def _update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE upload_jobs SET {columns} WHERE id = ?', (*fields.values(), job_id))
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"Error claiming upload job: {e}")
+                job = None
+            if job is None:
+                self._purge_if_due()
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _purge_if_due(self):
+        with self._lock:
+            if time.time() - self._purged_at < PURGE_INTERVAL:
+                return
+            self._purged_at = time.time()
+        try:
+            with self.app.app_context():
+                failed = purge_unreferenced()
+            if failed:
+                print(f"{failed} unreferenced objects could not be deleted from S3, retrying later")
+        except Exception as e:
+            print(f"Error purging unreferenced objects: {e}")
+
+    def _run(self, job):
+        job_id = job['id']
+        try:
+            handler = _handlers[job['kind']]
+            progress = _ProgressReporter(self, job_id)
+            with self.app.app_context():
+                # Content-addressed: if the same bytes are already stored there is nothing to send
+                keep_for_commit(job['s3_key'], job['spool_path'], job['content_type'])
+                if not existing_keys([job['s3_key']]):
+                    with open(job['spool_path'], 'rb') as f:
+                        current_app.s3.upload_fileobj(
+                            f,
+                            current_app.config['S3_BUCKET'],
+                            job['s3_key'],
+                            ExtraArgs={
+                                "ACL": "public-read",
+                                "ContentType": job['content_type'] or 'application/octet-stream'
+                            },
+                            Config=get_transfer_config(),
+                            Callback=progress
+                        )
+                file_path = f"{current_app.config['S3_LOCATION'].rstrip('/')}/{job['s3_key']}"
+                result = handler(job_id, json.loads(job['payload']), file_path)
+        except Exception as e:
+            print(f"Error processing upload job {job_id}: {e}")
+            self._retry_or_fail(job, e)
+            return
+
+        # The handler has committed its row, so the job has succeeded whatever happens from here on.
+        # If recording that fails the job is picked up again once stale, and the handler returns the same row.
+        try:
+            self._update(job_id, status='done', bytes_done=job['bytes_total'],
+                         result=json.dumps(result), error=None)
+        except Exception as e:
+            print(f"Error marking upload job {job_id} done: {e}")
+            return
+        self._remove_spool(job)
+
+    def _retry_or_fail(self, job, error):
+        try:
+            if job['attempts'] + 1 >= MAX_ATTEMPTS:
+                self._update(job['id'], status='failed', error=str(error))
+                self._remove_spool(job)
+            else:
+                self._update(job['id'], status='queued', error=str(error))
+        except Exception as e:
+            print(f"Error updating upload job {job['id']}: {e}")
+
+    def _remove_spool(self, job):
+        """Best effort: a leftover spool file only costs disk space"""
+        try:
+            if os.path.exists(job['spool_path']):
+                os.remove(job['spool_path'])
+        except OSError as e:
+            print(f"Error removing spooled upload {job['spool_path']}: {e}")
+
+
+class _ProgressReporter:
+    """boto3 transfer callback that writes progress back to the job row, at most once a second"""
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+        self.done = 0
+        self.reported_at = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_transferred):
+        with self._lock:
+            self.done += bytes_transferred
+            if time.time() - self.reported_at < 1:
+                return
+            self.reported_at = time.time()
+            done = self.done
+        self.queue._update(self.job_id, bytes_done=done)
+
+
+def get_upload_queue():
+    return current_app.extensions['upload_jobs']
+
+
+if __name__ == '__main__':
+    import sys
+    from app import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'work'
+    if command != 'work':
+        sys.exit(f"Unknown command: {command}")
+    # Importing the app has started this process's workers; keep them running
+    with app.app_context():
+        get_upload_queue().ensure_workers()
+    while True:
+        time.sleep(60)
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app
+from profiling import record_s3_call
+
+
+class UpstreamClient:
+    """
+    Shared HTTP client for fetching objects from S3_LOCATION.
+
+    Keeps one pooled keep-alive session per process so repeated cache misses
+    reuse TCP/TLS connections, applies connect/read timeouts to every request
+    and retries idempotent requests with exponential backoff on 5xx responses.
+    """
+
+    def __init__(self, pool_size=20, connect_timeout=3.05, read_timeout=30,
+                 retries=3, backoff_factor=0.3):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            pool_size=config['UPSTREAM_POOL_SIZE'],
+            connect_timeout=config['UPSTREAM_CONNECT_TIMEOUT'],
+            read_timeout=config['UPSTREAM_READ_TIMEOUT'],
+            retries=config['UPSTREAM_RETRIES'],
+            backoff_factor=config['UPSTREAM_BACKOFF_FACTOR']
+        )
+
+    @property
+    def session(self):
+        # Sockets must not be shared with a forked child, so each worker process
+        # builds its own session the first time it needs one
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                              max_retries=retry, pool_block=False)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, url, stream=False, etag=None, last_modified=None, byte_range=None):
+        """
+        GET `url`, sending If-None-Match / If-Modified-Since when validators are
+        given, and only bytes [start, stop) for a byte_range of (start, stop)
+        (stop None for the rest of the object)
+        """
+        headers = {}
+        if byte_range is not None:
+            start, stop = byte_range
+            headers['Range'] = f"bytes={start}-{'' if stop is None else stop - 1}"
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        started = time.perf_counter()
+        response = self.session.get(url, headers=headers, stream=stream, timeout=self.timeout)
+        # Until the headers arrive; a streamed body is read later
+        record_s3_call(time.perf_counter() - started)
+        return response
+
+
+def get_upstream_client():
+    """Return the upstream client for the current app, creating it on first use"""
+    client = current_app.extensions.get('upstream_client')
+    if client is None:
+        client = UpstreamClient.from_config(current_app.config)
+        current_app.extensions['upstream_client'] = client
+    return client